@@ -2,26 +2,62 @@
 
 import argparse
 import atexit
+import base64
+import contextlib
+import csv
+import gzip
 import hashlib
+import importlib
+import io
 import ipaddress
 import json
 import logging
-import operator
 import os
 import pprint
-from prettytable import PrettyTable
-from pyVim import connect
-from pyVmomi import vim
+import random
 import re
-import requests
 import shutil
 import socket
-import subprocess
+import struct
 import sys
+import tempfile
+import threading
 import time
-import urllib3
 import yaml
-from pyVim.task import WaitForTask, WaitForTasks
+
+
+class LazyImport(object):
+    """ Module, or module attribute, imported on first use """
+    def __init__(self, module, attribute=None):
+        self._module = module
+        self._attribute = attribute
+        self._target = None
+
+    def _resolve(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            if self._attribute:
+                target = getattr(target, self._attribute)
+            self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._resolve(), name)
+
+    def __call__(self, *args, **kwargs):
+        return self._resolve()(*args, **kwargs)
+
+
+asyncio = LazyImport("asyncio")
+PrettyTable = LazyImport("prettytable", "PrettyTable")
+connect = LazyImport("pyVim.connect")
+vim = LazyImport("pyVmomi", "vim")
+vmodl = LazyImport("pyVmomi", "vmodl")
+VmomiSupport = LazyImport("pyVmomi.VmomiSupport")
+requests = LazyImport("requests")
+ssl = LazyImport("ssl")
+urllib3 = LazyImport("urllib3")
+WaitForTask = LazyImport("pyVim.task", "WaitForTask")
 
 ## logging
 
@@ -37,6 +73,118 @@ def quit(msg):
     sys.exit(1)
 
 
+class Profiler(object):
+    """ Chrome trace-event recorder of the phases and vim tasks """
+    phases_pid = 1
+    tasks_pid = 2
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.origin = time.time()
+        # local clock - vCenter clock, task times come from vCenter
+        self.clock_offset = 0
+        self._depth = 0
+        self._tracks = {}
+
+    def start(self, service_instance=None):
+        self.enabled = True
+        if service_instance is not None:
+            local = time.time()
+            remote = service_instance.CurrentTime().timestamp()
+            self.clock_offset = local - remote
+
+    def _us(self, timestamp):
+        return int((timestamp - self.origin) * 1e6)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Record the span of the wrapped block """
+        if not self.enabled:
+            yield
+            return
+        start = time.time()
+        self._depth += 1
+        try:
+            yield
+        finally:
+            self._depth -= 1
+            self.events.append({
+                "name": name, "cat": "phase", "ph": "X",
+                "ts": self._us(start), "dur": self._us(time.time()) -
+                self._us(start), "pid": self.phases_pid, "tid": 1,
+                "args": {"depth": self._depth}})
+
+    def task(self, name, entity, queued, started, completed, state):
+        """ Record a vim task from its TaskInfo times """
+        if not self.enabled or not (queued and completed):
+            return
+        started = started or completed
+        entity = entity or "vCenter"
+        tid = self._tracks.setdefault(entity, len(self._tracks) + 1)
+        queued, started, completed = [
+            t.timestamp() + self.clock_offset
+            for t in (queued, started, completed)]
+        common = {"cat": "task", "ph": "X", "pid": self.tasks_pid,
+                  "tid": tid, "args": {"entity": entity, "state": state}}
+        self.events.append(dict(common, name=name + " (queued)",
+                                ts=self._us(queued),
+                                dur=self._us(started) - self._us(queued)))
+        self.events.append(dict(common, name=name, ts=self._us(started),
+                                dur=self._us(completed) - self._us(started)))
+
+    def task_info(self, info):
+        """ Record a vim task from a TaskInfo """
+        if self.enabled:
+            self.task(info.descriptionId, info.entityName, info.queueTime,
+                      info.startTime, info.completeTime, info.state)
+
+    def write(self, path):
+        """ Write the Chrome trace-event file """
+        metadata = [
+            {"name": "process_name", "ph": "M", "pid": self.phases_pid,
+             "args": {"name": "caasp-vmware phases"}},
+            {"name": "process_name", "ph": "M", "pid": self.tasks_pid,
+             "args": {"name": "vCenter tasks"}}]
+        for entity, tid in self._tracks.items():
+            metadata.append({"name": "thread_name", "ph": "M",
+                             "pid": self.tasks_pid, "tid": tid,
+                             "args": {"name": entity}})
+        with open(path, "w") as f:
+            json.dump({"traceEvents": metadata + self.events,
+                       "displayTimeUnit": "ms"}, f)
+        log.info("profile written to {0}".format(path))
+
+    def summary(self):
+        """ Table of the time spent per phase and per kind of task """
+        rows = {}
+        for event in self.events:
+            key = (event["cat"], event["name"])
+            count, total, longest = rows.get(key, (0, 0, 0))
+            rows[key] = (count + 1, total + event["dur"],
+                         max(longest, event["dur"]))
+
+        table = PrettyTable()
+        table.field_names = ["Kind", "Name", "Count", "Total (s)", "Max (s)"]
+        table.align["Name"] = "l"
+        table.float_format = ".1"
+        for (kind, name), (count, total, longest) in rows.items():
+            table.add_row([kind, name, count, total / 1e6, longest / 1e6])
+        return table.get_string(sortby="Total (s)", reversesort=True)
+
+
+profiler = Profiler()
+
+
+def wait_for_task(task, *args, **kwargs):
+    """ WaitForTask recording the task in the profile """
+    try:
+        return WaitForTask(task, *args, **kwargs)
+    finally:
+        if profiler.enabled:
+            profiler.task_info(task.info)
+
+
 def parse_args():
     """ Parse command line arguments """
     parser = argparse.ArgumentParser(description="Process args")
@@ -44,7 +192,9 @@ def parse_args():
     # Mandatory options
     parser.add_argument("action", choices=[
         "plan", "deploy", "destroy", "status", "listimages", "pushimage",
-        "deleteimage"], help="Execution command")
+        "deleteimage", "replenish", "snapshot", "reset", "scale", "reap",
+        "collect"],
+        help="Execution command")
     parser.add_argument("--var-file", help="Deployment customization file")
     parser.add_argument("--stack-name", help="Name of the stack")
     parser.add_argument("--guest-id", help="Guest operating system identifier")
@@ -58,8 +208,66 @@ def parse_args():
                         help="Media directory on the datastore")
     parser.add_argument("--source-media", help="Source media to upload to the"
                         " remote media directory")
-    parser.add_argument("--parallel", action="store_true",
-                        help="Run commands in parallel where possible")
+    parser.add_argument("--source-media-sha256",
+                        help="SHA-256 of the source media, by default read"
+                        " from <source media>.sha256")
+    parser.add_argument("--transfer-parallel", type=int,
+                        help="Number of datastore uploads and downloads run"
+                        " concurrently")
+    parser.add_argument("--transfer-bandwidth", type=float,
+                        help="Total bandwidth of the datastore transfers in"
+                        " MiB/s, 0 for no cap")
+    parser.add_argument("--collect-dir",
+                        help="Local directory the VM logs are downloaded to")
+    parser.add_argument("--parallel", type=int,
+                        help="Number of virtual machines cloned concurrently")
+    parser.add_argument("--max-clones-per-datastore", type=int,
+                        help="Concurrent clones allowed per datastore")
+    parser.add_argument("--max-clones-per-host", type=int,
+                        help="Concurrent clones allowed per ESXi host")
+    parser.add_argument("--linked-clones", action="store_true",
+                        help="Create nodes as linked clones of a snapshot"
+                        " of the role templates")
+    parser.add_argument("--pool-size", type=int,
+                        help="Number of warm pool VMs kept per role and"
+                        " media, 0 disables the warm pool")
+    parser.add_argument("--pool-folder",
+                        help="VM folder and datastore directory of the"
+                        " warm pool")
+    parser.add_argument("--clone-retries", type=int,
+                        help="Retries of a clone failing with a transient"
+                        " fault")
+    parser.add_argument("--power-on-batch", type=int,
+                        help="Number of VMs powered-on by a single"
+                        " PowerOnMultiVM_Task, 1 disables batching")
+    parser.add_argument("--capacity-check",
+                        choices=["refuse", "shrink", "off"],
+                        help="Refuse a stack which does not fit the"
+                        " resource pool and datastores, or drop workers"
+                        " until it does")
+    parser.add_argument("--cpu-overcommit", type=float,
+                        help="vCPUs counted per free physical core by the"
+                        " capacity check")
+    parser.add_argument("--snapshot-name",
+                        help="Name of the snapshot taken by the snapshot"
+                        " action")
+    parser.add_argument("--reap-ttl", type=float,
+                        help="Hours after which a stack whose VMs were"
+                        " neither created nor powered-on is reaped")
+    parser.add_argument("--reap-stacks",
+                        help="Comma separated stacks reap is restricted to,"
+                        " all the stacks by default")
+    parser.add_argument("--reap-confirm", action="store_true",
+                        help="Tear down the stacks reap reports")
+    parser.add_argument("--reap-force", action="store_true",
+                        help="Also reap the stacks having powered-on VMs")
+    parser.add_argument("--template-cache", action="store_true",
+                        help="Share the role templates between the stacks")
+    parser.add_argument("--template-cache-folder",
+                        help="VM folder and datastore directory of the"
+                        " shared templates")
+    parser.add_argument("--template-cache-size", type=int,
+                        help="Number of unused shared templates kept")
 
     # cloud-init
     parser.add_argument("--admin-cloud-init", help="Path to the cloud-init"
@@ -67,6 +275,11 @@ def parse_args():
     parser.add_argument("--node-cloud-init", help="Path to the cloud-init"
                         " config file for the master and worker nodes")
 
+    parser.add_argument("--cloud-init-mode",
+                        choices=["iso", "guestinfo", "guestinfo-gzip"],
+                        help="Pass the cloud-init data as an iso or through"
+                        " guestinfo, optionally gzipped")
+
     # vCenter
     parser.add_argument("--vc-host", help="vCenter host to connect to")
     parser.add_argument("--vc-port", help="vCenter host port")
@@ -81,6 +294,18 @@ def parse_args():
                         help="Network for the virtual machines")
     parser.add_argument("--vc-resource-pool",
                         help="Resource pool for the virtual machines")
+    parser.add_argument("--vc-datastores",
+                        help="Comma separated datastores the nodes are"
+                        " spread over")
+    parser.add_argument("--vc-hosts",
+                        help="Comma separated ESXi hosts or clusters the"
+                        " nodes are spread over")
+    parser.add_argument("--session-cache", action="store_true",
+                        help="Keep the vCenter session open and reuse it"
+                        " in the next invocations")
+    parser.add_argument("--inventory-cache-ttl", type=int,
+                        help="Seconds the vCenter inventory index is cached,"
+                        " 0 disables the cache")
 
     # Admin
     parser.add_argument("--admin-prefix", help="Admin node name prefix")
@@ -104,6 +329,12 @@ def parse_args():
                         help="Show every VMs on the cluster, can take long time")
     parser.add_argument("--show-regex",
         help="Show VMs on the cluster matching a regex")
+    parser.add_argument("--output", choices=["table", "json", "csv"],
+                        help="Output format")
+
+    # Profiling
+    parser.add_argument("--profile", help="Write a Chrome trace-event file"
+                        " of the phases and vCenter tasks to this path")
 
     args = parser.parse_args()
     return(args)
@@ -113,7 +344,7 @@ def load_yaml(yaml_file):
     """ Load file and read yaml """
     try:
         with open(yaml_file, "r", encoding="utf-8") as f:
-            content = yaml.load(f)
+            content = yaml.safe_load(f)
         return(content)
     except IOError as e:
         quit("I/O error: {0}".format(e))
@@ -136,6 +367,45 @@ def get_user_opt(args):
     if "state_file_dir" not in user_opt:
         user_opt["state_file_dir"] = None
 
+    if "inventory_cache_ttl" not in user_opt:
+        user_opt["inventory_cache_ttl"] = 3600
+
+    for k, v in [("parallel", 1),
+                 ("max_clones_per_datastore", None),
+                 ("max_clones_per_host", None),
+                 ("clone_retries", 3),
+                 ("linked_clones", False),
+                 ("pool_size", 0),
+                 ("pool_folder", "caasp-pool"),
+                 ("cloud_init_mode", "iso"),
+                 ("power_on_batch", 16),
+                 ("session_cache", False),
+                 ("capacity_check", "refuse"),
+                 ("snapshot_name", "caasp-reset"),
+                 ("source_media_sha256", None),
+                 ("transfer_parallel", 4),
+                 ("transfer_bandwidth", 0),
+                 ("collect_dir", "vm-logs"),
+                 ("reap_ttl", 24),
+                 ("reap_stacks", []),
+                 ("reap_confirm", False),
+                 ("reap_force", False),
+                 ("cpu_overcommit", 4),
+                 ("vc_datastores", []),
+                 ("vc_hosts", []),
+                 ("template_cache", False),
+                 ("template_cache_folder", "caasp-templates"),
+                 ("template_cache_size", 3),
+                 ("profile", None)]:
+        if k not in user_opt:
+            user_opt[k] = v
+
+    # lists are comma separated on the command line
+    for k in ["vc_datastores", "vc_hosts", "reap_stacks"]:
+        if isinstance(user_opt[k], str):
+            user_opt[k] = [n.strip() for n in user_opt[k].split(",")
+                           if n.strip()]
+
     # Allow getting credentials from environment user_opt
     if os.environ.get("VC_HOST") is not None:
         user_opt["vc_host"] = os.environ.get("VC_HOST")
@@ -168,7 +438,6 @@ def generate_config(user_opt):
     stack_name = config["parameters"]["stack_name"]
     config["parameters"]["vm_deploy_dir"] = "caasp-{0}".format(stack_name)
 
-    # Used for the local deployment dir in /tmp
     if stack_name:
         stack_hash = hashlib.md5(stack_name.encode('utf-8')).hexdigest()
     else:
@@ -192,7 +461,6 @@ def generate_config(user_opt):
             'ds_cloud_iso_path': 'caasp-pyvomi/caasp-master-pyvomi.iso',
             'instance_id': 'master',
             'iso_filename': 'caasp-master-pyvomi.iso',
-            'path': '/tmp/3772b45d891d0f9d14ddef20c3fd03db/master',
             'stack_hash': '3772b45d891d0f9d14ddef20c3fd03db',
             'stack_name': 'pyvomi'},
           'vmguests': [ {
@@ -205,9 +473,6 @@ def generate_config(user_opt):
         conf_dict[role]["config"]["stack_name"] = stack_name
         conf_dict[role]["config"]["stack_hash"] = stack_hash
 
-        conf_dict[role]["config"]["path"] = "/tmp/{0}/{1}".format(
-            stack_hash, role)
-
         conf_dict[role]["config"]["cloud_init_file"] = cloud_init_file
 
         iso_filename = "{0}.iso".format(node_name)
@@ -236,21 +501,180 @@ def generate_config(user_opt):
     return config
 
 
-def get_obj(service_instance, viewType, obj_name, content=None):
-    """ Return an object from ServiceInstance """
-    recursive = True
-    obj = None
-    if not content:
-        content = service_instance.RetrieveContent()
-    container = content.rootFolder
-    containerView = content.viewManager.CreateContainerView(
-        container, viewType, recursive)
-    for o in containerView.view:
-        if o.name == obj_name:
-            obj = o
-            break
-    containerView.Destroy()
-    return obj
+def retrieve_properties(vsphere, prop_specs, container=None, objects=None,
+                        follow=None, page_size=1000):
+    """
+    Return the prop_specs properties of the objects below container, or of
+    objects and their follow references, as dicts with the object in "obj"
+    """
+    pc = vmodl.query.PropertyCollector
+    content = vsphere.content
+    view = None
+
+    if objects is None:
+        if container is None:
+            container = content.rootFolder
+        view = content.viewManager.CreateContainerView(
+            container, list(prop_specs), True)
+        traversal = pc.TraversalSpec(name="traverseView", path="view",
+                                     skip=False, type=vim.view.ContainerView)
+        object_set = [pc.ObjectSpec(obj=view, skip=True,
+                                    selectSet=[traversal])]
+    else:
+        select_set = []
+        for t, paths in (follow or {}).items():
+            for path in paths:
+                select_set.append(pc.TraversalSpec(
+                    name="follow{0}".format(len(select_set)), path=path,
+                    skip=False, type=t))
+        object_set = [pc.ObjectSpec(obj=o, skip=False, selectSet=select_set)
+                      for o in objects]
+
+    prop_set = [pc.PropertySpec(type=t, pathSet=p, all=False)
+                for t, p in prop_specs.items()]
+    filter_spec = pc.FilterSpec(objectSet=object_set, propSet=prop_set,
+                                reportMissingObjectsInResults=False)
+    options = pc.RetrieveOptions(maxObjects=page_size)
+
+    items = []
+    collector = content.propertyCollector
+    try:
+        result = collector.RetrievePropertiesEx([filter_spec], options)
+        while result:
+            for o in result.objects:
+                item = {p.name: p.val for p in o.propSet}
+                item["obj"] = o.obj
+                items.append(item)
+            if not result.token:
+                break
+            result = collector.ContinueRetrievePropertiesEx(result.token)
+    finally:
+        if view:
+            view.Destroy()
+
+    return items
+
+
+def cache_dir():
+    """ Local directory used to cache data between invocations """
+    path = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                       os.path.expanduser("~/.cache")),
+                        "caasp-vmware")
+    if not os.path.exists(path):
+        os.makedirs(path, mode=0o700)
+    return path
+
+
+class Inventory(object):
+    """ Name -> MoRef index of the vCenter objects, cached on disk for ttl """
+    cache_version = 2
+    type_names = ["Datacenter", "Datastore", "Network", "ResourcePool",
+                  "HostSystem", "ComputeResource"]
+
+    def __init__(self, vsphere, ttl):
+        self.vsphere = vsphere
+        self.ttl = int(ttl)
+        self.cache_file = os.path.join(
+            cache_dir(), "inventory-{0}.json".format(vsphere.host))
+        self.index = None
+        self.from_cache = False
+
+    def _stamp(self):
+        """ Version stamp, part of the ServiceContent we already have """
+        about = self.vsphere.content.about
+        return "{0}:{1}".format(about.instanceUuid, about.build)
+
+    def _load(self):
+        """ Load the index from the disk cache if it is still valid """
+        if self.ttl <= 0 or not os.path.exists(self.cache_file):
+            return None
+        try:
+            with open(self.cache_file, "r", encoding="utf-8") as f:
+                cache = json.load(f)
+        except (IOError, ValueError) as e:
+            log.debug("ignoring inventory cache: {0}".format(e))
+            return None
+
+        if cache.get("version") != self.cache_version:
+            return None
+        if cache.get("stamp") != self._stamp():
+            log.debug("inventory cache stamp mismatch")
+            return None
+        if time.time() - cache.get("created", 0) > self.ttl:
+            log.debug("inventory cache expired")
+            return None
+        return cache["index"]
+
+    def _save(self):
+        if self.ttl <= 0:
+            return
+        cache = {"version": self.cache_version,
+                 "stamp": self._stamp(),
+                 "created": time.time(),
+                 "index": self.index}
+        try:
+            with open(self.cache_file, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+        except IOError as e:
+            log.warning("unable to write inventory cache: {0}".format(e))
+
+    def build(self):
+        """ Index every object name in one pass over the inventory """
+        log.info("indexing vcenter inventory...")
+        types = {t: getattr(vim, t) for t in self.type_names}
+        index = {t: {} for t in types}
+        items = retrieve_properties(
+            self.vsphere, {t: ["name"] for t in types.values()})
+        for item in items:
+            for type_name, vim_type in types.items():
+                if isinstance(item["obj"], vim_type):
+                    # keep the real type, e.g. a DistributedVirtualPortgroup
+                    # is indexed as a Network
+                    index[type_name].setdefault(item["name"], []).append(
+                        [type(item["obj"]).__name__, item["obj"]._moId])
+        self.index = index
+        self.from_cache = False
+        self._save()
+
+    def _candidates(self, type_name, name):
+        if self.index is None:
+            self.index = self._load()
+            self.from_cache = self.index is not None
+            if self.index is None:
+                self.build()
+        return self.index[type_name].get(name, [])
+
+    def lookup(self, type_name, name, scope=None):
+        """ Managed object named name, among the objects of scope, or None """
+        stub = self.vsphere.service_instance._stub
+
+        candidates = self._candidates(type_name, name)
+        if not candidates and self.from_cache:
+            # the object may have been created after the cache
+            self.build()
+            candidates = self._candidates(type_name, name)
+
+        objs = [VmomiSupport.GetVmodlType(t)(moid, stub=stub)
+                for t, moid in candidates]
+        if len(objs) > 1 and scope is not None:
+            scope_ids = set(o._moId for o in scope())
+            objs = [o for o in objs if o._moId in scope_ids] or objs
+        if not objs:
+            return None
+        obj = objs[0]
+
+        if self.from_cache:
+            # cheap single property check of the cached reference
+            try:
+                valid = obj.name == name
+            except vmodl.fault.ManagedObjectNotFound:
+                valid = False
+            if not valid:
+                log.debug("stale inventory cache entry: {0}".format(name))
+                self.build()
+                return self.lookup(type_name, name, scope)
+
+        return obj
 
 
 class VSphere(object):
@@ -264,19 +688,103 @@ class VSphere(object):
         self.datastore_name = vsphere["vc_datastore"]
         self.network_name = vsphere["vc_network"]
         self.resource_pool_name = vsphere["vc_resource_pool"]
+        self.session_cache = vsphere["session_cache"]
+        self.transfer_parallel = max(1, int(vsphere["transfer_parallel"]))
+        self.transfer_limiter = BandwidthLimiter(
+            float(vsphere["transfer_bandwidth"]) * 1024 * 1024)
 
         self.service_intance = self.connect()
         self.content = self._content()
-        self.datacenter = self.get_datacenter()
-        self.datastore = self.get_datastore()
-        self.network = self.get_network()
-        self.resource_pool = self.get_resource_pool()
-        self.storage_manager = self.get_storage_manager()
-        self.file_manager = self.get_file_manager()
+        self.inventory = Inventory(self, vsphere["inventory_cache_ttl"])
+
+        # Objects are resolved on first use
+        self._datacenter = None
+        self._datastore = None
+        self._network = None
+        self._resource_pool = None
+        self._folders = {}
+        self._http_session = None
+        self.datastore_cache = DatastoreCache()
+
+    @property
+    def datacenter(self):
+        if self._datacenter is None:
+            self._datacenter = self.get_datacenter()
+        return self._datacenter
+
+    @property
+    def datastore(self):
+        if self._datastore is None:
+            self._datastore = self.get_datastore()
+        return self._datastore
+
+    @property
+    def network(self):
+        if self._network is None:
+            self._network = self.get_network()
+        return self._network
+
+    @property
+    def resource_pool(self):
+        if self._resource_pool is None:
+            self._resource_pool = self.get_resource_pool()
+        return self._resource_pool
+
+    @property
+    def http_session(self):
+        """ requests.Session carrying the vCenter session cookie """
+        if self._http_session is None:
+            session = requests.Session()
+            # a kept-alive connection per concurrent transfer
+            session.mount("https://", requests.adapters.HTTPAdapter(
+                pool_connections=1, pool_maxsize=self.transfer_parallel))
+            session.verify = not self.insecure
+
+            # vmware_soap_session="697a89a"; Path=/; HttpOnly; Secure;
+            client_cookie = self.service_instance._stub.cookie
+            session.cookies.set(
+                "vmware_soap_session",
+                client_cookie.split("=", 1)[1].split(";", 1)[0])
+            self._http_session = session
+        return self._http_session
+
+    @property
+    def storage_manager(self):
+        """ vim.VirtualDiskManager """
+        return self.content.virtualDiskManager
+
+    @property
+    def file_manager(self):
+        """ vim.FileManager """
+        return self.content.fileManager
+
+    def folder(self, name, create=False):
+        """ vim.Folder directly under the datacenter VM folder """
+        if name not in self._folders:
+            vm_folder = self.datacenter.vmFolder
+            folder = self.content.searchIndex.FindChild(vm_folder, name)
+            if not folder and create:
+                log.info("creating VM folder: {0}".format(name))
+                try:
+                    folder = vm_folder.CreateFolder(name)
+                except vim.fault.DuplicateName:
+                    folder = self.content.searchIndex.FindChild(vm_folder,
+                                                                name)
+            if not folder:
+                return None
+            self._folders[name] = folder
+        return self._folders[name]
 
     # Connect to vCenter
     def connect(self):
         log.task("log in to vcenter".format(self.host))
+        if self.session_cache:
+            service_instance = self._resume_session()
+            if service_instance:
+                self.service_instance = service_instance
+                log.info("cached session still valid, reusing it")
+                return service_instance
+
         log.info("connecting...")
         try:
             if self.insecure is False:
@@ -286,10 +794,6 @@ class VSphere(object):
                     pwd=self.password,
                     port=int(self.port)
                 )
-                atexit.register(connect.Disconnect, service_instance)
-                self.service_instance = service_instance
-                log.info("connection succeeded".format(self.host))
-                return service_instance
             elif self.insecure is True:
                 service_instance = connect.SmartConnectNoSSL(
                     host=self.host,
@@ -297,21 +801,69 @@ class VSphere(object):
                     pwd=self.password,
                     port=int(self.port)
                 )
-                atexit.register(connect.Disconnect, service_instance)
-                self.service_instance = service_instance
-                log.info("connection succeeded".format(self.host))
-                return service_instance
         except Exception as e:
             quit("connection failed: {0}".format(e))
 
+        if self.session_cache:
+            # the session is left open for the next invocations
+            self._save_session(service_instance)
+        else:
+            atexit.register(connect.Disconnect, service_instance)
+        self.service_instance = service_instance
+        log.info("connection succeeded".format(self.host))
+        return service_instance
+
+    @property
+    def session_file(self):
+        """ Session cache file of this host and user """
+        key = hashlib.sha256("{0}:{1}:{2}".format(
+            self.host, self.port, self.username).encode("utf-8")).hexdigest()
+        return os.path.join(cache_dir(), "session-{0}.json".format(key[:16]))
+
+    def _resume_session(self):
+        """ Service instance of the cached session, None if it expired """
+        try:
+            with open(self.session_file, encoding="utf-8") as f:
+                cookie = json.load(f)["cookie"]
+        except (IOError, ValueError, KeyError):
+            return None
+
+        ssl_context = None
+        if self.insecure is True:
+            ssl_context = ssl._create_unverified_context()
+        try:
+            stub = connect.SmartStubAdapter(host=self.host,
+                                            port=int(self.port),
+                                            sslContext=ssl_context)
+            stub.cookie = cookie
+            service_instance = vim.ServiceInstance("ServiceInstance", stub)
+            # None once the session expired or was terminated
+            if service_instance.content.sessionManager.currentSession:
+                return service_instance
+        except Exception as e:
+            log.info("cached session unusable: {0}".format(e))
+        return None
+
+    def _save_session(self, service_instance):
+        """ Store the session cookie, readable by the current user only """
+        cache = {"host": self.host, "user": self.username,
+                 "cookie": service_instance._stub.cookie}
+        try:
+            fd = os.open(self.session_file,
+                         os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            # in case the file already existed with other permissions
+            os.fchmod(fd, 0o600)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+        except (IOError, OSError) as e:
+            log.warning("unable to write session cache: {0}".format(e))
+
     def _content(self):
         return self.service_instance.RetrieveContent()
 
     def get_datacenter(self):
         """ vim.Datacenter """
-        datacenter = None
-        datacenter = get_obj(self.service_instance, [
-                             vim.Datacenter], self.datacenter_name, self.content)
+        datacenter = self.inventory.lookup("Datacenter", self.datacenter_name)
 
         if not datacenter:
             quit("datacenter not found: {0}".format(
@@ -321,11 +873,9 @@ class VSphere(object):
 
     def get_datastore(self):
         """ vim.Datastore """
-        datastore = None
-        for ds in self.datacenter.datastoreFolder.childEntity:
-            if ds.name == self.datastore_name:
-                datastore = ds
-                break
+        datastore = self.inventory.lookup(
+            "Datastore", self.datastore_name,
+            scope=lambda: self.datacenter.datastore)
 
         if not datastore:
             quit("datastore not found: {0}".format(
@@ -335,9 +885,9 @@ class VSphere(object):
 
     def get_network(self):
         """ vim.Network """
-        network = None
-        network = get_obj(self.service_instance, [
-                          vim.Network], self.network_name, self.content)
+        network = self.inventory.lookup(
+            "Network", self.network_name,
+            scope=lambda: self.datacenter.network)
 
         if not network:
             quit("network not found: {0}".format(self.network_name))
@@ -345,9 +895,8 @@ class VSphere(object):
 
     def get_resource_pool(self):
         """ vim.ResourcePool """
-        resource_pool = None
-        resource_pool = get_obj(self.service_instance, [
-                                vim.ResourcePool], self.resource_pool_name, self.content)
+        resource_pool = self.inventory.lookup("ResourcePool",
+                                              self.resource_pool_name)
 
         if not resource_pool:
             quit("resource pool not found: {0}".format(
@@ -355,72 +904,291 @@ class VSphere(object):
 
         return resource_pool
 
-    def get_storage_manager(self):
-        """ vim.VirtualDiskManager """
-        content = self.service_instance.RetrieveServiceContent()
-        self.storage_manager = content.virtualDiskManager
-        return content.virtualDiskManager
 
-    def get_file_manager(self):
-        """ vim.FileManager """
-        content = self.service_instance.RetrieveServiceContent()
-        self.file_manager = content.fileManager
-        return content.fileManager
+class IsoImage(object):
+    """ Minimal in-memory ISO9660 writer with Joliet and Rock Ridge """
+    sector = 2048
+    rr_id = b"RRIP_1991A"
+    rr_descriptor = (b"THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT"
+                     b" FOR POSIX FILE SYSTEM SEMANTICS")
+    rr_source = (b"PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE."
+                 b"  SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR"
+                 b" FOR CONTACT INFORMATION.")
+
+    def __init__(self, volume_id):
+        self.volume_id = volume_id
+        self.files = []
+        self.mtime = time.gmtime()
+
+    def add_file(self, name, data):
+        self.files.append((name, data))
+
+    # Encoding helpers
+
+    @staticmethod
+    def _both16(n):
+        return struct.pack("<H", n) + struct.pack(">H", n)
+
+    @staticmethod
+    def _both32(n):
+        return struct.pack("<I", n) + struct.pack(">I", n)
+
+    @staticmethod
+    def _text(value, size, encoding="ascii"):
+        """ Fixed size identifier field, padded with spaces """
+        if encoding == "utf-16-be":
+            data = value.encode(encoding)[:size - size % 2]
+            data += " ".encode(encoding) * ((size - len(data)) // 2)
+            return data.ljust(size, b"\x00")
+        return value.encode(encoding)[:size].ljust(size, b" ")
+
+    def _dir_date(self):
+        t = self.mtime
+        return struct.pack("7B", t.tm_year - 1900, t.tm_mon, t.tm_mday,
+                           t.tm_hour, t.tm_min, t.tm_sec, 0)
+
+    def _vd_date(self):
+        return time.strftime("%Y%m%d%H%M%S00", self.mtime).encode() + b"\x00"
+
+    @staticmethod
+    def _iso_name(name):
+        """ ISO9660 level 1 file identifier, e.g. user-data -> USER_DAT.;1 """
+        base, _, ext = name.upper().partition(".")
+        base = re.sub("[^A-Z0-9_]", "_", base)[:8]
+        ext = re.sub("[^A-Z0-9_]", "_", ext)[:3]
+        return "{0}.{1};1".format(base, ext).encode("ascii")
+
+    # Rock Ridge System Use entries
+
+    def _rr_px(self, mode, links):
+        return (b"PX" + bytes([36, 1]) + self._both32(mode) +
+                self._both32(links) + self._both32(0) + self._both32(0))
+
+    def _rr_tf(self):
+        # modification, access and attributes times
+        return b"TF" + bytes([5 + 3 * 7, 1, 0x0E]) + self._dir_date() * 3
+
+    @staticmethod
+    def _rr_nm(name):
+        name = name.encode("utf-8")
+        return b"NM" + bytes([5 + len(name), 1, 0]) + name
+
+    def _rr_ce(self, extent, length):
+        return (b"CE" + bytes([28, 1]) + self._both32(extent) +
+                self._both32(0) + self._both32(length))
+
+    def _rr_er(self):
+        return (b"ER" + bytes([8 + len(self.rr_id) + len(self.rr_descriptor) +
+                               len(self.rr_source), 1, len(self.rr_id),
+                               len(self.rr_descriptor), len(self.rr_source),
+                               1]) +
+                self.rr_id + self.rr_descriptor + self.rr_source)
+
+    def _dir_record(self, identifier, extent, size, is_dir, system_use=b""):
+        """ ECMA-119 9.1 directory record """
+        padding = b"\x00" if len(identifier) % 2 == 0 else b""
+        length = 33 + len(identifier) + len(padding) + len(system_use)
+        if length % 2:
+            system_use += b"\x00"
+            length += 1
+        return (bytes([length, 0]) + self._both32(extent) +
+                self._both32(size) + self._dir_date() +
+                bytes([2 if is_dir else 0, 0, 0]) + self._both16(1) +
+                bytes([len(identifier)]) + identifier + padding + system_use)
+
+    def _volume_descriptor(self, joliet, total_sectors, root_extent,
+                           path_table_size, l_table, m_table):
+        """ ECMA-119 8.4 primary or Joliet supplementary descriptor """
+        encoding = "utf-16-be" if joliet else "ascii"
+        root = self._dir_record(b"\x00", root_extent, self.sector, True)
+        vd = (bytes([2 if joliet else 1]) + b"CD001" + bytes([1, 0]) +
+              self._text("", 32, encoding) +
+              self._text(self.volume_id, 32, encoding) +
+              bytes(8) + self._both32(total_sectors))
+        # Joliet UCS-2 level 3 escape sequence
+        vd += (b"%/E" + bytes(29)) if joliet else bytes(32)
+        vd += (self._both16(1) + self._both16(1) +
+               self._both16(self.sector) + self._both32(path_table_size) +
+               struct.pack("<I", l_table) + bytes(4) +
+               struct.pack(">I", m_table) + bytes(4) + root +
+               self._text("", 128, encoding) * 4 +
+               self._text("", 37, encoding) * 3 +
+               self._vd_date() * 2 + b"0" * 16 + b"\x00" +
+               self._vd_date() + bytes([1, 0]))
+        return vd.ljust(self.sector, b"\x00")
+
+    @staticmethod
+    def _path_table(extent, byteorder):
+        """ Path table with the root directory only """
+        return (bytes([1, 0]) + struct.pack(byteorder + "I", extent) +
+                struct.pack(byteorder + "H", 1) + b"\x00\x00")
+
+    def build(self):
+        """ Return the image as bytes """
+        # Layout, in 2048 bytes sectors:
+        #   0-15   system area
+        #   16     primary volume descriptor
+        #   17     Joliet supplementary volume descriptor
+        #   18     volume descriptor set terminator
+        #   19-22  primary and Joliet path tables, L and M
+        #   23     primary root directory, with Rock Ridge entries
+        #   24     Joliet root directory
+        #   25     Rock Ridge continuation area (ER entry)
+        #   26-    file contents
+        primary_root, joliet_root, continuation = 23, 24, 25
+        extent = 26
+        files = []
+        for name, data in sorted(self.files):
+            files.append((name, data, extent))
+            extent += (len(data) + self.sector - 1) // self.sector
+        total_sectors = extent
+
+        # primary root directory with Rock Ridge entries
+        er = self._rr_er()
+        records = [
+            self._dir_record(b"\x00", primary_root, self.sector, True,
+                             b"SP" + bytes([7, 1, 0xBE, 0xEF, 0]) +
+                             self._rr_px(0o40555, 2) + self._rr_tf() +
+                             self._rr_ce(continuation, len(er))),
+            self._dir_record(b"\x01", primary_root, self.sector, True,
+                             self._rr_px(0o40555, 2) + self._rr_tf()),
+        ]
+        for name, data, file_extent in sorted(
+                files, key=lambda f: self._iso_name(f[0])):
+            records.append(self._dir_record(
+                self._iso_name(name), file_extent, len(data), False,
+                self._rr_px(0o100444, 1) + self._rr_tf() +
+                self._rr_nm(name)))
+        primary_dir = b"".join(records)
+
+        # Joliet root directory
+        records = [
+            self._dir_record(b"\x00", joliet_root, self.sector, True),
+            self._dir_record(b"\x01", joliet_root, self.sector, True),
+        ]
+        for name, data, file_extent in files:
+            records.append(self._dir_record(
+                name.encode("utf-16-be"), file_extent, len(data), False))
+        joliet_dir = b"".join(records)
+
+        if max(len(primary_dir), len(joliet_dir)) > self.sector:
+            raise ValueError("too many files for a single sector directory")
+
+        path_table_size = len(self._path_table(0, "<"))
+        sectors = [
+            bytes(self.sector * 16),
+            self._volume_descriptor(False, total_sectors, primary_root,
+                                    path_table_size, 19, 20),
+            self._volume_descriptor(True, total_sectors, joliet_root,
+                                    path_table_size, 21, 22),
+            (bytes([255]) + b"CD001" + bytes([1])).ljust(self.sector,
+                                                         b"\x00"),
+            self._path_table(primary_root, "<"),
+            self._path_table(primary_root, ">"),
+            self._path_table(joliet_root, "<"),
+            self._path_table(joliet_root, ">"),
+            primary_dir,
+            joliet_dir,
+            er,
+        ]
+        sectors += [data for name, data, file_extent in files]
+
+        image = io.BytesIO()
+        for data in sectors:
+            image.write(data)
+            image.write(bytes(-len(data) % self.sector))
+        return image.getvalue()
 
 
 class CloudInit(object):
     """ Create and Push cloud init iso to datastore """
 
+    @staticmethod
+    def user_data(role_config, admin_ip=None):
+        """ Content of the role cloud-init config file """
+        with open(role_config["cloud_init_file"], "r", encoding="utf-8") as f:
+            if admin_ip:
+                return f.read().replace("SET_ADMIN_NODE", admin_ip)
+            return f.read()
+
+    @staticmethod
+    def meta_data(instance_id, hostname="caasp"):
+        return "instance-id: {0}\nlocal-hostname: {1}".format(instance_id,
+                                                              hostname)
+
     @staticmethod
     def create_iso(role_config, admin_ip=None):
-        path = role_config["path"]
-        iso_filename = role_config["iso_filename"]
-        iso_path = "{0}/{1}".format(role_config["path"],
-                                    role_config["iso_filename"])
+        """ Build the cidata iso of a role in memory """
         instance_id = role_config["instance_id"]
-        cloud_init_file = role_config["cloud_init_file"]
 
         log.task("create cloud-init iso: {0}".format(instance_id))
-        if not os.path.exists(iso_path):
-            if not os.path.exists(path):
-                os.makedirs(path)
-
+        if not role_config.get("iso_data"):
             try:
                 log.info("generating metada-data")
-                with open("{0}/meta-data".format(path), "w", encoding="utf-8") as f:
-                    f.write(
-                        "instance-id: {0}\nlocal-hostname: caasp".format(instance_id))
+                meta_data = CloudInit.meta_data(instance_id)
 
                 log.info("generating user-data")
-                with open(cloud_init_file, "r", encoding="utf-8") as f:
-                    if admin_ip:
-                        user_data = f.read().replace("SET_ADMIN_NODE", admin_ip)
-                    else:
-                        user_data = f.read()
-
-                with open("{0}/user-data".format(path), "w", encoding="utf-8") as f:
-                    f.write(user_data)
+                user_data = CloudInit.user_data(role_config, admin_ip)
 
                 log.info("creating iso")
-                subprocess.run("genisoimage -output {0} -volid cidata -joliet -rock user-data meta-data >/dev/null 2>&1".format(
-                    iso_filename), cwd=path, shell=True, check=True)
+                iso = IsoImage("cidata")
+                iso.add_file("user-data", user_data.encode("utf-8"))
+                iso.add_file("meta-data", meta_data.encode("utf-8"))
+                role_config["iso_data"] = iso.build()
                 log.info("iso successfully created")
             except IOError as e:
                 quit("i/o error: {0}".format(e))
-            except subprocess.SubprocessError as es:
-                quit(
-                    "shelling out to genisoimage failed: {0}".format(es))
         else:
             log.info("iso already created")
 
+        return role_config["iso_data"]
+
     @staticmethod
-    def push_iso(vsphere, role_config):
-        iso_path = "{0}/{1}".format(role_config["path"],
-                                    role_config["iso_filename"])
+    def set_guestinfo(vm, admin_ip=None, compress=False):
+        """ Pass the cloud-init data through the guestinfo extraConfig keys """
+        log.task("set cloud-init guestinfo: {0}".format(vm.name))
+        try:
+            user_data = CloudInit.user_data(vm.role_config, admin_ip)
+        except IOError as e:
+            quit("i/o error: {0}".format(e))
+        meta_data = CloudInit.meta_data(vm.name, vm.name)
+
+        extra_config = []
+        for key, data in [("userdata", user_data), ("metadata", meta_data)]:
+            data = data.encode("utf-8")
+            encoding = "base64"
+            if compress:
+                data = gzip.compress(data)
+                encoding = "gzip+base64"
+            extra_config.append(vim.option.OptionValue(
+                key="guestinfo.{0}".format(key),
+                value=base64.b64encode(data).decode("ascii")))
+            extra_config.append(vim.option.OptionValue(
+                key="guestinfo.{0}.encoding".format(key), value=encoding))
+
+        try:
+            log.info("reconfiguring...")
+            task = vm.vm_obj.ReconfigVM_Task(
+                spec=vim.vm.ConfigSpec(extraConfig=extra_config))
+            wait_for_task(task, vm.service_instance)
+            log.info("guestinfo successfully set")
+        except Exception as e:
+            quit("reconfiguration failed: {0}".format(e))
 
+    @staticmethod
+    def push_iso(vsphere, role_config):
         log.task("push cloud-init iso to the datastore")
         Datastore.upload_file(
-            vsphere, iso_path, role_config["ds_cloud_iso_path"])
+            vsphere, role_config["iso_data"], role_config["ds_cloud_iso_path"])
+
+    @staticmethod
+    def push_isos(vsphere, role_configs):
+        """ Upload the cloud-init isos of role_configs """
+        log.task("push {0} cloud-init isos to the datastore".format(
+            len(role_configs)))
+        Datastore.upload_files(vsphere, [
+            (role_config["iso_data"], role_config["ds_cloud_iso_path"], None)
+            for role_config in role_configs])
 
 
 class HttpRequest(object):
@@ -433,7 +1201,9 @@ class HttpRequest(object):
         self.cookies = kwargs.get("cookies", None)
         self.verify = kwargs.get("verify", True)
 
-        self.http = requests.Session()
+        # a shared session is left open for the next requests
+        self.shared = "session" in kwargs
+        self.http = kwargs.get("session") or requests.Session()
 
     def head(self):
         try:
@@ -465,58 +1235,383 @@ class HttpRequest(object):
             quit("connection failed: {0}".format(e))
 
     def close(self):
-        self.http.close()
+        if not self.shared:
+            self.http.close()
+
+
+class UploadStream(object):
+    """ File-like upload body, hashed and throttled as it is read """
+    block_size = 1024 * 1024
+    progress_interval = 10
+
+    def __init__(self, source, size, name=None, limiter=None):
+        self.source = source
+        self.size = size
+        self.name = name
+        self.limiter = limiter
+        self.sha256 = hashlib.sha256()
+        self.sent = 0
+        self.started = time.time()
+        self._logged = self.started
+
+    def __len__(self):
+        # sent as Content-Length, the /folder endpoint does not take
+        # chunked uploads
+        return self.size
+
+    def __iter__(self):
+        # the body, sent block by block
+        while True:
+            data = self.read(self.block_size)
+            if not data:
+                return
+            yield data
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.block_size:
+            size = self.block_size
+        data = self.source.read(size)
+        if self.limiter:
+            self.limiter.consume(len(data))
+        self.sha256.update(data)
+        self.sent += len(data)
+        if time.time() - self._logged >= self.progress_interval:
+            self._logged = time.time()
+            log.info(self.progress())
+        return data
+
+    def rate(self):
+        return self.sent / max(time.time() - self.started, 0.001)
+
+    def progress(self):
+        mib = 1024.0 ** 2
+        rate = self.rate()
+        name = "{0} ".format(self.name) if self.name else ""
+        if not self.size:
+            return "uploaded {0}{1:.0f} MiB, {2:.1f} MiB/s".format(
+                name, self.sent / mib, rate / mib)
+        return "uploaded {0}{1:.0f}/{2:.0f} MiB ({3:.0f}%), {4:.1f} MiB/s, " \
+            "ETA {5:.0f}s".format(name, self.sent / mib, self.size / mib,
+                                  100.0 * self.sent / self.size, rate / mib,
+                                  (self.size - self.sent) / max(rate, 1))
+
+
+class BandwidthLimiter(object):
+    """ Token bucket shared by the transfers, rate in bytes/s, 0 for no cap """
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, size):
+        """ Account for size bytes, sleep while over the rate """
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            self.allowance = min(self.rate, self.allowance +
+                                 (now - self.last) * self.rate) - size
+            self.last = now
+            delay = -self.allowance / self.rate if self.allowance < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+def published_sha256(src_file):
+    """
+    SHA-256 published next to a local or HTTP source as <source>.sha256,
+    plain or GPG clear-signed, or None
+    """
+    checksum_file = "{0}.sha256".format(src_file)
+    try:
+        if src_file[:4] == "http":
+            response = requests.get(checksum_file, timeout=30)
+            if response.status_code != 200:
+                return None
+            content = response.text
+        elif os.path.exists(checksum_file):
+            with open(checksum_file, "r", encoding="utf-8") as f:
+                content = f.read()
+        else:
+            return None
+    except (IOError, requests.RequestException) as e:
+        log.warning("unable to get {0}: {1}".format(checksum_file, e))
+        return None
+
+    name = os.path.basename(src_file)
+    for line in content.splitlines():
+        fields = line.split()
+        if fields and re.match("^[0-9a-fA-F]{64}$", fields[0]) and \
+                (len(fields) == 1 or fields[1].lstrip("*") == name):
+            return fields[0].lower()
+    return None
+
+
+class DatastoreCache(object):
+    """ Run-scoped cache of the datastore browser answers """
+    def __init__(self):
+        # datastore path -> FileInfo, True if it exists but its details
+        # are unknown, None if missing
+        self.files = {}
+        # (datastore dir path, match pattern) -> file names
+        self.listings = {}
+
+    def invalidate(self, datastore_path, exists=False):
+        """ Forget everything about datastore_path and its content """
+        path = datastore_path.rstrip("/")
+        parent = os.path.split(path)[0]
+        for key in list(self.files):
+            if key.rstrip("/") == path or key.startswith(path + "/"):
+                del self.files[key]
+        for key in list(self.listings):
+            folder = key[0].rstrip("/")
+            if folder in (path, parent) or folder.startswith(path + "/"):
+                del self.listings[key]
+        self.files[datastore_path] = True if exists else None
 
 
 class Datastore(object):
     @staticmethod
-    def upload_file(vsphere, src_file, remote_file):
-        """ Upload a file to a datastore using HTTP direct access """
+    def folder_url(vsphere, path):
+        """ HTTP URL of a file of a datastore, through the /folder endpoint """
+        return "https://{0}:443/folder/{1}".format(vsphere.host, path)
+
+    @staticmethod
+    def upload_file(vsphere, src_file, remote_file, sha256=None):
+        """
+        Upload a file to a datastore using HTTP direct access
+        src_file is a local path, an HTTP URL or the content as bytes
+        """
+        Datastore.upload_files(vsphere, [(src_file, remote_file, sha256)])
+
+    @staticmethod
+    def stat_files(vsphere, remote_files):
+        """ FileInfo of the remote_files, None if missing, by remote file """
+        datastore = "[{0}]".format(vsphere.datastore.name)
+        cache = vsphere.datastore_cache
+
+        folders = {}
+        for remote_file in remote_files:
+            info = cache.files.get(datastore + remote_file, False)
+            # True means the file is known to exist, but not its details
+            if info is False:
+                folder, name = os.path.split(remote_file)
+                folders.setdefault(folder, set()).add(name)
+
+        details = vim.host.DatastoreBrowser.FileInfo.Details(
+            fileSize=True, modification=True, fileType=True)
+        searches = []
+        for folder, names in folders.items():
+            spec = vim.host.DatastoreBrowser.SearchSpec(
+                matchPattern=sorted(names), details=details)
+            searches.append((folder, names,
+                             vsphere.datastore.browser.SearchDatastore_Task(
+                                 datastorePath=datastore + folder,
+                                 searchSpec=spec)))
+
+        for folder, names, task in searches:
+            found = {}
+            try:
+                wait_for_task(task)
+                found = {f.path: f for f in task.info.result.file or []}
+            except vim.fault.FileNotFound:
+                pass
+            for name in names:
+                cache.files[datastore + os.path.join(folder, name)] = \
+                    found.get(name)
+
+        return {remote_file: cache.files.get(datastore + remote_file)
+                for remote_file in remote_files}
+
+    @staticmethod
+    def upload_files(vsphere, transfers):
+        """ Upload (source, remote file, sha256) transfers concurrently """
+        remote = Datastore.stat_files(vsphere, [t[1] for t in transfers])
+
+        async def run():
+            semaphore = asyncio.Semaphore(vsphere.transfer_parallel)
+
+            async def transfer(src_file, remote_file, sha256):
+                async with semaphore:
+                    await TaskWaiter._call(
+                        Datastore._upload, vsphere, src_file, remote_file,
+                        remote[remote_file], sha256)
+
+            await asyncio.gather(*[transfer(*t) for t in transfers])
+
+        run_async(run())
+
+    @staticmethod
+    def _source_size(src_file):
+        """ Size of an upload source or None if unknown """
+        if isinstance(src_file, bytes):
+            return len(src_file)
+        if src_file[:4] == "http":
+            try:
+                response = requests.head(
+                    src_file, allow_redirects=True, timeout=30,
+                    headers={"Accept-Encoding": "identity"})
+                size = response.headers.get("Content-Length")
+                return int(size) if response.ok and size else None
+            except requests.RequestException:
+                return None
+        return os.path.getsize(src_file)
+
+    @staticmethod
+    def _upload(vsphere, src_file, remote_file, info, sha256=None):
+        """ Upload one file, info is the remote FileInfo, True or None """
         params = {"dsName": vsphere.datastore.info.name,
                   "dcPath": vsphere.datacenter.name}
-        resource = "folder/{0}".format(remote_file)
-        http_url = "https://{0}:443/{1}".format(vsphere.host, resource)
-
-        # Make a cookie from vmware_soap_session="697a89a"; Path=/; HttpOnly; Secure;
-        client_cookie = vsphere.service_instance._stub.cookie
-        cookie = dict()
-        cookie_value = client_cookie.split("=", 1)[1].split(";", 1)[0]
-        cookie["vmware_soap_session"] = cookie_value
 
         # Get the request headers set up
         headers = {'Content-Type': 'application/octet-stream'}
 
-        # Toggle the boolean insecure
-        verify_cert = not vsphere.insecure
+        remote_file_req = HttpRequest(
+            http_url=Datastore.folder_url(vsphere, remote_file),
+            params=params, headers=headers, verify=not vsphere.insecure,
+            session=vsphere.http_session)
 
-        remote_file_req = HttpRequest(http_url=http_url, params=params,
-                                      headers=headers, cookies=cookie,
-                                      verify=verify_cert)
-
-        remote_file_exists = remote_file_req.head()
+        datastore_path = "[{0}]{1}".format(vsphere.datastore.name, remote_file)
+        if isinstance(src_file, bytes):
+            source = "{0} bytes in memory".format(len(src_file))
+        else:
+            source = src_file
+
+        if info:
+            size = Datastore._source_size(src_file)
+            if info is True or size is None or info.fileSize == size:
+                log.info("file already exists on the datastore: {0}".format(
+                    datastore_path))
+                return
+            log.info("size of {0} differs from {1}, uploading again".format(
+                datastore_path, source))
+
+        log.info("uploading {0} to {1}...".format(source, datastore_path))
+        if isinstance(src_file, bytes):
+            remote_file_req.put(data=UploadStream(
+                io.BytesIO(src_file), len(src_file),
+                limiter=vsphere.transfer_limiter))
+        else:
+            Datastore._stream_upload(vsphere, src_file, remote_file_req,
+                                     datastore_path, sha256)
 
-        log.info("- source: {0}".format(src_file))
-        log.info("- destination: [{0}]{1}".format(vsphere.datastore.info.name,
-                                                  remote_file))
-        if remote_file_exists == 404:
-            log.info("uploading...")
-            if src_file[:4] == "http":
-                file_url = HttpRequest(http_url=src_file)
-                f = file_url.get(stream=True)
-                remote_file_req.put(data=f)
-            else:
-                with open(src_file, "rb") as f:
-                    remote_file_req.put(data=f)
+        log.info("file upload succeeded: {0}".format(datastore_path))
+        remote_file_req.close()
+        vsphere.datastore_cache.invalidate(datastore_path, exists=True)
 
-            log.info("file upload succeeded")
-            remote_file_req.close()
+    @staticmethod
+    def _stream_upload(vsphere, src_file, remote_file_req, datastore_path,
+                       sha256=None):
+        """ PUT a local file or an HTTP URL, verifying its SHA-256 """
+        if sha256 is None:
+            sha256 = published_sha256(src_file)
+        if sha256 is None:
+            log.warning("no published SHA-256 for {0}, the upload is not "
+                        "verified".format(src_file))
+
+        name = os.path.basename(datastore_path)
+        if src_file[:4] == "http":
+            # identity, Content-Length must be the size of the file
+            source = HttpRequest(http_url=src_file,
+                                 headers={"Accept-Encoding": "identity"})
+            response = source.get(stream=True)
+            size = response.headers.get("Content-Length")
+            body = response.raw
+            try:
+                if size is None:
+                    # the upload needs a size, spool the source to get it
+                    log.info("size of {0} unknown, downloading it "
+                             "first".format(src_file))
+                    body = tempfile.TemporaryFile()
+                    shutil.copyfileobj(response.raw, body,
+                                       UploadStream.block_size)
+                    size = body.tell()
+                    body.seek(0)
+                stream = UploadStream(body, int(size), name,
+                                      vsphere.transfer_limiter)
+                remote_file_req.put(data=stream)
+            finally:
+                if body is not response.raw:
+                    body.close()
+                response.close()
+                source.close()
         else:
-            log.info("file already exists on the datastore")
+            with open(src_file, "rb") as f:
+                stream = UploadStream(f, os.path.getsize(src_file), name,
+                                      vsphere.transfer_limiter)
+                remote_file_req.put(data=stream)
+
+        elapsed = time.time() - stream.started
+        log.info("uploaded {0:.0f} MiB in {1:.1f}s, {2:.1f} MiB/s".format(
+            stream.sent / 1024.0 ** 2, elapsed, stream.rate() / 1024.0 ** 2))
+
+        digest = stream.sha256.hexdigest()
+        if sha256 and digest != sha256.lower():
+            # never leave a corrupted image behind
+            wait_for_task(vsphere.file_manager.DeleteDatastoreFile_Task(
+                datacenter=vsphere.datacenter, name=datastore_path))
+            vsphere.datastore_cache.invalidate(datastore_path)
+            quit("SHA-256 mismatch for {0}: {1}, expected {2}".format(
+                src_file, digest, sha256))
+        log.info("SHA-256 {0}: {1}".format(
+            "verified" if sha256 else "of the upload", digest))
+
+    @staticmethod
+    def download_files(vsphere, transfers):
+        """
+        Download ("[datastore] path", local path) transfers concurrently,
+        return the number of files downloaded
+        """
+        async def run():
+            semaphore = asyncio.Semaphore(vsphere.transfer_parallel)
+
+            async def transfer(datastore_path, local_path):
+                async with semaphore:
+                    return await TaskWaiter._call(
+                        Datastore._download, vsphere, datastore_path,
+                        local_path)
+
+            return await asyncio.gather(*[transfer(*t) for t in transfers])
+
+        return sum(run_async(run()))
+
+    @staticmethod
+    def _download(vsphere, datastore_path, local_path):
+        """ Download one file, return True on success """
+        match = re.match(r"^\[([^\]]+)\]\s*(.*)$", datastore_path)
+        if not match:
+            log.warning("not a datastore path: {0}".format(datastore_path))
+            return False
+        params = {"dsName": match.group(1),
+                  "dcPath": vsphere.datacenter.name}
+        limiter = vsphere.transfer_limiter
+
+        os.makedirs(os.path.dirname(local_path) or ".", exist_ok=True)
+        try:
+            response = vsphere.http_session.get(
+                Datastore.folder_url(vsphere, match.group(2)), params=params,
+                stream=True)
+            response.raise_for_status()
+            with open(local_path + ".part", "wb") as f:
+                for data in response.iter_content(UploadStream.block_size):
+                    limiter.consume(len(data))
+                    f.write(data)
+            response.close()
+        except (IOError, requests.RequestException) as e:
+            log.warning("download of {0} failed: {1}".format(
+                datastore_path, e))
+            if os.path.exists(local_path + ".part"):
+                os.remove(local_path + ".part")
+            return False
+
+        os.rename(local_path + ".part", local_path)
+        log.info("downloaded {0}".format(datastore_path))
+        return True
 
     @staticmethod
     def path_exists(vsphere, path):
         """ Check if a file or folder exists on a datastore """
-        path_exist = False
 
         # datastore path = [datastore]path/media.vmdk
         datastore = "[{0}]".format(vsphere.datastore.name)
@@ -524,35 +1619,64 @@ class Datastore(object):
         folder_path = os.path.split(datastore_path)[0]
         file_name = os.path.split(datastore_path)[1]
 
-        # use datastore root folder
-        if not folder_path:
-            folder_path = datastore
+        cache = vsphere.datastore_cache
+        if file_name:
+            if cache.files.get(datastore_path) is True:
+                return True
+            return Datastore.file_info(vsphere, path) is not None
 
         # only search for the folder path
-        if file_name == "":
-            file_name = None
+        if folder_path not in cache.files:
+            spec = vim.host.DatastoreBrowser.SearchSpec()
+            task = vsphere.datastore.browser.SearchDatastore_Task(
+                datastorePath=folder_path, searchSpec=spec)
+            try:
+                wait_for_task(task)
+                # it means at least the directory exists
+                cache.files[folder_path] = True
+            except vim.fault.FileNotFound:
+                cache.files[folder_path] = None
+            except vim.fault.InvalidDatastore as e:
+                quit("operation cannot be performed on the target "
+                     "datastore: {0}".format(e))
+        return cache.files[folder_path] is not None
 
-        spec = vim.host.DatastoreBrowser.SearchSpec(matchPattern=file_name)
+    @staticmethod
+    def file_info(vsphere, path):
+        """ FileInfo, with size and modification time, of a file or None """
+        datastore_path = "[{0}]{1}".format(vsphere.datastore.name, path)
+        folder_path, file_name = os.path.split(datastore_path)
+
+        # use datastore root folder
+        if not folder_path:
+            folder_path = "[{0}]".format(vsphere.datastore.name)
+
+        cache = vsphere.datastore_cache
+        info = cache.files.get(datastore_path, False)
+        # True means the file is known to exist, but not its details
+        if info is not False and info is not True:
+            return info
+
+        details = vim.host.DatastoreBrowser.FileInfo.Details(
+            fileSize=True, modification=True, fileType=True)
+        spec = vim.host.DatastoreBrowser.SearchSpec(matchPattern=[file_name],
+                                                    details=details)
         task = vsphere.datastore.browser.SearchDatastore_Task(
             datastorePath=folder_path, searchSpec=spec)
+        info = None
         try:
-            WaitForTask(task)
-            result = task.info.result
-            for f in result.file:
+            wait_for_task(task)
+            for f in task.info.result.file:
                 if f.path == file_name:
-                    path_exist = True
-                    return path_exist
-                    break
-            # it means at least the directory exists
-            if not file_name:
-                path_exist = True
-        except vim.fault.FileNotFound as e:
-            path_exist = False
+                    info = f
+        except vim.fault.FileNotFound:
+            pass
         except vim.fault.InvalidDatastore as e:
-            quit(
-                "operation cannot be performed on the target datastore: {0}".format(e))
-        finally:
-            return path_exist
+            quit("operation cannot be performed on the target "
+                 "datastore: {0}".format(e))
+
+        cache.files[datastore_path] = info
+        return info
 
     @staticmethod
     def list_path(vsphere, path, match_pattern=None):
@@ -562,18 +1686,56 @@ class Datastore(object):
         datastore_path = datastore + path
         files = []
 
+        cache = vsphere.datastore_cache
+        key = (datastore_path, match_pattern)
+        if key in cache.listings:
+            return list(cache.listings[key])
+
         spec = vim.host.DatastoreBrowser.SearchSpec(matchPattern=match_pattern)
         task = vsphere.datastore.browser.SearchDatastore_Task(
             datastorePath=datastore_path, searchSpec=spec)
 
         try:
-            WaitForTask(task)
+            wait_for_task(task)
             result = task.info.result
             for f in result.file:
                 files.append(f.path)
         except vim.fault.FileNotFound:
             quit("path does not exist: {0}".format(datastore_path))
 
+        cache.listings[key] = list(files)
+        return files
+
+    @staticmethod
+    def search_tree(vsphere, path, match_pattern):
+        """ Files matching match_pattern below path, None if it is missing """
+        datastore = "[{0}]".format(vsphere.datastore.name)
+        datastore_path = datastore + path
+        browser = vim.host.DatastoreBrowser
+
+        details = browser.FileInfo.Details(
+            fileType=True, fileSize=True, modification=True)
+        # typed queries, so that a vmdk is reported once and not also as
+        # its -flat.vmdk extent
+        spec = browser.SearchSpec(
+            matchPattern=match_pattern, details=details,
+            query=[browser.IsoImageQuery(), browser.VmDiskQuery()])
+        task = vsphere.datastore.browser.SearchDatastoreSubFolders_Task(
+            datastorePath=datastore_path, searchSpec=spec)
+        try:
+            wait_for_task(task)
+        except vim.fault.FileNotFound:
+            return None
+
+        files = []
+        cache = vsphere.datastore_cache
+        root = datastore_path.rstrip("/")
+        for result in task.info.result:
+            # folderPath is "[datastore] dir/sub/" or "[datastore]dir/sub"
+            folder = result.folderPath.replace("] ", "]", 1).rstrip("/")
+            for f in result.file or []:
+                cache.files["{0}/{1}".format(folder, f.path)] = f
+                files.append((folder[len(root):].lstrip("/"), f))
         return files
 
     @staticmethod
@@ -592,6 +1754,7 @@ class Datastore(object):
             log.info("creation succeeded")
         except vim.fault.FileAlreadyExists:
             log.info("directory already exists, nothing to do")
+        vsphere.datastore_cache.invalidate(datastore_path, exists=True)
 
     @staticmethod
     def delete_path(vsphere, path):
@@ -608,10 +1771,12 @@ class Datastore(object):
         log.task("delete path: {0}".format(datastore_path))
         try:
             log.info("deleting...")
-            WaitForTask(task)
+            wait_for_task(task)
+            vsphere.datastore_cache.invalidate(datastore_path)
             log.info("deletion succeeded")
         except vim.fault.FileNotFound:
             log.info("path not found, nothing to do")
+            vsphere.datastore_cache.invalidate(datastore_path)
         except vim.fault.CannotDeleteFile as e:
             quit("file deletion failed: {0}".format(e))
         except vim.fault.FileLocked:
@@ -622,6 +1787,10 @@ class VMachine(object):
     recursive = True
     vm_obj = None
     vmdk = None
+    # template snapshot used as parent disk by the linked clones
+    base_snapshot_name = "caasp-linked-clone-base"
+    linked_clone_annotation = "caasp-linked-clone-of: "
+    hardware_version = "vmx-11"
 
     def __init__(self, vsphere, common_config, role_config, vm_config):
         self.vsphere = vsphere
@@ -644,9 +1813,18 @@ class VMachine(object):
                                                       common_config["vm_deploy_dir"],
                                                       vm_config["name"])
 
+        self.template_cache = common_config["template_cache"]
+        if self.template_cache:
+            # role templates are shared by every stack with the same spec
+            self.template_name = TemplateCache.template_name(
+                vsphere, common_config, self.cpu, self.ram)
+            self.template_dir = common_config["template_cache_folder"]
+        else:
+            self.template_dir = common_config["vm_deploy_dir"]
+
         self.vm_template_path = "[{0}] {1}/{2}/{2}.vmx".format(common_config["vc_datastore"],
-                                                               common_config["vm_deploy_dir"],
-                                                               vm_config["name"][:-3])
+                                                               self.template_dir,
+                                                               self.template_name)
 
         self.media_type = common_config["media_type"]
         self.media_name = common_config["media"]
@@ -654,22 +1832,87 @@ class VMachine(object):
             common_config["vc_datastore"], common_config["media"])
 
         self.guest_id = common_config["guest_id"]
+        self.linked_clone = common_config["linked_clones"]
+        self.cloud_init_mode = common_config["cloud_init_mode"]
 
         self.service_instance = vsphere.service_instance
-        self.datacenter = vsphere.datacenter
-        self.datastore = vsphere.datastore
-        self.network = vsphere.network
-        self.resource_pool = vsphere.resource_pool
-        self.storage_manager = vsphere.storage_manager
-        self.file_manager = vsphere.file_manager
+
+        # VM folder and annotation, only used by the warm pool entries
+        self.folder = None
+        self.annotation = None
+        # warm pool VM reserved for this VM
+        self.pool_vm = None
+        # datastore, resource pool and host chosen by Placement
+        self.placement = {}
 
         self.vm_obj = self.get_vm()
 
+    @property
+    def guestinfo(self):
+        """ True if cloud-init data is passed through guestinfo """
+        return self.cloud_init_mode.startswith("guestinfo")
+
+    # vSphere objects are resolved by VSphere on first use
+    @property
+    def datacenter(self):
+        return self.vsphere.datacenter
+
+    @property
+    def vm_folder(self):
+        if self.folder:
+            return self.folder
+        return self.datacenter.vmFolder
+
+    def template_folder(self, create=False):
+        """ VM folder of the role template """
+        if self.template_cache:
+            return self.vsphere.folder(self.template_dir, create=create)
+        return self.vm_folder
+
+    @property
+    def datastore(self):
+        return self.vsphere.datastore
+
+    @property
+    def network(self):
+        return self.vsphere.network
+
+    @property
+    def resource_pool(self):
+        return self.vsphere.resource_pool
+
+    # where the VM is created, vc_datastore and vc_resource_pool unless
+    # it was placed
+    @property
+    def target_datastore(self):
+        return self.placement.get("datastore") or self.datastore
+
+    @property
+    def target_pool(self):
+        return self.placement.get("pool") or self.resource_pool
+
+    @property
+    def target_host(self):
+        return self.placement.get("host")
+
+    @property
+    def storage_manager(self):
+        return self.vsphere.storage_manager
+
+    @property
+    def file_manager(self):
+        return self.vsphere.file_manager
+
     def get_vm(self, isTemplate=False):
         """ Return VirtualMachine object from a Datacenter """
-        vm_name = self.template_name if isTemplate else self.name
+        if isTemplate:
+            folder = self.template_folder()
+            if not folder:
+                return None
+            return self.service_instance.content.searchIndex.FindChild(
+                folder, self.template_name)
         return self.service_instance.content.searchIndex.FindChild(
-            self.datacenter.vmFolder, vm_name)
+            self.vm_folder, self.name)
 
     def _check_media(self):
         """ Check if the media exists on a datastore """
@@ -693,24 +1936,24 @@ class VMachine(object):
             log.info("- destination:".format(self.dest_path))
             try:
                 log.info("copying...")
-                WaitForTask(task, self.service_instance)
+                wait_for_task(task, self.service_instance)
                 log.info("copy succeded")
             except Exception as e:
                 quit("copy error: {0}".format(e))
 
+    @staticmethod
+    def first_ipv4(guest_net):
+        """ Get first IPv4 available on the first NIC of guest.net """
+        if guest_net:
+            for i in guest_net[0].ipAddress:
+                if ipaddress.ip_address(i).version == 4:
+                    return i
+        return None
+
     def get_ip(self):
         """ Get first IPv4 available on the first NIC """
         self.vm_obj = self.get_vm()
-        ip = None
-
-        if self.vm_obj.guest.net:
-            for i in self.vm_obj.guest.net[0].ipAddress:
-                if ipaddress.ip_address(i).version == 4:
-                    ip = i
-                    break
-            return ip
-        else:
-            return ip
+        return self.first_ipv4(self.vm_obj.guest.net)
 
     def create_vm_async(self, isTemplate=False):
         """
@@ -781,6 +2024,12 @@ class VMachine(object):
 
             virtual_eth_spec = vim.vm.device.VirtualDeviceSpec(device=virtual_eth_dev,
                                                                operation=device_operation)
+            device_change = [virtual_ide_controller_spec,
+                             virtual_ide_spec, virtual_eth_spec]
+            # cloud-init data is passed through guestinfo, no CDROM needed
+            if self.media_type == "iso" or not self.guestinfo:
+                device_change.append(virtual_cdrom_spec)
+
             # Add disk.enableUUID=1
             enable_uuid = vim.option.OptionValue(key="disk.enableUUID", value=1)
 
@@ -788,19 +2037,20 @@ class VMachine(object):
                 name=vm_name, guestId=self.guest_id,
                 memoryMB=self.ram, numCPUs=self.cpu,
                 extraConfig=[enable_uuid], files=vmx_file,
-                deviceChange=[virtual_ide_controller_spec,
-                              virtual_ide_spec, virtual_eth_spec, virtual_cdrom_spec],
-                version="vmx-11")
+                deviceChange=device_change,
+                version=self.hardware_version)
 
-            task = self.datacenter.vmFolder.CreateVM_Task(
-                config=vm_spec, pool=self.resource_pool)
+            folder = self.template_folder(create=True) if isTemplate \
+                else self.vm_folder
+            task = folder.CreateVM_Task(
+                config=vm_spec, pool=self.target_pool, host=self.target_host)
             log.info("creating {}".format(vm_name))
             return task
 
     def create_vm(self, isTemplate=False):
         try:
             task = self.create_vm_async(isTemplate=isTemplate)
-            WaitForTask(task, self.service_instance)
+            wait_for_task(task, self.service_instance)
             log.info("creation succeeded")
             self.vm_obj = self.get_vm(isTemplate)
         except Exception as e:
@@ -823,7 +2073,7 @@ class VMachine(object):
             try:
                 log.info("deleting...")
                 task = self.vm_obj.Destroy_Task()
-                WaitForTask(task, self.service_instance)
+                wait_for_task(task, self.service_instance)
                 self.vm_obj = self.get_vm()
                 log.info("deletion succeded")
             except Exception as e:
@@ -859,7 +2109,7 @@ class VMachine(object):
             try:
                 log.info("powering-on...")
                 task = self.vm_obj.PowerOnVM_Task()
-                WaitForTask(task, self.service_instance)
+                wait_for_task(task, self.service_instance)
                 self.vm_obj = self.get_vm()
                 log.info("powering-on succeded")
             except Exception as e:
@@ -877,7 +2127,7 @@ class VMachine(object):
                 try:
                     log.info("powering-off...")
                     task = self.vm_obj.PowerOffVM_Task()
-                    WaitForTask(task, self.service_instance)
+                    wait_for_task(task, self.service_instance)
                     self.vm_obj = self.get_vm()
                     log.info("powering-off succeded")
                 except Exception as e:
@@ -893,6 +2143,186 @@ class VMachine(object):
         self.delete()
         log.info("destroy succeeded")
 
+    # Coroutine variants, tasks are awaited through a TaskWaiter so that
+    # many VMs can be handled concurrently. Task faults are raised.
+
+    async def power_on_aio(self, waiter):
+        """ Power-on a VM """
+        power_state = await TaskWaiter._call(
+            lambda: self.vm_obj.runtime.powerState)
+        if power_state != "poweredOn":
+            log.info("powering-on {0}...".format(self.name))
+            task = await TaskWaiter._call(self.vm_obj.PowerOnVM_Task)
+            await waiter.wait(task)
+            log.info("powering-on succeeded: {0}".format(self.name))
+
+    async def snapshot_aio(self, waiter, name):
+        """ Snapshot the disks of the VM, replacing one named name """
+        previous = await TaskWaiter._call(self.find_snapshot, name)
+        if previous:
+            log.info("removing previous snapshot of {0}...".format(self.name))
+            task = await TaskWaiter._call(previous.RemoveSnapshot_Task,
+                                          removeChildren=True,
+                                          consolidate=True)
+            await waiter.wait(task)
+        log.info("snapshotting {0}...".format(self.name))
+        task = await TaskWaiter._call(
+            self.vm_obj.CreateSnapshot_Task, name=name,
+            description="caasp-vmware reset point", memory=False,
+            quiesce=False)
+        snapshot = await waiter.wait(task)
+        log.info("snapshot succeeded: {0}".format(self.name))
+        return snapshot
+
+    async def revert_aio(self, waiter, name):
+        """ Revert the VM to a snapshot, leaving it powered-off """
+        snapshot = await TaskWaiter._call(self.find_snapshot, name)
+        if not snapshot:
+            raise Exception("snapshot {0} not found on {1}".format(
+                name, self.name))
+        log.info("reverting {0}...".format(self.name))
+        task = await TaskWaiter._call(snapshot.RevertToSnapshot_Task,
+                                      suppressPowerOn=True)
+        await waiter.wait(task)
+        log.info("revert succeeded: {0}".format(self.name))
+
+    def find_snapshot(self, name, vm_obj=None):
+        """ Return the snapshot named name of vm_obj, the VM by default """
+        vm_obj = vm_obj or self.vm_obj
+        if not vm_obj or not vm_obj.snapshot:
+            return None
+
+        snapshots = list(vm_obj.snapshot.rootSnapshotList)
+        while snapshots:
+            snapshot = snapshots.pop()
+            if snapshot.name == name:
+                return snapshot.snapshot
+            snapshots.extend(snapshot.childSnapshotList)
+        return None
+
+    def get_base_snapshot(self, template_vm=None):
+        """ Return the template snapshot linked clones are created from """
+        if not template_vm:
+            template_vm = self.get_vm(isTemplate=True)
+        if not template_vm:
+            return None
+        return self.find_snapshot(self.base_snapshot_name, template_vm)
+
+    def create_base_snapshot(self):
+        """ Snapshot the role template once, linked clones are cut from it """
+        template_vm = self.get_vm(isTemplate=True)
+        log.subtask("create base snapshot: {0}".format(self.template_name))
+        if self.get_base_snapshot(template_vm):
+            log.info("snapshot already exists")
+            return
+
+        # templates cannot be snapshotted
+        is_template = template_vm.config.template
+        try:
+            if is_template:
+                template_vm.MarkAsVirtualMachine(pool=self.target_pool,
+                                                 host=self.target_host)
+            log.info("snapshotting...")
+            task = template_vm.CreateSnapshot_Task(
+                name=self.base_snapshot_name,
+                description="Base of the caasp-vmware linked clones",
+                memory=False, quiesce=False)
+            wait_for_task(task, self.service_instance)
+            if is_template:
+                template_vm.MarkAsTemplate()
+            log.info("snapshot succeeded")
+        except Exception as e:
+            quit("snapshot failed: {0}".format(e))
+
+    def _clone_spec(self, template_vm):
+        """ CloneSpec of a full clone or a linked clone of template_vm """
+        relocate_spec = vim.vm.RelocateSpec(
+            datastore=self.target_datastore,
+            pool=self.target_pool,
+            host=self.target_host)
+        vm_clone_spec = vim.vm.CloneSpec(
+            location=relocate_spec,
+            powerOn=False,
+            template=False)
+        annotation = []
+
+        if self.linked_clone:
+            snapshot = self.get_base_snapshot(template_vm)
+            if not snapshot:
+                raise Exception("base snapshot not found on template: "
+                                "{0}".format(self.template_name))
+            relocate_spec.diskMoveType = "createNewChildDiskBacking"
+            vm_clone_spec.snapshot = snapshot
+            # used by destroy to find the clones depending on a template
+            annotation.append("{0}{1}".format(self.linked_clone_annotation,
+                                              self.template_name))
+
+        config = {}
+        if self.template_cache:
+            # the reference count of the shared template
+            annotation.append("{0}{1}".format(
+                TemplateCache.annotation_prefix, self.template_name))
+            # its CDROM is the cloud-init iso of the stack which created it
+            device_change = self._cloud_init_cdrom_change(template_vm)
+            if device_change:
+                config["deviceChange"] = device_change
+
+        if self.annotation:
+            annotation.append(self.annotation)
+        if annotation:
+            config["annotation"] = "\n".join(annotation)
+        if config:
+            vm_clone_spec.config = vim.vm.ConfigSpec(**config)
+
+        return vm_clone_spec
+
+    def _cloud_init_cdrom_change(self, vm_obj):
+        """
+        Device changes attaching the cloud-init iso of this VM to the
+        CDROM of vm_obj, if the cloud-init data is passed as an iso
+        """
+        if self.media_type == "iso" or self.guestinfo:
+            return []
+
+        for device in vm_obj.config.hardware.device:
+            if isinstance(device, vim.vm.device.VirtualCdrom):
+                device.backing = vim.vm.device.VirtualCdrom.IsoBackingInfo(
+                    datastore=self.datastore,
+                    fileName=self.cloud_init_path)
+                return [vim.vm.device.VirtualDeviceSpec(
+                    device=device,
+                    operation=vim.vm.device.VirtualDeviceSpec.Operation.edit)]
+        return []
+
+    def claim(self):
+        """
+        Turn the reserved warm pool VM into this VM: set its name, CPU and
+        RAM, attach the role cloud-init iso and move it out of the pool
+        """
+        log.subtask("claim warm pool virtual machine: {0}".format(self.name))
+        pool_vm = self.pool_vm
+
+        # drop the pool annotation, keep the linked clone one
+        annotation = "\n".join(
+            line for line in (pool_vm.config.annotation or "").splitlines()
+            if not line.startswith(WarmPool.annotation_prefix))
+
+        vm_spec = vim.vm.ConfigSpec(
+            name=self.name, memoryMB=self.ram, numCPUs=self.cpu,
+            annotation=annotation,
+            deviceChange=self._cloud_init_cdrom_change(pool_vm))
+
+        try:
+            log.info("reconfiguring...")
+            wait_for_task(pool_vm.ReconfigVM_Task(spec=vm_spec),
+                          self.service_instance)
+            wait_for_task(self.vm_folder.MoveIntoFolder_Task([pool_vm]),
+                          self.service_instance)
+            self.vm_obj = self.get_vm()
+            log.info("claiming succeeded")
+        except Exception as e:
+            quit("claiming failed: {0}".format(e))
+
     def clone_vm(self):
         """ Clone VM from a previously created template,
         template_name == vm_name without last 3 digits """
@@ -904,21 +2334,15 @@ class VMachine(object):
         if template_vm:
             self._check_media()
 
-            vm_clone_spec = vim.vm.CloneSpec(
-                location=vim.vm.RelocateSpec(
-                    datastore=self.datastore,
-                    pool=self.resource_pool),
-                powerOn=False,
-                template=False)
-
-            task = template_vm.CloneVM_Task(
-                folder=self.datacenter.vmFolder,
-                name=self.name,
-                spec=vm_clone_spec)
-
             try:
+                vm_clone_spec = self._clone_spec(template_vm)
+                task = template_vm.CloneVM_Task(
+                    folder=self.vm_folder,
+                    name=self.name,
+                    spec=vm_clone_spec)
+
                 log.info("cloning...")
-                WaitForTask(task)
+                wait_for_task(task)
                 self.vm_obj = self.get_vm(isTemplate=False)
                 log.info("cloning succeeded")
             except Exception as e:
@@ -940,21 +2364,25 @@ class VMachine(object):
 
         self._check_media()
 
-        vm_clone_spec = vim.vm.CloneSpec(
-            location=vim.vm.RelocateSpec(
-                datastore=self.datastore,
-                pool=self.resource_pool),
-            powerOn=False,
-            template=False)
+        vm_clone_spec = self._clone_spec(template_vm)
 
         log.info("cloning...")
         task = template_vm.CloneVM_Task(
-            folder=self.datacenter.vmFolder,
+            folder=self.vm_folder,
             name=self.name,
             spec=vm_clone_spec)
 
         return task
 
+    def push_cloud_init(self, admin_ip=None):
+        """ Provide the cloud-init data, as iso or through guestinfo """
+        if self.guestinfo:
+            CloudInit.set_guestinfo(
+                self, admin_ip, compress=self.cloud_init_mode.endswith("gzip"))
+        else:
+            CloudInit.create_iso(self.role_config, admin_ip)
+            CloudInit.push_iso(self.vsphere, self.role_config)
+
     def deploy(self, admin_ip=None):
         """ Wrapper to deploy a VM (slow) """
 
@@ -963,8 +2391,7 @@ class VMachine(object):
 
         self.create_vm()
         self._copy_vmdk()
-        CloudInit.create_iso(self.role_config, admin_ip)
-        CloudInit.push_iso(self.vsphere, self.role_config)
+        self.push_cloud_init(admin_ip)
         self.power_on()
 
         log.info("deployment succeeded")
@@ -979,79 +2406,1125 @@ class VMachine(object):
             self.create_vm_template()
 
         self.clone_vm()
-        CloudInit.create_iso(self.role_config, admin_ip)
-        CloudInit.push_iso(self.vsphere, self.role_config)
+        self.push_cloud_init(admin_ip)
         self.power_on()
 
         log.info("deployment succeeded")
 
 
+class TemplateCache(object):
+    """ Role templates shared by every stack, evicted least recently used """
+    prefix = "caasp-template-"
+    annotation_prefix = "caasp-template: "
+    last_used_field = "caasp-template-last-used"
+
+    def __init__(self, vsphere, parameters):
+        self.vsphere = vsphere
+        self.folder_name = parameters["template_cache_folder"]
+        self.size = int(parameters["template_cache_size"])
+
+    @classmethod
+    def media_stamp(cls, vsphere, media):
+        """ Size and modification time of the media, None if missing """
+        info = Datastore.file_info(vsphere, media)
+        return info and [info.fileSize, info.modification.isoformat()]
+
+    @classmethod
+    def template_name(cls, vsphere, parameters, cpu, ram):
+        """ Name of the cached template for this spec """
+        key = [parameters["vc_datastore"],
+               parameters["media"],
+               cls.media_stamp(vsphere, parameters["media"]),
+               parameters["media_type"],
+               parameters["guest_id"],
+               int(cpu), int(ram),
+               VMachine.hardware_version,
+               parameters["vc_network"],
+               parameters["cloud_init_mode"].startswith("guestinfo")]
+        digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return "{0}{1}".format(cls.prefix, digest[:16])
+
+    def prepare(self):
+        """ Create the VM folder and datastore directory of the cache """
+        Datastore.create_dir(self.vsphere, self.folder_name)
+        self.vsphere.folder(self.folder_name, create=True)
+
+    def _field_key(self, create=False):
+        """ Key of the last used custom field """
+        manager = self.vsphere.content.customFieldsManager
+        for field in manager.field or []:
+            if field.name == self.last_used_field:
+                return field.key
+        if not create:
+            return None
+        try:
+            return manager.AddCustomFieldDef(
+                name=self.last_used_field, moType=vim.VirtualMachine).key
+        except vim.fault.DuplicateName:
+            return self._field_key()
+
+    def touch(self, template_vm):
+        """ Record that template_vm has just been used """
+        try:
+            self.vsphere.content.customFieldsManager.SetField(
+                entity=template_vm, key=self._field_key(create=True),
+                value=str(int(time.time())))
+        except vmodl.MethodFault as e:
+            log.warning("unable to record the use of {0}: {1}".format(
+                template_vm.name, e.msg))
+
+    def evict(self):
+        """ Remove the least recently used templates without any clone """
+        log.task("evict unused cached templates")
+        folder = self.vsphere.folder(self.folder_name)
+        if not folder:
+            log.info("template cache is empty")
+            return
+
+        field_key = self._field_key()
+        users = annotated_vms(self.vsphere, self.annotation_prefix)
+        unused = []
+        for item in retrieve_properties(
+                self.vsphere,
+                {vim.VirtualMachine: ["name", "config.template",
+                                      "customValue"]},
+                container=folder):
+            if not item.get("config.template") or \
+                    not item["name"].startswith(self.prefix) or \
+                    users.get(item["name"]):
+                continue
+            last_used = 0
+            for value in item.get("customValue") or []:
+                if value.key == field_key:
+                    last_used = int(value.value)
+            unused.append((last_used, item))
+
+        unused.sort(key=lambda u: u[0], reverse=True)
+        log.info("{0} unused cached templates, keeping {1}".format(
+            len(unused), self.size))
+        for last_used, item in unused[self.size:]:
+            log.info("evicting {0}, last used: {1}".format(
+                item["name"], time.ctime(last_used) if last_used
+                else "unknown"))
+            # unregister only, the template disk is the installation media
+            try:
+                item["obj"].UnregisterVM()
+            except vmodl.MethodFault as e:
+                log.warning("unable to evict {0}: {1}".format(
+                    item["name"], e.msg))
+                continue
+            Datastore.delete_path(self.vsphere, "{0}/{1}".format(
+                self.folder_name, item["name"]))
+
+
+class WarmPool(object):
+    """ Pool of powered-off, pre-cloned master and worker VMs """
+    roles = ["master", "worker"]
+    annotation_prefix = "caasp-pool: "
+
+    def __init__(self, vsphere, conf):
+        self.vsphere = vsphere
+        self.conf = conf
+        self.parameters = conf["parameters"]
+        self.size = int(self.parameters["pool_size"])
+        self.folder_name = self.parameters["pool_folder"]
+        self.media = self.parameters["media"]
+        self.media_hash = hashlib.md5(
+            self.media.encode("utf-8")).hexdigest()[:8]
+
+    def annotation(self, role):
+        return "{0}media={1} role={2}".format(self.annotation_prefix,
+                                              self.media, role)
+
+    @property
+    def folder(self):
+        """ vim.Folder of the pool, created if needed """
+        return self.vsphere.folder(self.folder_name, create=True)
+
+    def _vmachine(self, role, index):
+        """ VMachine of a pool entry, its template is the pool template """
+        parameters = dict(self.parameters)
+        parameters["vm_deploy_dir"] = self.folder_name
+
+        role_config = dict(self.conf[role]["config"])
+        # replaced by the stack iso when the VM is claimed
+        role_config["ds_cloud_iso_path"] = "{0}/cidata.iso".format(
+            self.folder_name)
+
+        vm_config = {
+            "name": self._vmachine_name(role, index),
+            "role": role,
+            "ram": int(self.parameters["{0}_ram".format(role)]),
+            "cpu": int(self.parameters["{0}_cpu".format(role)]),
+        }
+
+        vm = VMachine(self.vsphere, parameters, role_config, vm_config)
+        vm.folder = self.folder
+        vm.annotation = self.annotation(role)
+        vm.vm_obj = vm.get_vm()
+        return vm
+
+    def entries(self):
+        """ Return the pool VMs of every media """
+        return retrieve_properties(
+            self.vsphere,
+            {vim.VirtualMachine: ["name", "config.annotation",
+                                  "config.template", "runtime.powerState"]},
+            container=self.folder)
+
+    def available(self, role, entries=None):
+        """ Powered-off pool VMs of the current media for role """
+        if entries is None:
+            entries = self.entries()
+        annotation = self.annotation(role)
+        return sorted([e for e in entries
+                       if annotation in (e.get("config.annotation") or "")
+                       .splitlines()
+                       and not e.get("config.template")
+                       and e["runtime.powerState"] == "poweredOff"],
+                      key=lambda e: e["name"])
+
+    def claim(self, vms):
+        """
+        Assign pool VMs to the VMachines in vms
+        Return the list of VMachines which got a pool VM
+        """
+        claimed = []
+        entries = self.entries()
+        entries = {r: self.available(r, entries) for r in self.roles}
+        for vm in vms:
+            while entries.get(vm.role):
+                entry = entries[vm.role].pop(0)
+                pool_vm = entry["obj"]
+                # renaming reserves the entry, another deploy may have
+                # renamed it in the meantime
+                try:
+                    wait_for_task(pool_vm.Rename_Task(vm.name))
+                except vim.fault.DuplicateName:
+                    break
+                except Exception as e:
+                    log.warning("unable to reserve {0}: {1}".format(
+                        entry["name"], e))
+                    continue
+                if pool_vm.name != vm.name:
+                    continue
+                log.info("reserved pool VM {0} for {1}".format(
+                    entry["name"], vm.name))
+                vm.pool_vm = pool_vm
+                claimed.append(vm)
+                break
+
+        log.info("{0} of {1} virtual machines taken from the warm "
+                 "pool".format(len(claimed), len(vms)))
+        return claimed
+
+    def replenish(self):
+        """ Clone the missing pool VMs of the current media """
+        log.task("replenish warm pool: {0}".format(self.media))
+        Datastore.create_dir(self.vsphere, self.folder_name)
+        template_cache = None
+        if self.parameters["template_cache"]:
+            template_cache = TemplateCache(self.vsphere, self.parameters)
+            template_cache.prepare()
+        vms = []
+        entries = self.entries()
+        names = set(e["name"] for e in entries)
+        for role in self.roles:
+            available = len(self.available(role, entries))
+            log.info("{0} {1} VMs available, pool size is {2}".format(
+                available, role, self.size))
+
+            template = self._vmachine(role, 0)
+            template.create_vm_template()
+            if template.linked_clone:
+                template.create_base_snapshot()
+            if template_cache:
+                template_cache.touch(template.get_vm(isTemplate=True))
+
+            index = 0
+            for _ in range(self.size - available):
+                while self._vmachine_name(role, index) in names:
+                    index += 1
+                vms.append(self._vmachine(role, index))
+                index += 1
+
+        if vms:
+            CloneScheduler(self.vsphere, self.parameters).run(vms)
+        log.info("warm pool replenished")
+
+    def _vmachine_name(self, role, index):
+        return "{0}-{1}-{2}{3:03d}".format(self.folder_name, self.media_hash,
+                                           role, index)
+
+
 def clean_up(location, path, vsphere=None):
     """
-    Remove local directory in /tmp/stack_hash
-    or remote directory in deployment dir path
+    Remove remote directory in deployment dir path
     """
 
     log.task("clean-up {0} files".format(location))
 
-    if location == "local":
-        p = os.path.dirname(path)
-        if os.path.exists(p):
-            shutil.rmtree(p)
-
     if location == "remote":
         Datastore.delete_path(vsphere, path)
 
     log.info("cleaning-up succeeded")
 
 
+class TaskWaiter(object):
+    """ Asyncio waiter turning vim Tasks into awaitables """
+    properties = ["info.state", "info.progress", "info.error", "info.result",
+                  "info.queueTime", "info.startTime", "info.completeTime",
+                  "info.descriptionId", "info.entityName"]
+    max_wait = 10
+
+    def __init__(self, vsphere):
+        self.vsphere = vsphere
+        # task id -> {property path: value}
+        self.infos = {}
+        self._futures = {}
+        self._collector = None
+        self._view = None
+        self._runner = None
+        self._closing = False
+
+    async def __aenter__(self):
+        await self._call(self._setup)
+        self._runner = asyncio.ensure_future(self._run())
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    @staticmethod
+    async def _call(func, *args, **kwargs):
+        """ Run a blocking vSphere call in the executor """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, lambda: func(*args, **kwargs))
+
+    def _setup(self):
+        pc = vmodl.query.PropertyCollector
+        content = self.vsphere.content
+        self._collector = content.propertyCollector.CreatePropertyCollector()
+        self._view = content.viewManager.CreateListView(obj=[])
+        traversal = pc.TraversalSpec(name="traverseList", path="view",
+                                     skip=False, type=vim.view.ListView)
+        filter_spec = pc.FilterSpec(
+            objectSet=[pc.ObjectSpec(obj=self._view, skip=True,
+                                     selectSet=[traversal])],
+            propSet=[pc.PropertySpec(type=vim.Task, pathSet=self.properties,
+                                     all=False)])
+        self._collector.CreateFilter(filter_spec, partialUpdates=False)
+
+    def _teardown(self):
+        self._view.DestroyView()
+        self._collector.DestroyPropertyCollector()
+
+    async def close(self):
+        self._closing = True
+        if self._runner:
+            if not self._runner.done():
+                await self._call(self._collector.CancelWaitForUpdates)
+            try:
+                await self._runner
+            except Exception:
+                pass
+        await self._call(self._teardown)
+
+    async def wait(self, task):
+        """ Wait for task to complete, return its result or raise its fault """
+        if self._runner and self._runner.done():
+            # nothing would ever resolve the future
+            if not self._runner.cancelled() and self._runner.exception():
+                raise self._runner.exception()
+            raise RuntimeError("task waiter is closed")
+        future = asyncio.get_event_loop().create_future()
+        self._futures[task._moId] = future
+        self.infos.setdefault(task._moId, {})
+        await self._call(self._view.ModifyListView, add=[task])
+        return await future
+
+    def info(self, task):
+        """ Properties of task known so far """
+        return self.infos.get(task._moId, {})
+
+    def progress(self, task):
+        """ Completion percentage of a running task """
+        return self.info(task).get("info.progress")
+
+    def _resolve(self, task_id):
+        """ Resolve the future of a completed task, return True if done """
+        info = self.infos[task_id]
+        future = self._futures.get(task_id)
+        if info.get("info.state") not in ("success", "error"):
+            return False
+        if future and not future.done():
+            profiler.task(info.get("info.descriptionId"),
+                          info.get("info.entityName"),
+                          info.get("info.queueTime"),
+                          info.get("info.startTime"),
+                          info.get("info.completeTime"), info["info.state"])
+            if info["info.state"] == "success":
+                future.set_result(info.get("info.result"))
+            else:
+                future.set_exception(info.get("info.error") or
+                                     Exception("task failed"))
+        self._futures.pop(task_id, None)
+        return True
+
+    async def _run(self):
+        options = vmodl.query.PropertyCollector.WaitOptions(
+            maxWaitSeconds=self.max_wait)
+        version = ""
+        try:
+            while not self._closing:
+                try:
+                    update = await self._call(
+                        self._collector.WaitForUpdatesEx, version, options)
+                except vmodl.fault.RequestCanceled:
+                    break
+                if update is None:
+                    continue
+                version = update.version
+
+                done = []
+                for filter_update in update.filterSet:
+                    for object_update in filter_update.objectSet:
+                        if object_update.kind == "leave":
+                            continue
+                        task_id = object_update.obj._moId
+                        info = self.infos.setdefault(task_id, {})
+                        for change in object_update.changeSet:
+                            info[change.name] = change.val
+                        if self._resolve(task_id):
+                            done.append(object_update.obj)
+
+                if done:
+                    await self._call(self._view.ModifyListView, remove=done)
+        except Exception as e:
+            # do not leave anybody waiting forever
+            for future in self._futures.values():
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+
+class PowerOnBatcher(object):
+    """ Power-on VMs in batches with Datacenter.PowerOnMultiVM_Task """
+    linger = 2
+
+    def __init__(self, vsphere, waiter, size):
+        self.vsphere = vsphere
+        self.waiter = waiter
+        self.size = max(1, int(size))
+        self._queue = []
+        self._timer = None
+        # batches in flight
+        self._batches = set()
+
+    async def power_on(self, vm):
+        """ Power-on vm, return once it is powered-on """
+        if self.size == 1:
+            return await vm.power_on_aio(self.waiter)
+
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._queue.append((vm, future))
+        if len(self._queue) >= self.size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.linger, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queue = self._queue, []
+        if batch:
+            task = asyncio.ensure_future(self._power_on(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._done)
+
+    def _done(self, task):
+        self._batches.discard(task)
+        if not task.cancelled() and task.exception():
+            log.error("batch power-on failed: {0}".format(task.exception()))
+
+    async def _power_on(self, batch):
+        log.info("powering-on {0}...".format(
+            ", ".join(vm.name for vm, _ in batch)))
+        pending = {vm.vm_obj._moId: (vm, future) for vm, future in batch}
+        attempted = []
+        try:
+            task = await TaskWaiter._call(
+                lambda: self.vsphere.datacenter.PowerOnMultiVM_Task(
+                    vm=[vm.vm_obj for vm, _ in batch]))
+            result = await self.waiter.wait(task)
+            for info in result.attempted or []:
+                if info.task and info.vm._moId in pending:
+                    attempted.append(pending.pop(info.vm._moId) + (info.task,))
+            for info in result.notAttempted or []:
+                log.warning("{0} not powered-on by the batch: {1}".format(
+                    info.vm.name,
+                    getattr(info.fault, "msg", None) or info.fault))
+        except vmodl.MethodFault as e:
+            log.warning("batch power-on failed: {0}".format(e.msg or e))
+        except Exception as e:
+            # do not leave the nodes of the batch waiting forever
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+        await asyncio.gather(
+            *([self._wait(vm, future, task) for vm, future, task in attempted] +
+              [self._single(vm, future) for vm, future in pending.values()]))
+
+    async def _wait(self, vm, future, task):
+        """ Wait for the power-on task started by the batch """
+        try:
+            await self.waiter.wait(task)
+            log.info("powering-on succeeded: {0}".format(vm.name))
+            future.set_result(None)
+        except vmodl.MethodFault as e:
+            log.warning("batch power-on of {0} failed: {1}".format(
+                vm.name, e.msg or e))
+            await self._single(vm, future)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+    async def _single(self, vm, future):
+        """ Fall back to an individual power-on """
+        try:
+            result = await vm.power_on_aio(self.waiter)
+            if not future.done():
+                future.set_result(result)
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+
+def run_async(coro):
+    """ Run a coroutine to completion from synchronous code """
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+async def wait_tasks(vsphere, tasks):
+    """ Wait for all tasks, return their results """
+    async with TaskWaiter(vsphere) as waiter:
+        return await asyncio.gather(*[waiter.wait(t) for t in tasks])
+
+
 def wait(tasks):
     tasks = list(tasks)
     if tasks:
         log.info("waiting on %d tasks..." % len(tasks))
-        WaitForTasks(tasks, wait._service_instance)
+        run_async(wait_tasks(wait._vsphere, tasks))
     log.info("done")
 
 
+def transient_faults():
+    """ vim faults after which a clone is worth retrying """
+    return (
+        vim.fault.TaskInProgress,
+        vim.fault.ConcurrentAccess,
+        vim.fault.FileLocked,
+        vim.fault.ResourceInUse,
+        vim.fault.HostConnectFault,
+        vim.fault.InvalidHostState,
+        vim.fault.CannotAccessFile,
+        vmodl.fault.HostCommunication,
+    )
+
+
+def jittered_backoff(attempt, base=5, maximum=120):
+    """ Exponential backoff delay before retrying after attempt """
+    delay = min(maximum, base * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1.5)
+
+
+class Placement(object):
+    """ Spread the VMs of a stack over several datastores and hosts """
+    # score penalty of a running task or of a VM already placed
+    load_weight = 0.05
+    # score penalty per unit of provisioned ratio above 1
+    overcommit_weight = 0.5
+
+    def __init__(self, vsphere, parameters):
+        self.vsphere = vsphere
+        self.datastore_names = parameters["vc_datastores"]
+        self.host_names = parameters["vc_hosts"]
+        self.datastores = None
+        self.hosts = None
+        self._disk_sizes = {}
+
+    @property
+    def enabled(self):
+        return bool(self.datastore_names or self.host_names)
+
+    def _running_tasks(self, items):
+        """ Number of queued or running tasks per managed object id """
+        tasks = [t for item in items for t in item.get("recentTask", [])]
+        running = set()
+        if tasks:
+            running = set(
+                t["obj"]._moId for t in retrieve_properties(
+                    self.vsphere, {vim.Task: ["info.state"]}, objects=tasks)
+                if t.get("info.state") in ("queued", "running"))
+        return {item["obj"]._moId: len([t for t in item.get("recentTask", [])
+                                        if t._moId in running])
+                for item in items}
+
+    def _load_datastores(self):
+        objs = []
+        for name in self.datastore_names:
+            datastore = self.vsphere.inventory.lookup(
+                "Datastore", name,
+                scope=lambda: self.vsphere.datacenter.datastore)
+            if not datastore:
+                quit("datastore not found: {0}".format(name))
+            objs.append(datastore)
+        if not objs:
+            objs = [self.vsphere.datastore]
+
+        items = retrieve_properties(self.vsphere, {vim.Datastore: [
+            "name", "recentTask", "summary.accessible",
+            "summary.maintenanceMode", "summary.capacity",
+            "summary.freeSpace", "summary.uncommitted"]}, objects=objs)
+        tasks = self._running_tasks(items)
+
+        self.datastores = []
+        for item in items:
+            if not item.get("summary.accessible") or \
+                    item.get("summary.maintenanceMode",
+                             "normal") != "normal":
+                log.warning("skipping datastore {0}: not accessible or in "
+                            "maintenance mode".format(item["name"]))
+                continue
+            self.datastores.append({
+                "obj": item["obj"], "name": item["name"],
+                "capacity": item["summary.capacity"],
+                "free": item["summary.freeSpace"],
+                "uncommitted": item.get("summary.uncommitted", 0),
+                "tasks": tasks[item["obj"]._moId], "vms": 0})
+        if not self.datastores:
+            quit("no usable datastore to place the VMs on")
+
+    def _load_hosts(self):
+        if not self.host_names:
+            # DRS or vc_resource_pool decides, the datastores are assumed
+            # to be reachable from it
+            self.hosts = [{"obj": None,
+                           "name": self.vsphere.resource_pool_name,
+                           "pool": self.vsphere.resource_pool, "host": None,
+                           "datastores": None, "memory": 1, "used": 0,
+                           "tasks": 0, "vms": 0}]
+            return
+
+        objs = []
+        for name in self.host_names:
+            host = self.vsphere.inventory.lookup("HostSystem", name) or \
+                self.vsphere.inventory.lookup("ComputeResource", name)
+            if not host:
+                quit("host or cluster not found: {0}".format(name))
+            objs.append(host)
+
+        common = ["name", "recentTask", "datastore"]
+        items = retrieve_properties(self.vsphere, {
+            vim.HostSystem: common + [
+                "parent", "runtime.connectionState",
+                "runtime.inMaintenanceMode", "summary.hardware.memorySize",
+                "summary.quickStats.overallMemoryUsage"],
+            vim.ComputeResource: common + ["resourcePool"]}, objects=objs)
+        tasks = self._running_tasks(items)
+
+        # root resource pool of the hosts, memory usage of the clusters
+        pools = {}
+        parents = [i["parent"] for i in items if "parent" in i]
+        if parents:
+            pools = {i["obj"]._moId: i["resourcePool"]
+                     for i in retrieve_properties(
+                         self.vsphere, {vim.ComputeResource: ["resourcePool"]},
+                         objects=parents)}
+        usage = {}
+        cluster_pools = [i["resourcePool"] for i in items
+                         if "resourcePool" in i]
+        if cluster_pools:
+            usage = {i["obj"]._moId: i for i in retrieve_properties(
+                self.vsphere, {vim.ResourcePool: [
+                    "runtime.memory.maxUsage",
+                    "runtime.memory.overallUsage"]},
+                objects=cluster_pools)}
+
+        # vc_resource_pool is kept when it belongs to the candidate
+        owner = self.vsphere.resource_pool.owner._moId
+
+        self.hosts = []
+        for item in items:
+            if isinstance(item["obj"], vim.HostSystem):
+                if item.get("runtime.connectionState") != "connected" or \
+                        item.get("runtime.inMaintenanceMode"):
+                    log.warning("skipping host {0}: not connected or in "
+                                "maintenance mode".format(item["name"]))
+                    continue
+                compute = item["parent"]
+                pool = pools[compute._moId]
+                host = item["obj"]
+                memory = item.get("summary.hardware.memorySize", 0)
+                used = item.get("summary.quickStats.overallMemoryUsage",
+                                0) * 1024 * 1024
+            else:
+                compute = item["obj"]
+                pool = item["resourcePool"]
+                host = None
+                memory = usage[pool._moId].get("runtime.memory.maxUsage", 0)
+                used = usage[pool._moId].get(
+                    "runtime.memory.overallUsage", 0)
+            if compute._moId == owner:
+                pool = self.vsphere.resource_pool
+
+            self.hosts.append({
+                "obj": item["obj"], "name": item["name"], "pool": pool,
+                "host": host,
+                "datastores": set(d._moId for d in item["datastore"]),
+                "memory": max(memory, 1), "used": used,
+                "tasks": tasks[item["obj"]._moId], "vms": 0})
+        if not self.hosts:
+            quit("no usable host to place the VMs on")
+
+    def _disk_size(self, vm):
+        """ Bytes a clone of the template of vm takes on its datastore """
+        if vm.linked_clone:
+            # a child disk, growing with the guest writes only
+            return 0
+        if vm.template_name not in self._disk_sizes:
+            template = vm.get_vm(isTemplate=True)
+            devices = template.config.hardware.device if template else []
+            self._disk_sizes[vm.template_name] = sum(
+                d.capacityInBytes for d in devices
+                if isinstance(d, vim.vm.device.VirtualDisk))
+        return self._disk_sizes[vm.template_name]
+
+    def _host_score(self, host, ram):
+        free = host["memory"] - host["used"] - ram
+        return free / host["memory"] - \
+            self.load_weight * (host["tasks"] + host["vms"])
+
+    def _datastore_score(self, datastore, size):
+        capacity = max(datastore["capacity"], 1)
+        free = datastore["free"] - size
+        provisioned = (capacity - free + datastore["uncommitted"]) / capacity
+        return free / capacity - \
+            self.overcommit_weight * max(0, provisioned - 1) - \
+            self.load_weight * (datastore["tasks"] + datastore["vms"])
+
+    def assign(self, vms, templates=False):
+        """
+        Choose the datastore, pool and host of the VMachines in vms,
+        templates are only placed on a host, their disk is the media
+        """
+        if not self.enabled:
+            return
+        if self.datastores is None:
+            self._load_datastores()
+            self._load_hosts()
+
+        media_datastore = self.vsphere.datastore._moId
+        for vm in vms:
+            ram = int(vm.ram) * 1024 * 1024
+            size = 0 if templates else self._disk_size(vm)
+
+            candidates = []
+            for host in self.hosts:
+                reachable = host["datastores"]
+                if reachable is not None and \
+                        media_datastore not in reachable:
+                    continue
+                datastores = [
+                    d for d in self.datastores
+                    if (reachable is None or d["obj"]._moId in reachable) and
+                    d["free"] >= size]
+                if templates or datastores:
+                    candidates.append((host, datastores))
+            if not candidates:
+                quit("no host and datastore can hold {0}".format(vm.name))
+
+            host, datastores = max(
+                candidates, key=lambda c: self._host_score(c[0], ram))
+            host["used"] += ram
+            host["vms"] += 1
+            vm.placement = {"pool": host["pool"], "host": host["host"]}
+            target = host["name"]
+
+            if not templates:
+                datastore = max(datastores, key=lambda d:
+                                self._datastore_score(d, size))
+                datastore["free"] -= size
+                datastore["vms"] += 1
+                vm.placement["datastore"] = datastore["obj"]
+                target = "{0}/{1}".format(target, datastore["name"])
+            log.info("placing {0} on {1}".format(vm.name, target))
+
+    def report(self):
+        """ Log the projected usage of the candidates """
+        if not self.enabled or self.datastores is None:
+            return
+        table = PrettyTable()
+        table.field_names = ["Name", "VMs", "Tasks", "Free (%)"]
+        table.float_format = ".1"
+        for d in self.datastores:
+            table.add_row([d["name"], d["vms"], d["tasks"],
+                           100.0 * d["free"] / max(d["capacity"], 1)])
+        for h in self.hosts:
+            if h["obj"] is None:
+                continue
+            table.add_row([h["name"], h["vms"], h["tasks"],
+                           100.0 * (h["memory"] - h["used"]) / h["memory"]])
+        log.info("placement:\n{0}".format(table.get_string()))
+
+
+class CloneScheduler(object):
+    """ Clone VMs with bounded concurrency, retrying transient faults """
+    backoff_base = 5
+    backoff_max = 120
+
+    def __init__(self, vsphere, parameters):
+        self.vsphere = vsphere
+        self.parallel = max(1, int(parameters["parallel"]))
+        self.per_datastore = parameters["max_clones_per_datastore"]
+        self.per_host = parameters["max_clones_per_host"]
+        self.retries = int(parameters["clone_retries"])
+        self._template_hosts = {}
+        self._semaphores = {}
+        self.jobs = []
+
+    def _template_host(self, vm):
+        """ ESXi host of the source template, used for throttling """
+        if vm.template_name not in self._template_hosts:
+            template = vm.get_vm(isTemplate=True)
+            host = template.runtime.host if template else None
+            self._template_hosts[vm.template_name] = \
+                host._moId if host else None
+        return self._template_hosts[vm.template_name]
+
+    def _semaphore(self, key, value):
+        if key not in self._semaphores:
+            self._semaphores[key] = asyncio.Semaphore(int(value))
+        return self._semaphores[key]
+
+    def _limits(self, job):
+        """ Semaphores to hold while cloning, always in the same order """
+        limits = []
+        if self.per_host and job["host"]:
+            limits.append(self._semaphore(("host", job["host"]),
+                                          self.per_host))
+        if self.per_datastore:
+            limits.append(self._semaphore(("datastore", job["datastore"]),
+                                          self.per_datastore))
+        limits.append(self._semaphore("parallel", self.parallel))
+        return limits
+
+    def _backoff(self, job):
+        return jittered_backoff(job["attempts"], self.backoff_base,
+                                self.backoff_max)
+
+    async def _attempt(self, waiter, job):
+        """ Run one clone attempt, return None or the task fault """
+        vm = job["vm"]
+        job["attempts"] += 1
+        job["submitted"] = time.time()
+        try:
+            # a failed attempt may leave a partial VM behind
+            if job["attempts"] > 1:
+                leftover = await TaskWaiter._call(vm.get_vm)
+                if leftover:
+                    log.info("removing leftover of failed clone: {0}".format(
+                        vm.name))
+                    await waiter.wait(
+                        await TaskWaiter._call(leftover.Destroy_Task))
+
+            task = await TaskWaiter._call(vm.async_clone_vm)
+            vm.vm_obj = await waiter.wait(task)
+        except vmodl.MethodFault as e:
+            return e
+
+        job["info"] = waiter.info(task)
+        job["elapsed"] = time.time() - job["submitted"]
+        log.info("cloning succeeded: {0}".format(vm.name))
+        return None
+
+    async def _clone(self, waiter, job):
+        """ Clone a VM, retrying transient faults, return True on success """
+        vm = job["vm"]
+        while True:
+            limits = self._limits(job)
+            for semaphore in limits:
+                await semaphore.acquire()
+            try:
+                error = await self._attempt(waiter, job)
+            except Exception as e:
+                log.error("clone of {0} failed: {1}".format(vm.name, e))
+                return False
+            finally:
+                for semaphore in limits:
+                    semaphore.release()
+
+            if error is None:
+                return True
+
+            if isinstance(error, transient_faults()) and \
+                    job["attempts"] <= self.retries:
+                delay = self._backoff(job)
+                log.warning("clone of {0} failed with a transient fault,"
+                            " retrying in {1:.0f}s: {2}".format(
+                                vm.name, delay, error.msg or error))
+                await asyncio.sleep(delay)
+            else:
+                log.error("clone of {0} failed: {1}".format(
+                    vm.name, getattr(error, "msg", None) or error))
+                return False
+
+    async def clone(self, waiter, vm):
+        """ Clone a VMachine, return True on success """
+        job = {"vm": vm, "attempts": 0, "submitted": None,
+               "datastore": vm.target_datastore._moId,
+               "host": await TaskWaiter._call(self._template_host, vm)}
+        self.jobs.append(job)
+        return await self._clone(waiter, job)
+
+    async def run_aio(self, waiter, vms):
+        """ Clone every VMachine in vms, return the ones which failed """
+        started = time.time()
+        results = await asyncio.gather(*[self.clone(waiter, vm) for vm in vms])
+        self.report(time.time() - started)
+
+        return [vm for vm, ok in zip(vms, results) if not ok]
+
+    def run(self, vms):
+        """ Clone every VMachine in vms, quit if any clone failed """
+        log.task("clone {0} virtual machines, {1} at a time".format(
+            len(vms), self.parallel))
+
+        async def run():
+            async with TaskWaiter(self.vsphere) as waiter:
+                return await self.run_aio(waiter, vms)
+
+        failed = run_async(run())
+        if failed:
+            quit("cloning failed: {0}".format(
+                ", ".join(vm.name for vm in failed)))
+
+    def report(self, total):
+        """ Log per-clone timing """
+        jobs = [j for j in self.jobs if "elapsed" in j]
+        table = PrettyTable()
+        table.field_names = ["Name", "Attempts", "Queued (s)", "Run (s)",
+                             "Total (s)"]
+        for job in jobs:
+            info = job["info"]
+            queued = (info["info.startTime"] -
+                      info["info.queueTime"]).total_seconds()
+            run = (info["info.completeTime"] -
+                   info["info.startTime"]).total_seconds()
+            table.add_row([job["vm"].name, job["attempts"],
+                           "{0:.1f}".format(queued), "{0:.1f}".format(run),
+                           "{0:.1f}".format(job["elapsed"])])
+        log.info("clone timing, {0:.1f}s in total:\n{1}".format(
+            total, table.get_string(sortby="Name")))
+
+
+def stack_demand(conf, clone_size):
+    """ vCPUs, RAM and datastore space needed by the VMs of conf """
+    vms = [vm_config for r in ["admin", "master", "worker"]
+           for vm_config in conf[r]["vmguests"]]
+    ram = sum(vm_config["ram"] for vm_config in vms) * 1024 * 1024
+    disk = ram
+    if not conf["parameters"]["linked_clones"]:
+        disk += len(vms) * clone_size
+    return {"cpu": sum(vm_config["cpu"] for vm_config in vms),
+            "ram": ram, "disk": disk}
+
+
+def stack_capacity(vsphere, parameters):
+    """ vCPUs, RAM and datastore space left for a stack """
+    inventory = vsphere.inventory
+    datastores = []
+    for name in parameters["vc_datastores"]:
+        datastore = inventory.lookup(
+            "Datastore", name, scope=lambda: vsphere.datacenter.datastore)
+        if not datastore:
+            quit("datastore not found: {0}".format(name))
+        datastores.append(datastore)
+    datastores = datastores or [vsphere.datastore]
+
+    computes = []
+    for name in parameters["vc_hosts"]:
+        compute = inventory.lookup("HostSystem", name) or \
+            inventory.lookup("ComputeResource", name)
+        if not compute:
+            quit("host or cluster not found: {0}".format(name))
+        computes.append(compute)
+    computes = computes or [vsphere.resource_pool]
+
+    usage = ["runtime.cpu.maxUsage", "runtime.cpu.overallUsage",
+             "runtime.memory.maxUsage", "runtime.memory.overallUsage"]
+    # the owner of a pool gives the MHz of a core, the root pool of a
+    # cluster its usage
+    items = retrieve_properties(vsphere, {
+        vim.Datastore: ["summary.freeSpace"],
+        vim.ResourcePool: usage + ["owner"],
+        vim.ComputeResource: ["resourcePool", "summary.totalCpu",
+                              "summary.numCpuCores"],
+        vim.HostSystem: ["summary.hardware.memorySize",
+                         "summary.hardware.cpuMhz",
+                         "summary.hardware.numCpuCores",
+                         "summary.quickStats.overallCpuUsage",
+                         "summary.quickStats.overallMemoryUsage"]},
+        objects=datastores + computes,
+        follow={vim.ResourcePool: ["owner"],
+                vim.ComputeResource: ["resourcePool"]})
+    props = {item["obj"]._moId: item for item in items}
+
+    cores = ram = 0
+    for compute in computes:
+        item = props[compute._moId]
+        if isinstance(compute, vim.HostSystem):
+            mhz = item["summary.hardware.cpuMhz"]
+            free_mhz = mhz * item["summary.hardware.numCpuCores"] - \
+                item.get("summary.quickStats.overallCpuUsage", 0)
+            free_ram = item["summary.hardware.memorySize"] - \
+                item.get("summary.quickStats.overallMemoryUsage",
+                         0) * 1024 * 1024
+        else:
+            if isinstance(compute, vim.ResourcePool):
+                pool, owner = item, props[item["owner"]._moId]
+            else:
+                pool, owner = props[item["resourcePool"]._moId], item
+            mhz = owner["summary.totalCpu"] / \
+                max(owner["summary.numCpuCores"], 1)
+            free_mhz = pool["runtime.cpu.maxUsage"] - \
+                pool["runtime.cpu.overallUsage"]
+            free_ram = pool["runtime.memory.maxUsage"] - \
+                pool["runtime.memory.overallUsage"]
+        cores += max(free_mhz, 0) / max(mhz, 1)
+        ram += max(free_ram, 0)
+
+    return {"cpu": cores * float(parameters["cpu_overcommit"]),
+            "ram": ram,
+            "disk": sum(props[d._moId]["summary.freeSpace"]
+                        for d in datastores)}
+
+
+def preflight(vsphere, conf):
+    """ Refuse, or shrink, a stack which does not fit the capacity left """
+    parameters = conf["parameters"]
+    if parameters["capacity_check"] == "off":
+        return
+
+    log.task("check capacity")
+    media = Datastore.file_info(vsphere, parameters["media"])
+    clone_size = media.fileSize if media else 0
+    available = stack_capacity(vsphere, parameters)
+
+    def exceeded():
+        demand = stack_demand(conf, clone_size)
+        return demand, [k for k in ["cpu", "ram", "disk"]
+                        if demand[k] > available[k]]
+
+    demand, over = exceeded()
+    workers = conf["worker"]["vmguests"]
+    if over and parameters["capacity_check"] == "shrink":
+        count = len(workers)
+        while over and workers:
+            workers.pop()
+            demand, over = exceeded()
+        if not over:
+            log.warning("not enough capacity for {0} workers, deploying "
+                        "{1}".format(count, len(workers)))
+
+    table = PrettyTable()
+    table.field_names = ["Resource", "Demand", "Available"]
+    table.float_format = ".1"
+    gib = 1024.0 ** 3
+    table.add_row(["vCPUs", demand["cpu"], available["cpu"]])
+    table.add_row(["RAM (GiB)", demand["ram"] / gib, available["ram"] / gib])
+    table.add_row(["Disk (GiB)", demand["disk"] / gib,
+                   available["disk"] / gib])
+    log.info("capacity:\n{0}".format(table.get_string()))
+
+    if over:
+        quit("not enough {0} for the stack".format(", ".join(over)))
+
+
 def deploy(vsphere, conf):
     """ Deploy VM and VM Templates """
+    preflight(vsphere, conf)
+    # recorded in the state file, the check may have dropped workers
+    conf["parameters"]["worker_count"] = len(conf["worker"]["vmguests"])
+
     admin_ip = None
     vm_deploy_dir = conf["parameters"]["vm_deploy_dir"]
     Datastore.create_dir(vsphere, vm_deploy_dir)
 
-    # Clean up local deployment files if previous deployment failed
-    clean_up(location="local", path=conf["admin"]["config"]["path"])
+    template_cache = None
+    if conf["parameters"]["template_cache"]:
+        template_cache = TemplateCache(vsphere, conf["parameters"])
+        template_cache.prepare()
 
-    log.task("create virtual machines role templates")
-    templates = []
-    for r in ["admin", "master", "worker"]:
-        for vm_config in conf[r]["vmguests"]:
-            vm = VMachine(vsphere, conf["parameters"],
-                          conf[r]["config"], vm_config)
-            assert not vm.get_vm(True)
-            templates.append(vm)
-            break
+    placement = Placement(vsphere, conf["parameters"])
 
-    wait(vm.create_vm_async(True) for vm in templates)
-    for vm in templates:
-        vm.vm_obj = vm.get_vm(True)
-        if vm.vm_obj:
-            log.info("Already created")
-            continue
+    log.task("create virtual machines role templates")
+    with profiler.phase("templates"):
+        templates = {}
+        for r in ["admin", "master", "worker"]:
+            for vm_config in conf[r]["vmguests"]:
+                vm = VMachine(vsphere, conf["parameters"],
+                              conf[r]["config"], vm_config)
+                # roles with the same spec share a cached template
+                templates.setdefault(vm.template_name, vm)
+                break
 
-        vm.vm_obj = vm.get_vm(True)
-        vm.vm_obj.MarkAsTemplate()
-        log.info("marking succeeded")
+        created = []
+        for vm in templates.values():
+            template_vm = vm.get_vm(True)
+            if template_vm and template_cache:
+                log.info("reusing cached template: {0}".format(
+                    vm.template_name))
+                continue
+            assert not template_vm
+            created.append(vm)
+
+        placement.assign(created, templates=True)
+        wait(vm.create_vm_async(True) for vm in created)
+        for vm in templates.values():
+            vm.vm_obj = vm.get_vm(True)
+            if vm.linked_clone:
+                vm.create_base_snapshot()
+
+            if vm in created:
+                log.info("marking as template...")
+                vm.vm_obj.MarkAsTemplate()
+                log.info("marking succeeded")
+            if template_cache:
+                template_cache.touch(vm.vm_obj)
 
     # Deploy Admin node
     log.task("deploy admin nodes")
     for vm_config in conf["admin"]["vmguests"]:
         vm = VMachine(vsphere, conf["parameters"],
                       conf["admin"]["config"], vm_config)
-        vm.deploy_from_template(create_template=False)
+        placement.assign([vm])
+        with profiler.phase("admin clone"):
+            vm.deploy_from_template(create_template=False)
 
         # Retrieve Admin IP address
-        admin_ip = get_vm_ip(vm, timeout=240, sleep=20)
+        with profiler.phase("admin IP wait"):
+            admin_ip = wait_for_ips(vsphere, [vm], timeout=240)[vm.name]
         log.info("Admin node IP address: {0}".format(admin_ip))
 
     # Deploy Master and Worker nodes in parallel
@@ -1063,70 +3536,450 @@ def deploy(vsphere, conf):
                           conf[r]["config"], vm_config)
             vms.append(vm)
 
-    # TODO: parallel deploys caused random failures. Also the deploy time
-    # for 5 nodes seem to be the same as sequential deploys.
-    if False:
-        wait(vm.async_clone_vm() for vm in vms)
-    else:
-        log.debug("Cloning VMs sequentially")
-        for vm in vms:
-            wait([vm.async_clone_vm()])
+    claimed = []
+    if int(conf["parameters"]["pool_size"]) > 0:
+        with profiler.phase("warm pool claim"):
+            claimed = WarmPool(vsphere, conf).claim(vms)
+
+    # warm pool VMs are already somewhere
+    placement.assign([vm for vm in vms if vm not in claimed])
+    placement.report()
 
-    for vm in vms:
-        vm.vm_obj = vm.get_vm(isTemplate=False)
-        CloudInit.create_iso(vm.role_config, admin_ip)
-        CloudInit.push_iso(vm.vsphere, vm.role_config)
-        vm.power_on()
+    with profiler.phase("nodes"):
+        deploy_nodes(vsphere, conf["parameters"], vms, claimed, admin_ip)
 
     if conf["parameters"]["media_type"] is not "iso":
-        generate_state_file(vsphere, conf)
+        with profiler.phase("node IP wait"):
+            generate_state_file(vsphere, conf)
+
+
+def deploy_nodes(vsphere, parameters, vms, claimed, admin_ip,
+                 iso_roles=None):
+    """
+    Clone, push the cloud-init data and power-on the nodes as a pipeline,
+    only the isos of iso_roles, all by default, are pushed
+    """
+    scheduler = CloneScheduler(vsphere, parameters)
+    power_on = None
+    log.task("deploy {0} nodes, cloning {1} at a time".format(
+        len(vms), scheduler.parallel))
+
+    async def push_role_isos(role_configs):
+        for role_config in role_configs:
+            await TaskWaiter._call(CloudInit.create_iso, role_config,
+                                   admin_ip)
+        await TaskWaiter._call(CloudInit.push_isos, vsphere, role_configs)
+
+    async def deploy_node(waiter, vm, iso):
+        if vm not in claimed and not await scheduler.clone(waiter, vm):
+            return False
+
+        try:
+            if vm in claimed:
+                # the cloud-init iso must exist before it is attached
+                if iso:
+                    await iso
+                await TaskWaiter._call(vm.claim)
+
+            if vm.guestinfo:
+                await TaskWaiter._call(
+                    CloudInit.set_guestinfo, vm, admin_ip,
+                    compress=vm.cloud_init_mode.endswith("gzip"))
+            elif iso:
+                await iso
+
+            await power_on.power_on(vm)
+        except Exception as e:
+            log.error("deploy of {0} failed: {1}".format(
+                vm.name, getattr(e, "msg", None) or e))
+            return False
+        log.info("node ready after {0:.1f}s: {1}".format(
+            time.time() - started, vm.name))
+        return True
+
+    async def run():
+        async with TaskWaiter(vsphere) as waiter:
+            nonlocal power_on
+            power_on = PowerOnBatcher(vsphere, waiter,
+                                      parameters["power_on_batch"])
+            # one iso per role, shared by its nodes
+            role_configs = {}
+            for vm in vms:
+                if not vm.guestinfo and (iso_roles is None or
+                                         vm.role in iso_roles):
+                    role_configs.setdefault(id(vm.role_config),
+                                            vm.role_config)
+            iso = None
+            if role_configs:
+                iso = asyncio.ensure_future(
+                    push_role_isos(list(role_configs.values())))
+            results = await asyncio.gather(
+                *[deploy_node(waiter, vm,
+                              iso if id(vm.role_config) in role_configs
+                              else None)
+                  for vm in vms])
+            if iso:
+                try:
+                    await iso
+                except Exception as e:
+                    log.error("cloud-init iso push failed: {0}".format(
+                        getattr(e, "msg", None) or e))
+            return results
+
+    started = time.time()
+    results = run_async(run())
+    if scheduler.jobs:
+        scheduler.report(time.time() - started)
+    failed = [vm.name for vm, ok in zip(vms, results) if not ok]
+    if failed:
+        quit("deploy failed: {0}".format(", ".join(failed)))
 
 
 def destroy(vsphere, conf):
     """ Destroy VM and VM Templates """
 
-    vms = []
+    log.task("destroy nodes")
+    nodes = {}
+    templates = {}
     for r in ["admin", "master", "worker"]:
-        log.task("destroy {0} nodes".format(r))
         for vm_config in conf[r]["vmguests"]:
             vm = VMachine(vsphere, conf["parameters"],
                           conf[r]["config"], vm_config)
-            vmh = vm.get_vm()
-            if vmh:
-                vms.append(vmh)
+            if vm.template_name not in templates:
+                templates[vm.template_name] = vm.get_vm(isTemplate=True)
+                nodes[vm.template_name] = []
+            vm.vm_obj = vm.get_vm()
+            if vm.vm_obj:
+                nodes[vm.template_name].append(vm)
+
+    # linked clones from other stacks keep the template alive, ours are
+    # about to be destroyed
+    names = [vm.name for vms in nodes.values() for vm in vms]
+    dependents = {
+        template_name: [name for name in vm_names if name not in names]
+        for template_name, vm_names in linked_clone_dependents(
+            vsphere).items()}
+
+    deploy_dir = "[{0}]{1}".format(vsphere.datastore.name,
+                                   conf["parameters"]["vm_deploy_dir"])
+
+    template_cache = None
+    if conf["parameters"]["template_cache"]:
+        template_cache = TemplateCache(vsphere, conf["parameters"])
+
+    async def unregister_template(template_name, node_jobs):
+        results = await asyncio.gather(*node_jobs)
+        template = templates[template_name]
+        if not template:
+            return True
+        if template_cache:
+            # shared by other stacks, evicted once unused
+            await TaskWaiter._call(template_cache.touch, template)
+            return True
+        if not all(results):
+            log.error("keeping template {0}, some of its VMs were not "
+                      "destroyed".format(template_name))
+            return False
+        if dependents.get(template_name):
+            # templates are only unregistered, never destroyed, so
+            # neither the media disk nor the base snapshot are touched
+            log.warning("keeping template {0}, still used by linked "
+                        "clones: {1}".format(
+                            template_name,
+                            ", ".join(dependents[template_name])))
+            return False
+        return await teardown_step(
+            "unregister {0}".format(template_name),
+            lambda: TaskWaiter._call(template.UnregisterVM))
+
+    async def delete_deploy_dir(waiter, template_jobs):
+        # the kept templates files live in the deployment dir
+        if not all(await asyncio.gather(*template_jobs)):
+            log.warning("keeping deployment dir: {0}".format(deploy_dir))
+            return False
+        return await delete_deploy_dir_aio(vsphere, waiter, deploy_dir)
+
+    async def run():
+        async with TaskWaiter(vsphere) as waiter:
+            template_jobs = []
+            for template_name, vms in nodes.items():
+                node_jobs = [asyncio.ensure_future(
+                    destroy_vm_aio(waiter, vm.vm_obj, vm.name))
+                    for vm in vms]
+                template_jobs.append(asyncio.ensure_future(
+                    unregister_template(template_name, node_jobs)))
+            return await delete_deploy_dir(waiter, template_jobs)
+
+    started = time.time()
+    if run_async(run()):
+        log.info("destroy succeeded in {0:.1f}s".format(
+            time.time() - started))
+
+    if template_cache:
+        template_cache.evict()
+
+
+def teardown_retry_faults():
+    """ vim faults after which a teardown step is worth retrying """
+    return transient_faults() + (vim.fault.InvalidState,)
+
+
+async def teardown_step(description, step, retries=3):
+    """ Run a teardown coroutine with retries, return True on success """
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await step()
+            return True
+        except vmodl.fault.ManagedObjectNotFound:
+            log.info("{0}: already gone".format(description))
+            return True
+        except teardown_retry_faults() as e:
+            if attempt > retries:
+                log.error("{0} failed: {1}".format(description, e.msg or e))
+                return False
+            delay = jittered_backoff(attempt)
+            log.warning("{0} failed with a transient fault, retrying in "
+                        "{1:.0f}s: {2}".format(description, delay, e.msg or e))
+            await asyncio.sleep(delay)
+        except Exception as e:
+            log.error("{0} failed: {1}".format(
+                description, getattr(e, "msg", None) or e))
+            return False
 
-    log.info("power off all running VMs")
-    wait(h.PowerOffVM_Task() for h in vms
-         if h.runtime.powerState == "poweredOn")
-    log.info("destroy VMs")
-    wait(h.Destroy_Task() for h in vms)
 
-    log.task("delete virtual machines role templates")
-    vms = []
-    for r in ["admin", "master", "worker"]:
-        for vm_config in conf[r]["vmguests"]:
-            vm = VMachine(vsphere, conf["parameters"],
-                          conf[r]["config"], vm_config)
-            h = vm.get_vm(isTemplate=True)
-            if h:
-                vms.append(h)
-                break
+async def destroy_vm_aio(waiter, vm_obj, name):
+    """ Power-off then destroy a VM, return True on success """
+    async def power_off():
+        power_state = await TaskWaiter._call(
+            lambda: vm_obj.runtime.powerState)
+        if power_state == "poweredOn":
+            log.info("powering-off {0}...".format(name))
+            await waiter.wait(await TaskWaiter._call(vm_obj.PowerOffVM_Task))
 
-    log.info("unregister")
-    try:
-        # AttributeError: 'NoneType' object has no attribute '_stub'
-        # or pyVmomi.VmomiSupport.ManagedObjectNotFound
-        wait(h.UnregisterVM() for h in vms)
-    except Exception:
-        time.sleep(5)
+    async def delete():
+        log.info("deleting {0}...".format(name))
+        await waiter.wait(await TaskWaiter._call(vm_obj.Destroy_Task))
+        log.info("deletion succeeded: {0}".format(name))
+
+    return await teardown_step("power-off {0}".format(name), power_off) and \
+        await teardown_step("destroy {0}".format(name), delete)
+
+
+async def delete_deploy_dir_aio(vsphere, waiter, deploy_dir):
+    """ Delete a "[datastore]dir" deployment dir, return True on success """
+    async def delete():
         try:
-            wait(h.UnregisterVM() for h in vms)
-        except Exception:
-            log.error("_stub error")
+            task = await TaskWaiter._call(
+                lambda: vsphere.file_manager.DeleteDatastoreFile_Task(
+                    datacenter=vsphere.datacenter, name=deploy_dir))
+            await waiter.wait(task)
+        except vim.fault.FileNotFound:
+            pass
+        vsphere.datastore_cache.invalidate(deploy_dir)
 
-    # Clean up the deployment on the cluster
-    clean_up(vsphere=vsphere, location="remote",
-             path=conf["parameters"]["vm_deploy_dir"])
+    return await teardown_step("delete {0}".format(deploy_dir), delete)
+
+
+def linked_clone_dependents(vsphere):
+    """
+    Return a dict template name -> names of the existing VMs which were
+    linked-cloned from the template
+    """
+    return annotated_vms(vsphere, VMachine.linked_clone_annotation)
+
+
+def annotated_vms(vsphere, prefix):
+    """
+    Return a dict value -> names of the existing VMs having a
+    "<prefix><value>" annotation line
+    """
+    vms = {}
+    items = retrieve_properties(
+        vsphere, {vim.VirtualMachine: ["name", "config.annotation"]},
+        container=vsphere.datacenter.vmFolder)
+    for item in items:
+        for line in (item.get("config.annotation") or "").splitlines():
+            if line.startswith(prefix):
+                vms.setdefault(line[len(prefix):], []).append(item["name"])
+    return vms
+
+
+def reap_candidates(vsphere, parameters):
+    """ Group the VMs, templates and dirs left on vCenter by stack name """
+    prefixes = "|".join(re.escape(parameters["{0}_prefix".format(r)])
+                        for r in ["admin", "master", "worker"])
+    vm_regex = re.compile(r"^(?:{0})-(?P<stack>.+)\d{{3}}$".format(prefixes))
+    template_regex = re.compile(r"^(?:{0})-(?P<stack>.+)$".format(prefixes))
+    dir_regex = re.compile(r"^caasp-(?P<stack>.+)$")
+    only = parameters["reap_stacks"]
+
+    stacks = {}
+
+    def stack(name):
+        return stacks.setdefault(name, {
+            "name": name, "vms": [], "templates": [], "dir": None,
+            "last_used": None, "powered_on": 0, "cpu": 0, "ram": 0,
+            "disk": 0})
+
+    def used(entry, when):
+        if when and (entry["last_used"] is None or when > entry["last_used"]):
+            entry["last_used"] = when
+
+    items = retrieve_properties(vsphere, {vim.VirtualMachine: [
+        "name", "config.template", "config.createDate", "config.annotation",
+        "runtime.powerState", "runtime.bootTime", "summary.config.numCpu",
+        "summary.config.memorySizeMB", "summary.storage.committed"]},
+        container=vsphere.datacenter.vmFolder)
+    dependents = {}
+    for item in items:
+        for line in (item.get("config.annotation") or "").splitlines():
+            if line.startswith(VMachine.linked_clone_annotation):
+                dependents.setdefault(
+                    line[len(VMachine.linked_clone_annotation):],
+                    []).append(item["name"])
+
+        # VMs without config are orphaned or inaccessible, the warm pool
+        # VMs and shared templates, which have their own lifecycle, do
+        # not match the node names
+        if "config.template" not in item:
+            continue
+        regex = template_regex if item["config.template"] else vm_regex
+        match = regex.match(item["name"])
+        if not match or (only and match.group("stack") not in only):
+            continue
+        entry = stack(match.group("stack"))
+        used(entry, item.get("config.createDate"))
+        used(entry, item.get("runtime.bootTime"))
+        if item["config.template"]:
+            # unregistered only, their disk is the media
+            entry["templates"].append(item)
+            continue
+        entry["vms"].append(item)
+        if item.get("runtime.powerState") == "poweredOn":
+            entry["powered_on"] += 1
+        entry["cpu"] += item.get("summary.config.numCpu", 0)
+        entry["ram"] += item.get("summary.config.memorySizeMB", 0) * 1024 ** 2
+        entry["disk"] += item.get("summary.storage.committed", 0)
+
+    # directories which are not stacks
+    reserved = [parameters["pool_folder"], parameters["template_cache_folder"],
+                (parameters["media_dir"] or "").strip("/")]
+    browser = vim.host.DatastoreBrowser
+    spec = browser.SearchSpec(
+        matchPattern=["caasp-*"], query=[browser.FolderQuery()],
+        details=browser.FileInfo.Details(modification=True))
+    task = vsphere.datastore.browser.SearchDatastore_Task(
+        datastorePath="[{0}]".format(vsphere.datastore.name), searchSpec=spec)
+    wait_for_task(task)
+    for f in task.info.result.file or []:
+        match = dir_regex.match(f.path)
+        if not match or f.path in reserved or \
+                (only and match.group("stack") not in only):
+            continue
+        entry = stack(match.group("stack"))
+        entry["dir"] = f.path
+        if not entry["vms"] and not entry["templates"]:
+            used(entry, f.modification)
+            # leftovers of a failed deploy or destroy
+            entry["disk"] += sum(
+                info.fileSize or 0 for _, info in Datastore.search_tree(
+                    vsphere, f.path, ["*.vmdk", "*.iso"]) or [])
+
+    return list(stacks.values()), dependents
+
+
+def reap(vsphere, conf):
+    """ Report the expired stacks, tear them down with reap_confirm """
+    parameters = conf["parameters"]
+    ttl = float(parameters["reap_ttl"]) * 3600
+    log.task("find stacks unused for {0}h".format(parameters["reap_ttl"]))
+
+    now = vsphere.service_instance.CurrentTime()
+    stacks, dependents = reap_candidates(vsphere, parameters)
+    expired = []
+    for entry in stacks:
+        age = (now - entry["last_used"]).total_seconds() \
+            if entry["last_used"] else None
+        entry["age"] = age
+        # a running cluster is not a leftover, whatever its age
+        if age is not None and age > ttl and \
+                (parameters["reap_force"] or not entry["powered_on"]):
+            expired.append(entry)
+
+    gib = 1024.0 ** 3
+    table = PrettyTable()
+    table.field_names = ["Stack", "VMs", "Powered-on", "Templates", "Dir",
+                         "Idle (h)", "vCPUs", "RAM (GiB)", "Disk (GiB)",
+                         "Reap"]
+    table.float_format = ".1"
+    for entry in stacks:
+        table.add_row([entry["name"], len(entry["vms"]),
+                       entry["powered_on"], len(entry["templates"]),
+                       entry["dir"] or "",
+                       entry["age"] / 3600 if entry["age"] is not None
+                       else "-",
+                       entry["cpu"], entry["ram"] / gib, entry["disk"] / gib,
+                       entry in expired])
+    log.info("stacks:\n{0}".format(table.get_string(sortby="Stack")))
+    log.info("reclaimable: {0} stacks, {1} vCPUs, {2:.1f} GiB RAM, {3:.1f} "
+             "GiB disk".format(len(expired),
+                               sum(e["cpu"] for e in expired),
+                               sum(e["ram"] for e in expired) / gib,
+                               sum(e["disk"] for e in expired) / gib))
+
+    if not expired:
+        return
+    if not parameters["reap_confirm"]:
+        log.info("nothing torn down, run again with --reap-confirm to reap "
+                 "these stacks")
+        return
+
+    # linked clones of reaped stacks do not keep their template alive
+    reaped = set(i["name"] for e in expired for i in e["vms"])
+    datastore_name = vsphere.datastore.name
+
+    async def reap_template(item):
+        kept = [n for n in dependents.get(item["name"], [])
+                if n not in reaped]
+        if kept:
+            log.warning("keeping template {0}, still used by linked "
+                        "clones: {1}".format(item["name"], ", ".join(kept)))
+            return False
+        return await teardown_step(
+            "unregister {0}".format(item["name"]),
+            lambda: TaskWaiter._call(item["obj"].UnregisterVM))
+
+    async def reap_stack(waiter, entry):
+        results = await asyncio.gather(
+            *[destroy_vm_aio(waiter, item["obj"], item["name"])
+              for item in entry["vms"]])
+        if not all(results):
+            log.error("keeping the templates and dir of stack {0}, some of "
+                      "its VMs were not destroyed".format(entry["name"]))
+            return False
+        results = await asyncio.gather(
+            *[reap_template(item) for item in entry["templates"]])
+        if not all(results) or not entry["dir"]:
+            return all(results)
+
+        return await delete_deploy_dir_aio(
+            vsphere, waiter,
+            "[{0}]{1}".format(datastore_name, entry["dir"]))
+
+    async def run():
+        async with TaskWaiter(vsphere) as waiter:
+            return await asyncio.gather(
+                *[reap_stack(waiter, entry) for entry in expired])
+
+    log.task("reap {0} stacks".format(len(expired)))
+    started = time.time()
+    results = run_async(run())
+    failed = [e["name"] for e, ok in zip(expired, results) if not ok]
+    if failed:
+        quit("reap failed: {0}".format(", ".join(failed)))
+    log.info("reap succeeded in {0:.1f}s".format(time.time() - started))
 
 
 def destroy_old(vsphere, conf):
@@ -1151,18 +4004,85 @@ def destroy_old(vsphere, conf):
     clean_up(vsphere=vsphere, location="remote", path=conf["parameters"]["vm_deploy_dir"])
 
 
-def get_vm_ip(vm_obj, timeout, sleep):
-    vm_ip = None
-    count = timeout
-    log.info("waiting IP address for virtual machine: {0}".format(vm_obj.name))
-    while vm_ip is None and count > 0:
-        vm_ip = vm_obj.get_ip()
-        count -= sleep
-        time.sleep(sleep)
-        if vm_ip:
-            return vm_ip
-    if vm_ip is None:
-        quit("no IP address found in {0} seconds".format(timeout))
+def wait_for_ips(vsphere, vms, timeout):
+    """ Wait for an IPv4 address on the VMachines in vms, return name -> IP """
+    pc = vmodl.query.PropertyCollector
+    names = {vm.vm_obj._moId: vm.name for vm in vms}
+    ips = {}
+
+    log.info("waiting IP address for virtual machines: {0}".format(
+        ", ".join(sorted(names.values()))))
+
+    # dedicated collector, its filter is destroyed with it
+    collector = vsphere.content.propertyCollector.CreatePropertyCollector()
+    try:
+        filter_spec = pc.FilterSpec(
+            objectSet=[pc.ObjectSpec(obj=vm.vm_obj, skip=False)
+                       for vm in vms],
+            propSet=[pc.PropertySpec(type=vim.VirtualMachine,
+                                     pathSet=["guest.net"], all=False)])
+        collector.CreateFilter(filter_spec, partialUpdates=False)
+
+        version = ""
+        deadline = time.time() + timeout
+        while len(ips) < len(names):
+            remaining = int(deadline - time.time())
+            if remaining <= 0:
+                quit("no IP address found in {0} seconds for: {1}".format(
+                    timeout, ", ".join(sorted(
+                        n for n in names.values() if n not in ips))))
+
+            update = collector.WaitForUpdatesEx(
+                version, pc.WaitOptions(maxWaitSeconds=min(remaining, 60)))
+            if update is None:
+                continue
+            version = update.version
+
+            for filter_update in update.filterSet:
+                for object_update in filter_update.objectSet:
+                    name = names[object_update.obj._moId]
+                    for change in object_update.changeSet:
+                        if change.name != "guest.net" or name in ips:
+                            continue
+                        ip = VMachine.first_ipv4(change.val)
+                        if ip:
+                            log.info("{0} IP address: {1}".format(name, ip))
+                            ips[name] = ip
+    finally:
+        collector.DestroyPropertyCollector()
+
+    return ips
+
+
+def vm_locations(vsphere, vms):
+    """ Datastore and host names of the VMachines in vms, by VM name """
+    objs = [vm.vm_obj for vm in vms if vm.vm_obj]
+    if not objs:
+        return {}
+    items = retrieve_properties(
+        vsphere, {vim.VirtualMachine: ["name", "datastore", "runtime.host"]},
+        objects=objs)
+
+    entities = {}
+    for item in items:
+        for entity in item.get("datastore", []) + [item.get("runtime.host")]:
+            if entity is not None:
+                entities[entity._moId] = entity
+    names = {}
+    if entities:
+        names = {i["obj"]._moId: i["name"] for i in retrieve_properties(
+            vsphere, {vim.ManagedEntity: ["name"]},
+            objects=list(entities.values()))}
+
+    locations = {}
+    for item in items:
+        datastores = item.get("datastore", [])
+        host = item.get("runtime.host")
+        locations[item["name"]] = {
+            "datastore": names.get(datastores[0]._moId)
+            if datastores else None,
+            "host": names.get(host._moId) if host else None}
+    return locations
 
 
 def generate_state_file(vsphere, conf):
@@ -1175,11 +4095,55 @@ def generate_state_file(vsphere, conf):
     state = {}
     state["config"] = conf["parameters"]
 
+    state_filename, state_filename_stack = state_file_paths(
+        conf["parameters"])
+
+    for k in ["vc_username", "vc_password"]:
+        del state["config"][k]
+
+    vms = []
+    for n in ["admin", "master", "worker"]:
+        for vm_config in conf[n]["vmguests"]:
+            vms.append(VMachine(vsphere, conf["parameters"],
+                                conf[n]["config"], vm_config))
+
+    state["vmguests"] = []
+    for vm_config in nodes_state(vsphere, vms):
+        state["vmguests"].append(vm_config)
+        index = state["vmguests"].index(vm_config)
+        state["vmguests"][index]["index"] = index
+
+    write_state_file(conf["parameters"], state)
+    log.info("state files successfully created")
+
+
+def nodes_state(vsphere, vms):
+    """
+    Wait for the IP addresses of the VMachines in vms and return their
+    vm_config completed with the addresses, image, UUID and location
+    """
+    ips = wait_for_ips(vsphere, vms, timeout=240)
+    locations = vm_locations(vsphere, vms)
+
+    for v in vms:
+        vm_config = v.vm_config
+        vm_ip = ips[v.name]
+        vm_config["publicipv4"] = vm_ip
+        vm_config["fqdn"] = socket.getfqdn(vm_ip)
+        vm_config["image"] = os.path.splitext(
+            os.path.basename(v.media_name))[0]
+        vm_config["uuid"] = v.vm_obj.config.uuid
+        vm_config.update(locations.get(v.name, {}))
+    return [v.vm_config for v in vms]
+
+
+def state_file_paths(parameters):
+    """ Path of the state file and of its per stack copy """
     state_filename = "caasp-vmware.state"
 
     # Add a directory if provided, otherwise current is used
-    if conf["parameters"]["state_file_dir"]:
-        state_file_dir = conf["parameters"]["state_file_dir"]
+    if parameters["state_file_dir"]:
+        state_file_dir = parameters["state_file_dir"]
 
         if state_file_dir[-1] != "/":  # Add slash
             state_file_dir = "{0}/".format(state_file_dir)
@@ -1187,27 +4151,24 @@ def generate_state_file(vsphere, conf):
         state_filename = "{0}{1}".format(state_file_dir, state_filename)
 
     state_filename_stack = "{0}-{1}".format(
-        state_filename, state["config"]["stack_name"])
+        state_filename, parameters["stack_name"])
+    return state_filename, state_filename_stack
 
-    for k in ["vc_username", "vc_password"]:
-        del state["config"][k]
 
-    state["vmguests"] = []
-    for n in ["admin", "master", "worker"]:
-        for vm_config in conf[n]["vmguests"]:
-            v = VMachine(vsphere, conf["parameters"],
-                         conf[n]["config"], vm_config)
+def read_state_file(parameters):
+    """ State of the stack written by deploy """
+    state_filename_stack = state_file_paths(parameters)[1]
+    try:
+        with open(state_filename_stack, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (IOError, ValueError) as e:
+        quit("unable to read state file {0}: {1}".format(
+            state_filename_stack, e))
 
-            vm_ip = get_vm_ip(v, timeout=240, sleep=2)
-            vm_config["publicipv4"] = vm_ip
-            vm_config["fqdn"] = socket.getfqdn(vm_ip)
-            vm_config["image"] = os.path.splitext(
-                os.path.basename(v.media_name))[0]
-            vm_config["uuid"] = v.vm_obj.config.uuid
 
-            state["vmguests"].append(vm_config)
-            index = state["vmguests"].index(vm_config)
-            state["vmguests"][index]["index"] = index
+def write_state_file(parameters, state):
+    """ Print the state and write it to the state files """
+    state_filename, state_filename_stack = state_file_paths(parameters)
 
     state_file_json = json.dumps(state, indent=2)
     print("====BEGINNING_STATE====")
@@ -1224,41 +4185,297 @@ def generate_state_file(vsphere, conf):
     except IOError as e:
         quit("I/O error: {0}".format(e))
 
-    log.info("state files successfully created")
+
+def stack_vms(vsphere, conf):
+    """ VMachine of every VM of the stack, quit if one is missing """
+    vms = []
+    for r in ["admin", "master", "worker"]:
+        for vm_config in conf[r]["vmguests"]:
+            vms.append(VMachine(vsphere, conf["parameters"],
+                                conf[r]["config"], vm_config))
+    missing = [vm.name for vm in vms if not vm.vm_obj]
+    if missing:
+        quit("virtual machines not found: {0}".format(", ".join(missing)))
+    return vms
+
+
+def snapshot(vsphere, conf):
+    """ Snapshot every VM of the stack and record it in the state file """
+    name = conf["parameters"]["snapshot_name"]
+    state = read_state_file(conf["parameters"])
+    vms = stack_vms(vsphere, conf)
+    log.task("snapshot {0} virtual machines: {1}".format(len(vms), name))
+
+    async def run():
+        async with TaskWaiter(vsphere) as waiter:
+            return await asyncio.gather(
+                *[vm.snapshot_aio(waiter, name) for vm in vms],
+                return_exceptions=True)
+
+    results = run_async(run())
+    failed = []
+    for vm, r in zip(vms, results):
+        if isinstance(r, Exception):
+            log.error("snapshot of {0} failed: {1}".format(
+                vm.name, getattr(r, "msg", None) or r))
+            failed.append(vm.name)
+    if failed:
+        quit("snapshot failed: {0}".format(", ".join(failed)))
+
+    state["snapshot"] = {
+        "name": name,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+    snapshots = {vm.name: r._moId for vm, r in zip(vms, results)}
+    for vm_config in state["vmguests"]:
+        if vm_config["name"] in snapshots:
+            vm_config["snapshot"] = snapshots[vm_config["name"]]
+    write_state_file(conf["parameters"], state)
+
+
+def reset(vsphere, conf):
+    """ Revert every VM of the stack to its snapshot and power it on """
+    state = read_state_file(conf["parameters"])
+    if "snapshot" not in state:
+        quit("no snapshot recorded in the state file, run snapshot first")
+    name = state["snapshot"]["name"]
+    vms = stack_vms(vsphere, conf)
+    log.task("reset {0} virtual machines to {1} taken at {2}".format(
+        len(vms), name, state["snapshot"]["created"]))
+
+    async def reset_vm(waiter, power_on, vm):
+        await vm.revert_aio(waiter, name)
+        await power_on.power_on(vm)
+
+    async def run():
+        async with TaskWaiter(vsphere) as waiter:
+            power_on = PowerOnBatcher(vsphere, waiter,
+                                      conf["parameters"]["power_on_batch"])
+            return await asyncio.gather(
+                *[reset_vm(waiter, power_on, vm) for vm in vms],
+                return_exceptions=True)
+
+    started = time.time()
+    results = run_async(run())
+    failed = []
+    for vm, r in zip(vms, results):
+        if isinstance(r, Exception):
+            log.error("reset of {0} failed: {1}".format(
+                vm.name, getattr(r, "msg", None) or r))
+            failed.append(vm.name)
+    if failed:
+        quit("reset failed: {0}".format(", ".join(failed)))
+
+    # DHCP may hand out other addresses after the reboot
+    ips = wait_for_ips(vsphere, vms, timeout=240)
+    for vm_config in state["vmguests"]:
+        if vm_config["name"] in ips:
+            vm_config["publicipv4"] = ips[vm_config["name"]]
+    state["snapshot"]["reset"] = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                               time.gmtime())
+    write_state_file(conf["parameters"], state)
+    log.info("stack reset in {0:.1f}s".format(time.time() - started))
+
+
+def scale(vsphere, conf):
+    """ Clone or destroy nodes to scale a deployed stack to its counts """
+    parameters = conf["parameters"]
+    state = read_state_file(parameters)
+    existing = set(vm_config["name"] for vm_config in state["vmguests"])
+    # the isos of these roles are in use by the existing nodes
+    deployed_roles = set(vm_config["role"] for vm_config in state["vmguests"])
+    roles = ["master", "worker"]
+
+    wanted = set(vm_config["name"] for r in roles
+                 for vm_config in conf[r]["vmguests"])
+    surplus = [VMachine(vsphere, parameters, conf[vm_config["role"]]["config"],
+                        vm_config)
+               for vm_config in state["vmguests"]
+               if vm_config["role"] in roles and
+               vm_config["name"] not in wanted]
+    missing = [VMachine(vsphere, parameters, conf[r]["config"], vm_config)
+               for r in roles for vm_config in conf[r]["vmguests"]
+               if vm_config["name"] not in existing]
+
+    log.task("scale to {0} masters and {1} workers: {2} to add, {3} to "
+             "remove".format(len(conf["master"]["vmguests"]),
+                             len(conf["worker"]["vmguests"]),
+                             len(missing), len(surplus)))
+    leftovers = [vm.name for vm in missing if vm.vm_obj]
+    if leftovers:
+        quit("virtual machines not in the state file already exist: "
+             "{0}".format(", ".join(leftovers)))
+    for vm in missing:
+        if not vm.get_vm(isTemplate=True):
+            quit("role template not found: {0}".format(vm.template_name))
+
+    if surplus:
+        # deleted from vCenter behind our back, only the state is updated
+        gone = [vm.name for vm in surplus if not vm.vm_obj]
+        if gone:
+            log.warning("virtual machines already destroyed: {0}".format(
+                ", ".join(gone)))
+        present = [vm for vm in surplus if vm.vm_obj]
+
+        async def run():
+            async with TaskWaiter(vsphere) as waiter:
+                return await asyncio.gather(
+                    *[destroy_vm_aio(waiter, vm.vm_obj, vm.name)
+                      for vm in present])
+
+        results = run_async(run())
+        removed = set(gone)
+        removed.update(vm.name for vm, ok in zip(present, results) if ok)
+        state["vmguests"] = [vm_config for vm_config in state["vmguests"]
+                             if vm_config["name"] not in removed]
+        write_state_file(parameters, state)
+        if len(removed) < len(surplus):
+            quit("destroy failed: {0}".format(", ".join(
+                vm.name for vm in surplus if vm.name not in removed)))
+
+    if missing:
+        # the admission check covers the new nodes only
+        delta = dict(conf, admin=dict(conf["admin"], vmguests=[]))
+        for r in roles:
+            delta[r] = dict(conf[r], vmguests=[
+                vm.vm_config for vm in missing if vm.role == r])
+        preflight(vsphere, delta)
+        missing = [vm for vm in missing
+                   if vm.vm_config in delta[vm.role]["vmguests"]]
+
+        admin_ip = [vm_config["publicipv4"] for vm_config in state["vmguests"]
+                    if vm_config["role"] == "admin"][0]
+
+        claimed = []
+        if int(parameters["pool_size"]) > 0:
+            claimed = WarmPool(vsphere, conf).claim(missing)
+        placement = Placement(vsphere, parameters)
+        placement.assign([vm for vm in missing if vm not in claimed])
+
+        deploy_nodes(vsphere, parameters, missing, claimed, admin_ip,
+                     iso_roles=set(roles) - deployed_roles)
+        state["vmguests"].extend(nodes_state(vsphere, missing))
+
+    order = ["admin"] + roles
+    state["vmguests"].sort(key=lambda vm_config: (
+        order.index(vm_config["role"]), vm_config["name"]))
+    for index, vm_config in enumerate(state["vmguests"]):
+        vm_config["index"] = index
+    for r in roles:
+        state["config"]["{0}_count".format(r)] = len(
+            [v for v in state["vmguests"] if v["role"] == r])
+    write_state_file(parameters, state)
+
+
+def image_index(vsphere, remote_path):
+    """ Images (ISO|VMDK) below a datastore directory, sorted by name """
+    files = Datastore.search_tree(vsphere, remote_path,
+                                  ["*.iso", "*.vmdk"])
+    if files is None:
+        return None
+
+    images = []
+    for folder, f in files:
+        if isinstance(f, vim.host.DatastoreBrowser.IsoImageInfo):
+            image_type = "iso"
+        elif isinstance(f, vim.host.DatastoreBrowser.VmDiskInfo):
+            image_type = "vmdk"
+        else:
+            continue
+        images.append({
+            "name": "{0}/{1}".format(folder, f.path) if folder else f.path,
+            "type": image_type,
+            "size": f.fileSize,
+            "modified": f.modification.isoformat()
+            if f.modification else None,
+        })
+
+    return {"datastore": vsphere.datastore.name,
+            "path": remote_path,
+            "images": sorted(images, key=lambda i: i["name"])}
 
 
-def list_images(vsphere, remote_path):
+def list_images(vsphere, remote_path, output="table"):
     """ List images (ISO|VMDK) in a datastore directory """
     log.task("list images in directory: [{0}]{1}".format(
         vsphere.datastore.name, remote_path))
 
-    if Datastore.path_exists(vsphere, remote_path):
-        iso = Datastore.list_path(
-            vsphere, remote_path, match_pattern=["*.iso"])
-        if iso:
-            log.info("available iso:")
-            for i in iso:
-                log.info(" - {0}".format(i))
-
-        vmdk = Datastore.list_path(
-            vsphere, remote_path, match_pattern=["*.vmdk"])
-        if vmdk:
-            log.info("available vmdk:")
-            for i in vmdk:
-                log.info(" - {0}".format(i))
-    else:
+    index = image_index(vsphere, remote_path)
+    if index is None:
         quit("images directory not found")
 
+    for image_type in ["iso", "vmdk"]:
+        names = [i["name"] for i in index["images"]
+                 if i["type"] == image_type]
+        if names:
+            log.info("available {0}:".format(image_type))
+            for name in names:
+                log.info(" - {0}".format(name))
+
+    keys = ["name", "type", "size", "modified"]
+    if output == "json":
+        print(json.dumps(index, indent=2))
+    elif output == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(keys)
+        for image in index["images"]:
+            writer.writerow([image[k] for k in keys])
+    else:
+        table = PrettyTable()
+        table.field_names = ["Name", "Type", "Size (MB)", "Modified"]
+        table.align["Name"] = "l"
+        for image in index["images"]:
+            table.add_row([image["name"], image["type"],
+                           (image["size"] or 0) // (1024 * 1024),
+                           image["modified"]])
+        print(table)
+
 
-def push_image(vsphere, src, remote_path):
+def push_image(vsphere, src, remote_path, sha256=None):
     """
-    Push an image to the datastore
-    The source can be a local path of an HTTP URL
+    Push images to the datastore
+    The sources are comma separated local paths or HTTP URLs
     """
-    file_name = os.path.basename(src)
-    log.task("push image to the datastore")
-    Datastore.upload_file(
-        vsphere, src, "{0}{1}".format(remote_path, file_name))
+    sources = [s.strip() for s in src.split(",") if s.strip()]
+    if len(sources) > 1 and sha256:
+        quit("--source-media-sha256 needs a single source media")
+    log.task("push {0} images to the datastore".format(len(sources)))
+    Datastore.upload_files(vsphere, [
+        (source, "{0}{1}".format(remote_path, os.path.basename(source)),
+         sha256) for source in sources])
+
+
+def collect(vsphere, conf):
+    """ Download the logs and .vmx files of the stack VMs to collect_dir """
+    collect_dir = conf["parameters"]["collect_dir"]
+    names = set(vm_config["name"] for r in ["admin", "master", "worker"]
+                for vm_config in conf[r]["vmguests"])
+
+    items = retrieve_properties(
+        vsphere, {vim.VirtualMachine: ["name", "layoutEx.file"]},
+        container=vsphere.datacenter.vmFolder)
+    transfers = []
+    found = set()
+    for item in items:
+        if item["name"] not in names:
+            continue
+        found.add(item["name"])
+        for f in item.get("layoutEx.file", []):
+            if f.type in ("log", "config"):
+                transfers.append((f.name, os.path.join(
+                    collect_dir, item["name"], os.path.basename(f.name))))
+
+    missing = sorted(names - found)
+    if missing:
+        log.warning("virtual machines not found: {0}".format(
+            ", ".join(missing)))
+
+    log.task("download {0} files of {1} virtual machines to {2}".format(
+        len(transfers), len(found), collect_dir))
+    downloaded = Datastore.download_files(vsphere, transfers)
+    if downloaded < len(transfers):
+        log.warning("{0} files could not be downloaded".format(
+            len(transfers) - downloaded))
+    log.info("{0} files downloaded".format(downloaded))
 
 
 def delete_image(vsphere, remote_path):
@@ -1267,18 +4484,20 @@ def delete_image(vsphere, remote_path):
     Datastore.delete_path(vsphere, remote_path)
 
 
+STATUS_FIELDS = [
+    # (column, json/csv key, vim.VirtualMachine property path)
+    ("Name", "name", "name"),
+    ("Hostname", "hostname", "guest.hostName"),
+    ("IP Address", "ip_address", "guest.ipAddress"),
+    ("State", "state", "guest.guestState"),
+    ("VMware Tools", "tools", "guest.toolsRunningStatus"),
+    ("Template", "template", "config.template"),
+]
+
+
 def status(vsphere, conf):
     """ Retrieve info about VMs and Templates """
     log.task("show virtual machines and templates")
-    datacenter = vsphere.get_datacenter()
-
-    vm_status = PrettyTable()
-    vm_status.field_names = ["Name",
-                             "Hostname",
-                             "IP Address",
-                             "State",
-                             "VMware Tools",
-                             "Template"]
 
     regex = re.compile("({0})|({1})|({2})".format(
         conf["parameters"]["admin_node"],
@@ -1289,58 +4508,96 @@ def status(vsphere, conf):
         regex = re.compile(conf["parameters"]["show_regex"])
 
     show_all = conf["parameters"].get("show_all", None)
-    vms = []
-
-    for vm in datacenter.vmFolder.childEntity:
-        try:
-            if not vm.guest:  # make sure it is a vm
-                continue
-            if vm.config is None:
-                continue
-            if show_all or re.search(regex, vm.name):
-                vms.append(vm)
-        # avoid failing as there is no attribute to differentiate
-        # between a Folder, vApp and a VirtualMachine
-        except AttributeError:
-            pass
-
-    for vm in vms:
-        vm_status.add_row([vm.name,
-                           vm.guest.hostName,
-                           vm.guest.ipAddress,
-                           vm.guest.guestState,
-                           vm.guest.toolsRunningStatus,
-                           vm.config.template])
-
-    print(vm_status.get_string(sort_key=operator.itemgetter(6), sortby="Template"))
+    output = conf["parameters"].get("output", None) or "table"
+
+    # Fetch every needed property of every VM in one paged query,
+    # filtering is done on the client side
+    items = retrieve_properties(
+        vsphere, {vim.VirtualMachine: [f[2] for f in STATUS_FIELDS]},
+        container=vsphere.datacenter.vmFolder)
+
+    rows = []
+    for item in items:
+        # VMs without config are orphaned or inaccessible
+        if "config.template" not in item:
+            continue
+        if show_all or re.search(regex, item["name"]):
+            rows.append([item.get(f[2]) for f in STATUS_FIELDS])
+
+    if output == "json":
+        keys = [f[1] for f in STATUS_FIELDS]
+        print(json.dumps([dict(zip(keys, r)) for r in rows], indent=2))
+    elif output == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow([f[1] for f in STATUS_FIELDS])
+        writer.writerows(rows)
+    else:
+        vm_status = PrettyTable()
+        vm_status.field_names = [f[0] for f in STATUS_FIELDS]
+        for r in rows:
+            vm_status.add_row(r)
+        print(vm_status.get_string(sortby="Template"))
 
 
 def main():
     args = parse_args()
     options = get_user_opt(args)
     conf = generate_config(options)
-    action = conf["parameters"]["action"]
-    media_dir = conf["parameters"]["media_dir"]
+
+    # plan runs offline
+    if conf["parameters"]["action"] == "plan":
+        print("PLAN ACTION")
+        pp = pprint.PrettyPrinter(indent=2)
+        pp.pprint(conf)
+        return
 
     vsphere = VSphere(conf["parameters"])
-    wait._service_instance = vsphere.service_instance
+    wait._vsphere = vsphere
+
+    if conf["parameters"]["profile"]:
+        profiler.start(vsphere.service_instance)
+        atexit.register(write_profile, conf["parameters"]["profile"])
+
+    with profiler.phase(conf["parameters"]["action"]):
+        run_action(vsphere, conf)
+
+
+def write_profile(path):
+    """ Write the profile and log its summary """
+    profiler.write(path)
+    log.info("profile summary:\n{0}".format(profiler.summary()))
+
+
+def run_action(vsphere, conf):
+    action = conf["parameters"]["action"]
+    media_dir = conf["parameters"]["media_dir"]
 
     if action == "deploy":
         deploy(vsphere, conf)
     elif action == "destroy":
         destroy(vsphere, conf)
-    elif action == "plan":
-        print("PLAN ACTION")
-        pp = pprint.PrettyPrinter(indent=2)
-        pp.pprint(conf)
     elif action == "status":
         status(vsphere, conf)
     elif action == "pushimage":
-        push_image(vsphere, conf["parameters"]["source_media"], media_dir)
+        push_image(vsphere, conf["parameters"]["source_media"], media_dir,
+                   conf["parameters"]["source_media_sha256"])
     elif action == "listimages":
-        list_images(vsphere, media_dir)
+        list_images(vsphere, media_dir,
+                    conf["parameters"].get("output", None) or "table")
     elif action == "deleteimage":
         delete_image(vsphere, conf["parameters"]["media"])
+    elif action == "replenish":
+        WarmPool(vsphere, conf).replenish()
+    elif action == "snapshot":
+        snapshot(vsphere, conf)
+    elif action == "reset":
+        reset(vsphere, conf)
+    elif action == "scale":
+        scale(vsphere, conf)
+    elif action == "reap":
+        reap(vsphere, conf)
+    elif action == "collect":
+        collect(vsphere, conf)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,14 @@
+import importlib.util
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="session")
+def caasp():
+    """ The caasp-vmware.py script, loaded as a module """
+    path = os.path.join(os.path.dirname(__file__), "..", "caasp-vmware.py")
+    spec = importlib.util.spec_from_file_location("caasp_vmware", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,81 @@
+from types import SimpleNamespace
+
+import pytest
+
+GIB = 1024 ** 3
+
+
+def conf(workers=3, capacity_check="refuse", linked_clones=False):
+    def nodes(role, count, cpu, ram):
+        return {"config": {}, "vmguests": [
+            {"name": "{0}{1:03d}".format(role, i), "role": role, "cpu": cpu,
+             "ram": ram} for i in range(count)]}
+
+    return {"parameters": {"capacity_check": capacity_check,
+                           "linked_clones": linked_clones,
+                           "media": "media.vmdk", "worker_count": workers},
+            "admin": nodes("admin", 1, 4, 8192),
+            "master": nodes("master", 1, 2, 4096),
+            "worker": nodes("worker", workers, 2, 4096)}
+
+
+@pytest.fixture
+def capacity(caasp, monkeypatch):
+    available = {}
+    monkeypatch.setattr(caasp.Datastore, "file_info",
+                        lambda vsphere, path: SimpleNamespace(
+                            fileSize=10 * GIB))
+    monkeypatch.setattr(caasp, "stack_capacity",
+                        lambda vsphere, parameters: available)
+    return available
+
+
+def test_stack_demand(caasp):
+    demand = caasp.stack_demand(conf(workers=2), 10 * GIB)
+    assert demand["cpu"] == 4 + 2 + 2 * 2
+    assert demand["ram"] == 20 * GIB
+    # a swap file per VM and a full clone of the disk
+    assert demand["disk"] == 20 * GIB + 4 * 10 * GIB
+
+
+def test_stack_demand_linked_clones(caasp):
+    demand = caasp.stack_demand(conf(workers=2, linked_clones=True),
+                                10 * GIB)
+    assert demand["disk"] == 20 * GIB
+
+
+def test_fits(caasp, capacity):
+    capacity.update(cpu=100, ram=100 * GIB, disk=1000 * GIB)
+    config = conf()
+    caasp.preflight(None, config)
+    assert len(config["worker"]["vmguests"]) == 3
+
+
+def test_refuse(caasp, capacity):
+    capacity.update(cpu=100, ram=20 * GIB, disk=1000 * GIB)
+    with pytest.raises(SystemExit):
+        caasp.preflight(None, conf())
+
+
+def test_shrink(caasp, capacity):
+    # room for the admin, the master and two workers
+    capacity.update(cpu=100, ram=20 * GIB, disk=1000 * GIB)
+    config = conf(capacity_check="shrink")
+    caasp.preflight(None, config)
+    assert [vm["name"] for vm in config["worker"]["vmguests"]] == \
+        ["worker000", "worker001"]
+    # the configured count is left to the caller
+    assert config["parameters"]["worker_count"] == 3
+
+
+def test_shrink_not_enough(caasp, capacity):
+    capacity.update(cpu=100, ram=10 * GIB, disk=1000 * GIB)
+    with pytest.raises(SystemExit):
+        caasp.preflight(None, conf(capacity_check="shrink"))
+
+
+def test_off(caasp, capacity):
+    capacity.update(cpu=0, ram=0, disk=0)
+    config = conf(capacity_check="off")
+    caasp.preflight(None, config)
+    assert len(config["worker"]["vmguests"]) == 3
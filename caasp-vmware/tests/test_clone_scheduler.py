@@ -0,0 +1,134 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeWaiter(object):
+    """ Run the fake clone tasks, recording how many run concurrently """
+
+    def __init__(self):
+        self.running = {}
+        self.peak = {}
+
+    def _count(self, keys, delta):
+        for key in keys:
+            self.running[key] = self.running.get(key, 0) + delta
+            self.peak[key] = max(self.peak.get(key, 0), self.running[key])
+
+    async def wait(self, task):
+        vm, outcome = task
+        keys = ["all", ("datastore", vm.datastore), ("host", vm.host)]
+        self._count(keys, 1)
+        await asyncio.sleep(0.01)
+        self._count(keys, -1)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return SimpleNamespace(name=vm.name)
+
+    def info(self, task):
+        return {}
+
+
+class FakeVM(object):
+    def __init__(self, name, datastore="ds-1", host="host-1", outcomes=()):
+        self.name = name
+        self.template_name = "template-" + host
+        self.datastore = datastore
+        self.host = host
+        self.target_datastore = SimpleNamespace(_moId=datastore)
+        self.outcomes = list(outcomes)
+        self.vm_obj = None
+        self.threads = set()
+
+    def get_vm(self, isTemplate=False):
+        if isTemplate:
+            return SimpleNamespace(runtime=SimpleNamespace(
+                host=SimpleNamespace(_moId=self.host)))
+        return None
+
+    def async_clone_vm(self):
+        self.threads.add(threading.current_thread())
+        return self, self.outcomes.pop(0) if self.outcomes else None
+
+
+def clone(caasp, vms, **parameters):
+    options = {"parallel": 4, "max_clones_per_datastore": None,
+               "max_clones_per_host": None, "clone_retries": 3}
+    options.update(parameters)
+    scheduler = caasp.CloneScheduler(None, options)
+    scheduler.backoff_base = scheduler.backoff_max = 0
+    waiter = FakeWaiter()
+
+    async def run():
+        return await asyncio.gather(*[scheduler.clone(waiter, vm)
+                                      for vm in vms])
+
+    return caasp.run_async(run()), waiter, scheduler
+
+
+def test_parallel(caasp):
+    vms = [FakeVM("vm-{0}".format(i)) for i in range(10)]
+    results, waiter, _ = clone(caasp, vms, parallel=3)
+    assert all(results)
+    assert waiter.peak["all"] == 3
+    assert all(vm.vm_obj.name == vm.name for vm in vms)
+
+
+def test_clone_calls_leave_the_loop(caasp):
+    vm = FakeVM("vm", outcomes=[caasp.vim.fault.FileLocked()])
+    results, _, _ = clone(caasp, [vm])
+    assert results == [True]
+    assert vm.threads and threading.main_thread() not in vm.threads
+
+
+def test_per_datastore_and_host(caasp):
+    vms = [FakeVM("vm-{0}".format(i), datastore="ds-{0}".format(i % 2),
+                  host="host-{0}".format(i % 3)) for i in range(12)]
+    _, waiter, _ = clone(caasp, vms, parallel=10,
+                         max_clones_per_datastore=2, max_clones_per_host=1)
+    assert waiter.peak[("datastore", "ds-0")] <= 2
+    assert waiter.peak[("datastore", "ds-1")] <= 2
+    assert all(waiter.peak[("host", "host-{0}".format(i))] == 1
+               for i in range(3))
+
+
+def test_transient_faults_are_retried(caasp):
+    vm = FakeVM("vm", outcomes=[caasp.vim.fault.FileLocked(),
+                                caasp.vim.fault.TaskInProgress()])
+    results, _, scheduler = clone(caasp, [vm])
+    assert results == [True]
+    assert scheduler.jobs[0]["attempts"] == 3
+
+
+def test_retries_are_bounded(caasp):
+    vm = FakeVM("vm", outcomes=[caasp.vim.fault.FileLocked()] * 5)
+    results, _, scheduler = clone(caasp, [vm], clone_retries=2)
+    assert results == [False]
+    assert scheduler.jobs[0]["attempts"] == 3
+
+
+def test_other_faults_are_not_retried(caasp):
+    vm = FakeVM("vm", outcomes=[caasp.vim.fault.InvalidState()])
+    results, _, scheduler = clone(caasp, [vm])
+    assert results == [False]
+    assert scheduler.jobs[0]["attempts"] == 1
+
+
+def test_transient_faults(caasp):
+    faults = caasp.transient_faults()
+    assert isinstance(caasp.vim.fault.FileLocked(), faults)
+    assert not isinstance(caasp.vim.fault.InvalidState(), faults)
+
+
+@pytest.mark.parametrize("attempt, low, high", [
+    (1, 2.5, 7.5),
+    (3, 10, 30),
+    # capped at maximum
+    (10, 60, 180),
+])
+def test_jittered_backoff(caasp, attempt, low, high):
+    delays = [caasp.jittered_backoff(attempt) for _ in range(100)]
+    assert all(low <= d <= high for d in delays)
+    assert len(set(delays)) > 1
@@ -0,0 +1,64 @@
+from types import SimpleNamespace
+
+import pytest
+
+PARAMETERS = {"parallel": 2, "max_clones_per_datastore": 0,
+              "max_clones_per_host": 0, "clone_retries": 0,
+              "power_on_batch": 1}
+
+
+class FakeVM(object):
+    def __init__(self, name, power_on=None):
+        self.name = name
+        self.role = "worker"
+        self.role_config = {}
+        self.guestinfo = True
+        self.cloud_init_mode = "guestinfo"
+        self.powered_on = False
+        self._power_on = power_on
+
+    def claim(self):
+        pass
+
+    async def power_on_aio(self, waiter):
+        if self._power_on:
+            raise self._power_on
+        self.powered_on = True
+
+
+@pytest.fixture
+def waiter(caasp, monkeypatch):
+    class FakeWaiter(object):
+        _call = caasp.TaskWaiter._call
+
+        def __init__(self, vsphere):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+    monkeypatch.setattr(caasp, "TaskWaiter", FakeWaiter)
+
+
+def test_node_failures(caasp, waiter, monkeypatch, caplog):
+    def set_guestinfo(vm, admin_ip, compress=False):
+        if vm.name == "guestinfo":
+            raise caasp.vmodl.fault.InvalidArgument(msg="too large")
+
+    monkeypatch.setattr(caasp.CloudInit, "set_guestinfo", set_guestinfo)
+    vms = [FakeVM("ok"), FakeVM("guestinfo"),
+           FakeVM("power-on", caasp.vim.fault.InvalidPowerState(
+               msg="invalid state"))]
+
+    with pytest.raises(SystemExit):
+        caasp.deploy_nodes(SimpleNamespace(), PARAMETERS, vms, vms,
+                           "10.0.0.1")
+
+    # a failed node does not stop the others
+    assert [vm.powered_on for vm in vms] == [True, False, False]
+    assert "deploy of guestinfo failed: too large" in caplog.text
+    assert "deploy of power-on failed: invalid state" in caplog.text
+    assert "deploy failed: guestinfo, power-on" in caplog.text
@@ -0,0 +1,67 @@
+import io
+
+import pytest
+
+pycdlib = pytest.importorskip("pycdlib")
+
+
+def open_iso(data):
+    iso = pycdlib.PyCdlib()
+    iso.open_fp(io.BytesIO(data))
+    return iso
+
+
+def read(iso, **path):
+    out = io.BytesIO()
+    iso.get_file_from_iso_fp(out, **path)
+    return out.getvalue()
+
+
+def test_cidata_image(caasp):
+    image = caasp.IsoImage("cidata")
+    user_data = b"#cloud-config\n" + b"x" * 5000
+    image.add_file("user-data", user_data)
+    image.add_file("meta-data", b"instance-id: master")
+    data = image.build()
+    assert len(data) % image.sector == 0
+
+    iso = open_iso(data)
+    try:
+        assert iso.has_joliet()
+        assert iso.has_rock_ridge()
+        assert read(iso, joliet_path="/user-data") == user_data
+        assert read(iso, rr_path="/user-data") == user_data
+        assert read(iso, iso_path="/META_DAT.;1") == b"instance-id: master"
+        assert sorted(c.file_identifier().decode("utf-16-be") for c in
+                      iso.list_children(joliet_path="/")
+                      if not c.is_dot() and not c.is_dotdot()) == \
+            ["meta-data", "user-data"]
+    finally:
+        iso.close()
+
+
+def test_volume_id(caasp):
+    image = caasp.IsoImage("cidata")
+    image.add_file("user-data", b"")
+    iso = open_iso(image.build())
+    try:
+        assert iso.pvd.volume_identifier.rstrip() == b"cidata"
+    finally:
+        iso.close()
+
+
+@pytest.mark.parametrize("name, iso_name", [
+    ("user-data", b"USER_DAT.;1"),
+    ("meta-data", b"META_DAT.;1"),
+    ("network-config.yaml", b"NETWORK_.YAM;1"),
+])
+def test_iso_name(caasp, name, iso_name):
+    assert caasp.IsoImage._iso_name(name) == iso_name
+
+
+def test_too_many_files(caasp):
+    image = caasp.IsoImage("cidata")
+    for i in range(100):
+        image.add_file("file-with-a-long-name-{0:03d}".format(i), b"x")
+    with pytest.raises(ValueError):
+        image.build()
@@ -0,0 +1,95 @@
+from types import SimpleNamespace
+
+import pytest
+
+GIB = 1024 ** 3
+
+
+def datastore(name, free, capacity=1000 * GIB, tasks=0):
+    return {"obj": SimpleNamespace(_moId=name), "name": name,
+            "capacity": capacity, "free": free, "uncommitted": 0,
+            "tasks": tasks, "vms": 0}
+
+
+def host(name, datastores, memory=256 * GIB, used=0):
+    return {"obj": SimpleNamespace(_moId=name), "name": name,
+            "pool": "pool-" + name, "host": name,
+            "datastores": set(datastores), "memory": memory, "used": used,
+            "tasks": 0, "vms": 0}
+
+
+def vm(name, ram=4096):
+    return SimpleNamespace(name=name, ram=ram, template_name="template",
+                           linked_clone=False, placement={})
+
+
+def placement(caasp, datastores, hosts, disk_size=40 * GIB):
+    vsphere = SimpleNamespace(datastore=SimpleNamespace(_moId="media"))
+    result = caasp.Placement(vsphere, {"vc_datastores": ["candidates"],
+                                       "vc_hosts": ["candidates"]})
+    result.datastores = datastores
+    result.hosts = hosts
+    result._disk_sizes["template"] = disk_size
+    return result
+
+
+def test_spread_over_datastores(caasp):
+    stores = [datastore("ds-1", 500 * GIB), datastore("ds-2", 500 * GIB)]
+    p = placement(caasp, stores, [host("esx-1", ["media", "ds-1", "ds-2"])])
+    vms = [vm("vm-{0}".format(i)) for i in range(4)]
+    p.assign(vms)
+    names = [v.placement["datastore"]._moId for v in vms]
+    assert names.count("ds-1") == names.count("ds-2") == 2
+    assert stores[0]["free"] == stores[1]["free"] == 420 * GIB
+
+
+def test_emptiest_datastore_first(caasp):
+    stores = [datastore("ds-1", 100 * GIB), datastore("ds-2", 800 * GIB)]
+    p = placement(caasp, stores, [host("esx-1", ["media", "ds-1", "ds-2"])])
+    vms = [vm("vm-1")]
+    p.assign(vms)
+    assert vms[0].placement["datastore"]._moId == "ds-2"
+
+
+def test_spread_over_hosts(caasp):
+    stores = [datastore("ds-1", 800 * GIB)]
+    hosts = [host("esx-1", ["media", "ds-1"]),
+             host("esx-2", ["media", "ds-1"], used=128 * GIB),
+             # cannot reach the media
+             host("esx-3", ["ds-1"])]
+    p = placement(caasp, stores, hosts)
+    vms = [vm("vm-{0}".format(i), ram=32 * 1024) for i in range(6)]
+    p.assign(vms)
+    names = [v.placement["host"] for v in vms]
+    assert "esx-3" not in names
+    # the busier host gets less
+    assert names.count("esx-1") > names.count("esx-2") > 0
+    assert all(v.placement["pool"] == "pool-" + v.placement["host"]
+               for v in vms)
+
+
+def test_full_datastore(caasp):
+    stores = [datastore("ds-1", 30 * GIB), datastore("ds-2", 50 * GIB)]
+    p = placement(caasp, stores, [host("esx-1", ["media", "ds-1", "ds-2"])])
+    vms = [vm("vm-1")]
+    p.assign(vms)
+    assert vms[0].placement["datastore"]._moId == "ds-2"
+    with pytest.raises(SystemExit):
+        p.assign([vm("vm-2")])
+
+
+def test_templates_stay_on_the_media_datastore(caasp):
+    stores = [datastore("ds-1", 500 * GIB)]
+    p = placement(caasp, stores, [host("esx-1", ["media", "ds-1"])])
+    template = vm("template")
+    p.assign([template], templates=True)
+    assert template.placement == {"pool": "pool-esx-1", "host": "esx-1"}
+    assert stores[0]["free"] == 500 * GIB
+
+
+def test_disabled(caasp):
+    p = caasp.Placement(None, {"vc_datastores": [], "vc_hosts": []})
+    vms = [vm("vm-1")]
+    p.assign(vms)
+    assert not p.enabled
+    assert vms[0].placement == {}
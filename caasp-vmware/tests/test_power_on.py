@@ -0,0 +1,94 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeWaiter(object):
+    """ TaskWaiter returning the result, or raising the fault, of a task """
+
+    def __init__(self, results):
+        self.results = results
+
+    async def wait(self, task):
+        result = self.results[task]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+class FakeVM(object):
+    def __init__(self, name):
+        self.name = name
+        self.vm_obj = SimpleNamespace(_moId=name, name=name)
+        self.single = False
+
+    async def power_on_aio(self, waiter):
+        self.single = True
+
+
+@pytest.fixture(autouse=True)
+def linger(caasp, monkeypatch):
+    monkeypatch.setattr(caasp.PowerOnBatcher, "linger", 0.01)
+
+
+def power_on(caasp, multi_vm, waiter, vms, size=4):
+    batcher = caasp.PowerOnBatcher(
+        SimpleNamespace(datacenter=SimpleNamespace(
+            PowerOnMultiVM_Task=multi_vm)), waiter, size)
+
+    async def run():
+        results = await asyncio.wait_for(asyncio.gather(
+            *[batcher.power_on(vm) for vm in vms],
+            return_exceptions=True), 5)
+        assert not batcher._batches
+        return results
+
+    return caasp.run_async(run())
+
+
+def test_batch(caasp):
+    vms = [FakeVM("vm-1"), FakeVM("vm-2"), FakeVM("vm-3")]
+    sent = []
+
+    def multi_vm(vm):
+        sent.append([v._moId for v in vm])
+        return "multi"
+
+    attempted = [SimpleNamespace(vm=v.vm_obj, task="task-" + v.name)
+                 for v in vms[:2]]
+    not_attempted = [SimpleNamespace(vm=vms[2].vm_obj, fault=None)]
+    waiter = FakeWaiter({
+        "multi": SimpleNamespace(attempted=attempted,
+                                 notAttempted=not_attempted),
+        "task-vm-1": None,
+        "task-vm-2": caasp.vim.fault.InvalidPowerState()})
+
+    assert power_on(caasp, multi_vm, waiter, vms) == [None, None, None]
+    assert sent == [["vm-1", "vm-2", "vm-3"]]
+    # failed or not attempted by the batch, powered-on one by one
+    assert [vm.single for vm in vms] == [False, True, True]
+
+
+def test_full_batches(caasp):
+    vms = [FakeVM("vm-{0}".format(i)) for i in range(5)]
+    sent = []
+
+    def multi_vm(vm):
+        sent.append(len(vm))
+        return "multi"
+
+    waiter = FakeWaiter({"multi": SimpleNamespace(attempted=[],
+                                                  notAttempted=[])})
+    power_on(caasp, multi_vm, waiter, vms, size=2)
+    assert sent == [2, 2, 1]
+
+
+@pytest.mark.parametrize("error", [IOError("connection reset"),
+                                   AttributeError("fault")])
+def test_unexpected_error(caasp, error):
+    def multi_vm(vm):
+        raise error
+
+    vms = [FakeVM("vm-1"), FakeVM("vm-2")]
+    assert power_on(caasp, multi_vm, FakeWaiter({}), vms) == [error, error]
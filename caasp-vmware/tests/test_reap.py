@@ -0,0 +1,166 @@
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+NOW = datetime.datetime(2026, 1, 10)
+OLD = NOW - datetime.timedelta(days=3)
+GIB = 1024 ** 3
+
+
+def vm(name, template=False, powered_on=False, used=OLD, annotation=""):
+    return {"obj": SimpleNamespace(_moId=name), "name": name,
+            "config.template": template, "config.createDate": used,
+            "config.annotation": annotation,
+            "runtime.powerState": "poweredOn" if powered_on else "poweredOff",
+            "runtime.bootTime": None, "summary.config.numCpu": 2,
+            "summary.config.memorySizeMB": 4096,
+            "summary.storage.committed": GIB}
+
+
+def parameters(**extra):
+    result = {"admin_prefix": "caasp-admin", "master_prefix": "caasp-master",
+              "worker_prefix": "caasp-worker", "pool_folder": "caasp-pool",
+              "template_cache_folder": "caasp-templates",
+              "media_dir": "images/", "stack_name": "mine", "reap_ttl": 24,
+              "reap_stacks": [], "reap_confirm": False, "reap_force": False}
+    result.update(extra)
+    return result
+
+
+@pytest.fixture
+def vcenter(caasp, monkeypatch):
+    items = []
+    dirs = []
+
+    def search(datastorePath, searchSpec):
+        return SimpleNamespace(info=SimpleNamespace(
+            result=SimpleNamespace(file=dirs)))
+
+    monkeypatch.setattr(caasp, "retrieve_properties",
+                        lambda *args, **kwargs: items)
+    monkeypatch.setattr(caasp, "wait_for_task", lambda task: None)
+    monkeypatch.setattr(caasp.Datastore, "search_tree",
+                        lambda vsphere, path, patterns: [
+                            ("disk.vmdk", SimpleNamespace(fileSize=GIB))])
+    vsphere = SimpleNamespace(
+        datacenter=SimpleNamespace(vmFolder=None),
+        datastore=SimpleNamespace(name="ds", browser=SimpleNamespace(
+            SearchDatastore_Task=search)),
+        service_instance=SimpleNamespace(CurrentTime=lambda: NOW))
+    return vsphere, items, dirs
+
+
+def directory(name, modification=OLD):
+    return SimpleNamespace(path=name, modification=modification)
+
+
+def candidates(caasp, vsphere, **extra):
+    stacks, dependents = caasp.reap_candidates(vsphere, parameters(**extra))
+    return {s["name"]: s for s in stacks}, dependents
+
+
+def test_names(caasp, vcenter):
+    vsphere, items, dirs = vcenter
+    items += [vm("caasp-admin-ci-42000"), vm("caasp-master-ci-42000"),
+              vm("caasp-worker-ci-42001"),
+              vm("caasp-admin-ci-42", template=True),
+              vm("caasp-worker-other000"),
+              # warm pool, shared templates and foreign VMs
+              vm("caasp-pool-0123abcd-worker000"),
+              vm("caasp-template-0123456789abcdef", template=True),
+              vm("caasp-admin-nonumber"), vm("jenkins-worker-001")]
+    dirs += [directory("caasp-ci-42"), directory("caasp-pool"),
+             directory("caasp-templates"), directory("caasp-images"),
+             directory("caasp-failed")]
+    stacks, _ = candidates(caasp, vsphere, media_dir="caasp-images/")
+
+    assert sorted(stacks) == ["ci-42", "failed", "other"]
+    ci = stacks["ci-42"]
+    assert [i["name"] for i in ci["vms"]] == [
+        "caasp-admin-ci-42000", "caasp-master-ci-42000",
+        "caasp-worker-ci-42001"]
+    assert [i["name"] for i in ci["templates"]] == ["caasp-admin-ci-42"]
+    assert ci["dir"] == "caasp-ci-42"
+    assert ci["cpu"] == 6 and ci["ram"] == 12 * GIB
+    # leftover dir of a failed deploy, its disks are counted
+    assert stacks["failed"]["dir"] == "caasp-failed"
+    assert stacks["failed"]["disk"] == GIB
+    assert stacks["other"]["dir"] is None
+
+
+def test_reap_stacks(caasp, vcenter):
+    vsphere, items, dirs = vcenter
+    items += [vm("caasp-admin-ci1000"), vm("caasp-admin-ci2000"),
+              vm("caasp-admin-mine000")]
+    dirs += [directory("caasp-ci1"), directory("caasp-ci3")]
+    # stack_name does not restrict the candidates
+    stacks, _ = candidates(caasp, vsphere)
+    assert sorted(stacks) == ["ci1", "ci2", "ci3", "mine"]
+    stacks, _ = candidates(caasp, vsphere, reap_stacks=["ci1", "ci3"])
+    assert sorted(stacks) == ["ci1", "ci3"]
+
+
+def test_linked_clone_dependents(caasp, vcenter):
+    vsphere, items, dirs = vcenter
+    annotation = caasp.VMachine.linked_clone_annotation + "caasp-admin-ci1"
+    items += [vm("caasp-admin-ci2000", annotation=annotation)]
+    _, dependents = candidates(caasp, vsphere)
+    assert dependents == {"caasp-admin-ci1": ["caasp-admin-ci2000"]}
+
+
+@pytest.fixture
+def teardown(caasp, monkeypatch):
+    torn_down = []
+
+    class FakeWaiter(object):
+        def __init__(self, vsphere):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+    async def destroy_vm_aio(waiter, vm_obj, name):
+        torn_down.append(name)
+        return True
+
+    async def delete_deploy_dir_aio(vsphere, waiter, deploy_dir):
+        torn_down.append(deploy_dir)
+        return True
+
+    monkeypatch.setattr(caasp, "TaskWaiter", FakeWaiter)
+    monkeypatch.setattr(caasp, "destroy_vm_aio", destroy_vm_aio)
+    monkeypatch.setattr(caasp, "delete_deploy_dir_aio",
+                        delete_deploy_dir_aio)
+    return torn_down
+
+
+def reap(caasp, vsphere, **extra):
+    caasp.reap(vsphere, {"parameters": parameters(**extra)})
+
+
+def test_reap_reports_only(caasp, vcenter, teardown):
+    vsphere, items, dirs = vcenter
+    items += [vm("caasp-admin-ci1000")]
+    reap(caasp, vsphere)
+    assert teardown == []
+
+
+def test_reap(caasp, vcenter, teardown):
+    vsphere, items, dirs = vcenter
+    items += [vm("caasp-admin-ci1000"),
+              vm("caasp-admin-recent000", used=NOW),
+              vm("caasp-admin-running000", powered_on=True)]
+    dirs += [directory("caasp-ci1")]
+    reap(caasp, vsphere, reap_confirm=True)
+    assert teardown == ["caasp-admin-ci1000", "[ds]caasp-ci1"]
+
+
+def test_reap_force(caasp, vcenter, teardown):
+    vsphere, items, dirs = vcenter
+    items += [vm("caasp-admin-running000", powered_on=True)]
+    reap(caasp, vsphere, reap_confirm=True, reap_force=True)
+    assert teardown == ["caasp-admin-running000"]
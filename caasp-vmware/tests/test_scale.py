@@ -0,0 +1,133 @@
+from types import SimpleNamespace
+
+import pytest
+
+
+def node(role, index):
+    return {"name": "caasp-{0}-test{1:03d}".format(role, index),
+            "role": role, "cpu": 2, "ram": 4096}
+
+
+def deployed(role, index):
+    return dict(node(role, index), publicipv4="10.0.0.{0}".format(index))
+
+
+class FakeVMachine(object):
+    # names of the VMs found on vCenter
+    existing = set()
+
+    def __init__(self, vsphere, common_config, role_config, vm_config):
+        self.name = vm_config["name"]
+        self.role = vm_config["role"]
+        self.vm_config = vm_config
+        self.template_name = "caasp-{0}-test".format(self.role)
+        self.vm_obj = self.name if self.name in self.existing else None
+
+    def get_vm(self, isTemplate=False):
+        return self.template_name
+
+
+@pytest.fixture
+def stack(caasp, monkeypatch):
+    calls = {"destroyed": [], "deployed": [], "written": []}
+    state = {"config": {}, "vmguests": []}
+
+    class FakeWaiter(object):
+        def __init__(self, vsphere):
+            pass
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            pass
+
+    async def destroy_vm_aio(waiter, vm_obj, name):
+        calls["destroyed"].append(name)
+        # the real one fails on a missing VM
+        return vm_obj is not None
+
+    def deploy_nodes(vsphere, parameters, vms, claimed, admin_ip,
+                     iso_roles=None):
+        calls["deployed"].append(([vm.name for vm in vms], iso_roles))
+
+    monkeypatch.setattr(caasp, "VMachine", FakeVMachine)
+    monkeypatch.setattr(caasp, "TaskWaiter", FakeWaiter)
+    monkeypatch.setattr(caasp, "destroy_vm_aio", destroy_vm_aio)
+    monkeypatch.setattr(caasp, "deploy_nodes", deploy_nodes)
+    monkeypatch.setattr(caasp, "Placement", lambda vsphere, parameters:
+                        SimpleNamespace(assign=lambda vms: None))
+    monkeypatch.setattr(caasp, "nodes_state",
+                        lambda vsphere, vms: [vm.vm_config for vm in vms])
+    monkeypatch.setattr(caasp, "read_state_file", lambda parameters: state)
+    monkeypatch.setattr(caasp, "write_state_file",
+                        lambda parameters, state: calls["written"].append(
+                            [vm["name"] for vm in state["vmguests"]]))
+    return state, calls
+
+
+def scale(caasp, state, masters, workers, leftovers=(), gone=()):
+    FakeVMachine.existing = set(vm["name"] for vm in state["vmguests"])
+    FakeVMachine.existing.update(leftovers)
+    FakeVMachine.existing.difference_update(gone)
+    conf = {"parameters": {"pool_size": 0, "capacity_check": "off"}}
+    for role, count in [("admin", 1), ("master", masters),
+                        ("worker", workers)]:
+        conf[role] = {"config": {"role": role},
+                      "vmguests": [node(role, i) for i in range(count)]}
+    caasp.scale(None, conf)
+
+
+def test_scale_up(caasp, stack):
+    state, calls = stack
+    state["vmguests"] = [deployed("admin", 0), deployed("master", 0),
+                         deployed("worker", 0)]
+    scale(caasp, state, 1, 3)
+    assert calls["destroyed"] == []
+    # the isos of the deployed roles are already on the datastore
+    assert calls["deployed"] == [(["caasp-worker-test001",
+                                   "caasp-worker-test002"], set())]
+    assert state["config"] == {"master_count": 1, "worker_count": 3}
+    assert [vm["index"] for vm in state["vmguests"]] == [0, 1, 2, 3, 4]
+
+
+def test_scale_up_new_role(caasp, stack):
+    state, calls = stack
+    state["vmguests"] = [deployed("admin", 0), deployed("master", 0)]
+    scale(caasp, state, 1, 2)
+    assert calls["deployed"] == [(["caasp-worker-test000",
+                                   "caasp-worker-test001"], {"worker"})]
+
+
+def test_scale_down(caasp, stack):
+    state, calls = stack
+    state["vmguests"] = [deployed("admin", 0), deployed("master", 0)] + \
+        [deployed("worker", i) for i in range(3)]
+    scale(caasp, state, 1, 1)
+    assert sorted(calls["destroyed"]) == ["caasp-worker-test001",
+                                          "caasp-worker-test002"]
+    assert calls["deployed"] == []
+    assert calls["written"][-1] == ["caasp-admin-test000",
+                                    "caasp-master-test000",
+                                    "caasp-worker-test000"]
+    assert state["config"] == {"master_count": 1, "worker_count": 1}
+
+
+def test_scale_down_gone_vm(caasp, stack):
+    state, calls = stack
+    state["vmguests"] = [deployed("admin", 0), deployed("master", 0)] + \
+        [deployed("worker", i) for i in range(3)]
+    scale(caasp, state, 1, 1, gone=["caasp-worker-test002"])
+    # already deleted on vCenter, only dropped from the state
+    assert calls["destroyed"] == ["caasp-worker-test001"]
+    assert calls["written"][-1] == ["caasp-admin-test000",
+                                    "caasp-master-test000",
+                                    "caasp-worker-test000"]
+
+
+def test_leftover_vm(caasp, stack):
+    state, calls = stack
+    state["vmguests"] = [deployed("admin", 0), deployed("master", 0)]
+    with pytest.raises(SystemExit):
+        scale(caasp, state, 1, 1, leftovers=["caasp-worker-test000"])
+    assert calls["deployed"] == []
@@ -0,0 +1,114 @@
+import asyncio
+import queue
+from types import SimpleNamespace
+
+import pytest
+
+
+class FakeCollector(object):
+    """ PropertyCollector reporting the outcome of the tasks added to its
+    ListView, one update per ModifyListView call """
+
+    def __init__(self, vmodl, outcomes):
+        self.vmodl = vmodl
+        self.outcomes = outcomes
+        self.updates = queue.Queue()
+        self.view = []
+        self.version = 0
+        self.destroyed = False
+        self.error = None
+
+    # ListView
+
+    def ModifyListView(self, add=None, remove=None):
+        for task in add or []:
+            self.view.append(task)
+            self.version += 1
+            self.updates.put(SimpleNamespace(
+                version=str(self.version),
+                filterSet=[SimpleNamespace(objectSet=[SimpleNamespace(
+                    kind="enter", obj=task,
+                    changeSet=[SimpleNamespace(name=k, val=v) for k, v in
+                               self.outcomes[task._moId].items()])])]))
+        for task in remove or []:
+            self.view.remove(task)
+
+    def DestroyView(self):
+        pass
+
+    # PropertyCollector
+
+    def WaitForUpdatesEx(self, version, options):
+        if self.error:
+            raise self.error
+        try:
+            update = self.updates.get(timeout=options.maxWaitSeconds)
+        except queue.Empty:
+            return None
+        if update == "cancel":
+            raise self.vmodl.fault.RequestCanceled()
+        return update
+
+    def CancelWaitForUpdates(self):
+        self.updates.put("cancel")
+
+    def DestroyPropertyCollector(self):
+        self.destroyed = True
+
+
+def task(moid):
+    return SimpleNamespace(_moId=moid)
+
+
+@pytest.fixture
+def waiter(caasp, monkeypatch):
+    outcomes = {}
+    collector = FakeCollector(caasp.vmodl, outcomes)
+
+    def setup(self):
+        self._collector = collector
+        self._view = SimpleNamespace(ModifyListView=collector.ModifyListView,
+                                     DestroyView=collector.DestroyView)
+
+    monkeypatch.setattr(caasp.TaskWaiter, "_setup", setup)
+    monkeypatch.setattr(caasp.TaskWaiter, "max_wait", 1)
+    return caasp.TaskWaiter(None), collector, outcomes
+
+
+def test_results_and_faults(caasp, waiter):
+    waiter, collector, outcomes = waiter
+    fault = caasp.vim.fault.FileLocked()
+    outcomes["task-1"] = {"info.state": "success", "info.result": 42,
+                          "info.progress": 100}
+    outcomes["task-2"] = {"info.state": "error", "info.error": fault}
+
+    async def run():
+        async with waiter:
+            return await asyncio.gather(waiter.wait(task("task-1")),
+                                        waiter.wait(task("task-2")),
+                                        return_exceptions=True)
+
+    assert caasp.run_async(run()) == [42, fault]
+    assert waiter.progress(task("task-1")) == 100
+    # completed tasks leave the view
+    assert collector.view == []
+    assert collector.destroyed
+
+
+def test_failed_update_loop(caasp, waiter):
+    waiter, collector, outcomes = waiter
+    outcomes["task-1"] = {"info.state": "running"}
+
+    async def run():
+        async with waiter:
+            pending = asyncio.ensure_future(waiter.wait(task("task-1")))
+            await asyncio.sleep(0.1)
+            collector.error = IOError("connection reset")
+            collector.updates.put(None)
+            with pytest.raises(IOError):
+                await asyncio.wait_for(pending, 5)
+            # nothing would resolve a later wait
+            with pytest.raises(IOError):
+                await asyncio.wait_for(waiter.wait(task("task-2")), 5)
+
+    caasp.run_async(run())
@@ -0,0 +1,185 @@
+from types import SimpleNamespace
+
+import pytest
+import requests
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, delay):
+        self.slept += delay
+        self.now += delay
+
+
+def test_bandwidth_limiter(caasp, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(caasp, "time", clock)
+    limiter = caasp.BandwidthLimiter(100)
+    # a second worth of burst, then the rate
+    limiter.consume(100)
+    assert clock.slept == 0
+    limiter.consume(50)
+    assert clock.slept == pytest.approx(0.5)
+    limiter.consume(100)
+    assert clock.slept == pytest.approx(1.5)
+    clock.now += 10
+    limiter.consume(100)
+    assert clock.slept == pytest.approx(1.5)
+
+
+def test_bandwidth_limiter_off(caasp, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(caasp, "time", clock)
+    limiter = caasp.BandwidthLimiter(0)
+    limiter.consume(10 ** 12)
+    assert clock.slept == 0
+
+
+@pytest.fixture
+def vsphere(caasp):
+    return SimpleNamespace(
+        host="vcenter", insecure=True, transfer_parallel=2,
+        transfer_limiter=caasp.BandwidthLimiter(0), http_session=None,
+        datacenter=SimpleNamespace(name="dc"),
+        datastore=SimpleNamespace(name="ds",
+                                  info=SimpleNamespace(name="ds")),
+        datastore_cache=caasp.DatastoreCache())
+
+
+def test_stat_files(caasp, vsphere, monkeypatch):
+    searches = []
+
+    def search(datastorePath, searchSpec):
+        searches.append((datastorePath, sorted(searchSpec.matchPattern)))
+        files = [SimpleNamespace(path=name, fileSize=len(name))
+                 for name in searchSpec.matchPattern if name != "missing"]
+        return SimpleNamespace(info=SimpleNamespace(
+            result=SimpleNamespace(file=files)))
+
+    vsphere.datastore.browser = SimpleNamespace(SearchDatastore_Task=search)
+    monkeypatch.setattr(caasp, "wait_for_task", lambda task: None)
+    remote = ["a/one", "a/two", "a/missing", "b/three"]
+    infos = caasp.Datastore.stat_files(vsphere, remote)
+    # a search per directory
+    assert sorted(searches) == [("[ds]a", ["missing", "one", "two"]),
+                                ("[ds]b", ["three"])]
+    assert infos["a/one"].fileSize == 3
+    assert infos["a/missing"] is None
+    # answered by the cache
+    caasp.Datastore.stat_files(vsphere, remote)
+    assert len(searches) == 2
+
+
+def test_upload_files(caasp, vsphere, monkeypatch):
+    sent = []
+
+    class FakeRequest(object):
+        def __init__(self, http_url, **kwargs):
+            self.url = http_url
+
+        def put(self, data):
+            sent.append((self.url, b"".join(data)))
+
+        def close(self):
+            pass
+
+    monkeypatch.setattr(caasp, "HttpRequest", FakeRequest)
+    monkeypatch.setattr(caasp.Datastore, "stat_files", lambda vsphere, files: {
+        "same": SimpleNamespace(fileSize=4),
+        "changed": SimpleNamespace(fileSize=3),
+        "new": None})
+    caasp.Datastore.upload_files(vsphere, [
+        (b"same", "same", None), (b"data", "changed", None),
+        (b"data", "new", None)])
+    assert sorted(sent) == [("https://vcenter:443/folder/changed", b"data"),
+                            ("https://vcenter:443/folder/new", b"data")]
+
+
+class FakeResponse(object):
+    def __init__(self, blocks, status=200):
+        self.blocks = blocks
+        self.status = status
+
+    def raise_for_status(self):
+        if self.status != 200:
+            raise requests.HTTPError(self.status)
+
+    def iter_content(self, size):
+        for block in self.blocks:
+            if isinstance(block, Exception):
+                raise block
+            yield block
+
+    def close(self):
+        pass
+
+
+def test_download_files(caasp, vsphere, tmp_path):
+    responses = {
+        "https://vcenter:443/folder/vm-1/vmware.log": FakeResponse(
+            [b"log ", b"lines"]),
+        "https://vcenter:443/folder/vm-1/vm-1.vmx": FakeResponse(
+            [b"config", requests.ConnectionError("reset")]),
+        "https://vcenter:443/folder/vm-1/missing": FakeResponse([], 404)}
+    vsphere.http_session = SimpleNamespace(
+        get=lambda url, params, stream: responses[url])
+
+    downloaded = caasp.Datastore.download_files(vsphere, [
+        ("[ds] vm-1/vmware.log", str(tmp_path / "vm-1" / "vmware.log")),
+        ("[ds] vm-1/vm-1.vmx", str(tmp_path / "vm-1" / "vm-1.vmx")),
+        ("[ds] vm-1/missing", str(tmp_path / "vm-1" / "missing")),
+        ("not a datastore path", str(tmp_path / "other"))])
+    assert downloaded == 1
+    assert (tmp_path / "vm-1" / "vmware.log").read_bytes() == b"log lines"
+    # no partial file left behind
+    assert sorted(p.name for p in (tmp_path / "vm-1").iterdir()) == \
+        ["vmware.log"]
+
+
+def test_collect(caasp, vsphere, monkeypatch, tmp_path):
+    def file(name, kind):
+        return SimpleNamespace(name=name, type=kind)
+
+    monkeypatch.setattr(caasp, "retrieve_properties", lambda *a, **k: [
+        {"name": "caasp-admin-test000", "layoutEx.file": [
+            file("[ds] caasp-admin-test000/vmware.log", "log"),
+            file("[ds] caasp-admin-test000/vmware-1.log", "log"),
+            file("[ds] caasp-admin-test000/caasp-admin-test000.vmx",
+                 "config"),
+            file("[ds] caasp-admin-test000/disk.vmdk", "diskDescriptor")]},
+        {"name": "other", "layoutEx.file": [
+            file("[ds] other/vmware.log", "log")]}])
+    transfers = []
+    monkeypatch.setattr(caasp.Datastore, "download_files",
+                        lambda vsphere, files: transfers.extend(files) or
+                        len(files))
+    vsphere.datacenter.vmFolder = None
+    conf = {"parameters": {"collect_dir": str(tmp_path)},
+            "admin": {"vmguests": [{"name": "caasp-admin-test000"}]},
+            "master": {"vmguests": [{"name": "caasp-master-test000"}]},
+            "worker": {"vmguests": []}}
+    caasp.collect(vsphere, conf)
+    local = str(tmp_path / "caasp-admin-test000")
+    assert sorted(transfers) == [
+        ("[ds] caasp-admin-test000/caasp-admin-test000.vmx",
+         local + "/caasp-admin-test000.vmx"),
+        ("[ds] caasp-admin-test000/vmware-1.log", local + "/vmware-1.log"),
+        ("[ds] caasp-admin-test000/vmware.log", local + "/vmware.log")]
+
+
+def test_http_pool_fits_the_transfers(caasp):
+    vsphere = caasp.VSphere.__new__(caasp.VSphere)
+    vsphere._http_session = None
+    vsphere.insecure = True
+    vsphere.transfer_parallel = 12
+    vsphere.service_instance = SimpleNamespace(_stub=SimpleNamespace(
+        cookie='vmware_soap_session="52a1"; Path=/; HttpOnly; Secure;'))
+    session = vsphere.http_session
+    assert session.get_adapter("https://vcenter")._pool_maxsize == 12
+    assert session.cookies["vmware_soap_session"] == '"52a1"'
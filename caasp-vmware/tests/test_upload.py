@@ -0,0 +1,99 @@
+import hashlib
+import io
+from types import SimpleNamespace
+
+import pytest
+
+DIGEST = hashlib.sha256(b"image").hexdigest()
+OTHER = hashlib.sha256(b"other").hexdigest()
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "image.vmdk"
+    path.write_bytes(b"image")
+    return path
+
+
+@pytest.mark.parametrize("content", [
+    DIGEST,
+    "{0}  image.vmdk\n".format(DIGEST),
+    "{0} *image.vmdk\n".format(DIGEST),
+    "{0}  other.vmdk\n{1}  image.vmdk\n".format(OTHER, DIGEST.upper()),
+    "-----BEGIN PGP SIGNED MESSAGE-----\nHash: SHA256\n\n"
+    "{0}  image.vmdk\n-----BEGIN PGP SIGNATURE-----\n\n"
+    "iQEzBAEBCAAdFiEE\n-----END PGP SIGNATURE-----\n".format(DIGEST),
+])
+def test_published_sha256(caasp, source, content):
+    (source.parent / "image.vmdk.sha256").write_text(content)
+    assert caasp.published_sha256(str(source)) == DIGEST
+
+
+@pytest.mark.parametrize("content", [
+    "{0}  other.vmdk\n".format(OTHER),
+    "not a checksum\n",
+    "",
+])
+def test_published_sha256_not_found(caasp, source, content):
+    (source.parent / "image.vmdk.sha256").write_text(content)
+    assert caasp.published_sha256(str(source)) is None
+
+
+def test_published_sha256_missing(caasp, source):
+    assert caasp.published_sha256(str(source)) is None
+
+
+def test_published_sha256_http(caasp, monkeypatch):
+    urls = []
+
+    def get(url, timeout):
+        urls.append(url)
+        return SimpleNamespace(status_code=200,
+                               text="{0}  image.vmdk\n".format(DIGEST))
+
+    monkeypatch.setattr(caasp, "requests", SimpleNamespace(
+        get=get, RequestException=IOError))
+    assert caasp.published_sha256("http://example.com/image.vmdk") == DIGEST
+    assert urls == ["http://example.com/image.vmdk.sha256"]
+
+
+def test_upload_stream(caasp):
+    data = bytes(range(256)) * 10000
+    stream = caasp.UploadStream(io.BytesIO(data), len(data), "image.vmdk")
+    assert len(stream) == len(data)
+    blocks = list(stream)
+    assert all(len(b) <= stream.block_size for b in blocks)
+    assert b"".join(blocks) == data
+    assert stream.sent == len(data)
+    assert stream.sha256.hexdigest() == hashlib.sha256(data).hexdigest()
+    assert "image.vmdk" in stream.progress()
+
+
+@pytest.mark.parametrize("length", [True, False])
+def test_stream_upload_http(caasp, monkeypatch, length):
+    data = b"image" * 100000
+    headers = {"Content-Length": str(len(data))} if length else {}
+    sent = {}
+
+    class FakeSource(object):
+        def __init__(self, **kwargs):
+            pass
+
+        def get(self, **kwargs):
+            return SimpleNamespace(headers=headers, raw=io.BytesIO(data),
+                                   close=lambda: None)
+
+        def close(self):
+            pass
+
+    def put(data):
+        # the /folder endpoint needs the size
+        sent["length"] = len(data)
+        sent["body"] = b"".join(data)
+
+    monkeypatch.setattr(caasp, "HttpRequest", FakeSource)
+    caasp.Datastore._stream_upload(
+        SimpleNamespace(transfer_limiter=None),
+        "http://example.com/image.vmdk", SimpleNamespace(put=put),
+        "[ds]images/image.vmdk", sha256=hashlib.sha256(data).hexdigest())
+    assert sent == {"length": len(data), "body": data}
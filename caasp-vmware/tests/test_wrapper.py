@@ -0,0 +1,36 @@
+import json
+import os
+import stat
+import subprocess
+
+WRAPPER = os.path.join(os.path.dirname(__file__), "..", "caasp-vmware")
+
+INDEX = {"datastore": "datastore1", "path": "caasp-team",
+         "images": [{"name": "SUSE-CaaSP-4.0.vmdk", "type": "vmdk",
+                     "size": 1024, "modified": "2019-06-01T00:00:00"}]}
+
+
+def script(path, body):
+    path.write_text("#!/bin/sh\n" + body)
+    path.chmod(path.stat().st_mode | stat.S_IEXEC)
+
+
+def test_json_output_is_parsable(tmp_path):
+    """ pip output must not end up in the stdout of listimages """
+    bindir = tmp_path / "py3venv" / "bin"
+    bindir.mkdir(parents=True)
+    # pip3 ignoring -q, as it does for some messages
+    script(bindir / "pip3",
+           "echo 'Requirement already satisfied: pyyaml in /venv'\n")
+    # the logging of caasp-vmware.py goes to stderr
+    script(bindir / "python3",
+           "echo '   0 INFO list images' >&2\n"
+           "cat <<'EOF'\n{0}\nEOF\n".format(json.dumps(INDEX, indent=2)))
+
+    out = subprocess.check_output(
+        [WRAPPER, "--output", "json", "listimages"],
+        cwd=os.path.dirname(WRAPPER),
+        env=dict(os.environ, WORKSPACE=str(tmp_path)),
+        stderr=subprocess.DEVNULL)
+
+    assert json.loads(out.decode()) == INDEX
@@ -8,6 +8,7 @@
 from subprocess import check_output
 from urllib.parse import urljoin, urlsplit
 import glob
+import json
 import re
 import subprocess
 
@@ -42,33 +43,28 @@ def pick_file_urls(list_url, fn_pattern):
     return out
 
 def fetch_images_in_vsphere():
-    lines = check_output(
-        "cd caasp-vmware && ./caasp-vmware --vc-host jazz.qa.prv.suse.net --media-dir caasp-team listimages",
+    out = check_output(
+        "cd caasp-vmware && ./caasp-vmware --vc-host jazz.qa.prv.suse.net --media-dir caasp-team --session-cache --output json listimages",
         shell=True
     )
-    lines = lines.decode()
-    print("--")
-    print(lines)
-    print("--")
-
-    i = lines.find('available vmdk:\n')
-    lines = lines[i+16:]
-    r = re.compile('SUSE-CaaSP-.*vmdk$')
-    out = set()
-    for l in lines.splitlines():
-        m = r.search(l)
-        if m:
-            out.add(m.group(0))
+    index = json.loads(out.decode())
+    # keep the index around, it can be diffed with the one of the next run
+    with open('vmware_img_index.json', 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
 
-    return out
+    # images of the media dir itself, not of its sub directories
+    r = re.compile('SUSE-CaaSP-[^/]*vmdk$')
+    return set(i["name"] for i in index["images"]
+               if i["type"] == "vmdk" and r.match(i["name"]))
 
 
 def scan_downloaded_images():
     return set(glob.glob('SUSE-CaaSP*.vmdk'))
 
 
-def upload_image_to_vsphere(fn):
-    cmd = "./caasp-vmware --vc-host jazz.qa.prv.suse.net  --media-dir caasp-team  --source-media ../{} pushimage".format(fn)
+def upload_images_to_vsphere(fnames):
+    sources = ",".join("../{}".format(fn) for fn in fnames)
+    cmd = "./caasp-vmware --vc-host jazz.qa.prv.suse.net  --media-dir caasp-team  --session-cache --source-media {} pushimage".format(sources)
     lines = check_output(
         "cd caasp-vmware && " + cmd,
         shell=True
@@ -84,7 +80,7 @@ def save_img_filename(fn):
 
 def delete_image_in_vsphere(fn):
     print("Purging old image from vSphere: %s" % fn)
-    cmd = "./caasp-vmware --vc-host jazz.qa.prv.suse.net  --media-dir caasp-team  --media {} deleteimage".format(fn)
+    cmd = "./caasp-vmware --vc-host jazz.qa.prv.suse.net  --media-dir caasp-team  --session-cache --media {} deleteimage".format(fn)
     lines = check_output(
         "cd caasp-vmware && " + cmd,
         shell=True
@@ -130,10 +126,10 @@ def main():
         print("Available for download: %s" % sorted(new_fnames))
         sys.exit(1)
 
-    fn = sorted(local_fnames)[0]
-    print("Uploading %s to vSphere" % fn)
-    upload_image_to_vsphere(fn)
-    save_img_filename(fn)
+    fnames = sorted(local_fnames)
+    print("Uploading %s to vSphere" % ", ".join(fnames))
+    upload_images_to_vsphere(fnames)
+    save_img_filename(fnames[0])
     print("done")
 
 